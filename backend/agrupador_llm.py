@@ -0,0 +1,102 @@
+import asyncio
+from typing import Awaitable, Callable, Generic, List, Optional, Tuple, TypeVar
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+class AgrupadorSolicitudes(Generic[T, R]):
+    """
+    Junta los pedidos que llegan dentro de una ventana de tiempo y los resuelve con una sola llamada
+    a `procesar_lote(items) -> resultados` (mismo orden). Cada llamador espera solo su resultado.
+
+    El lote se despacha al vencer la ventana, al llegar a `max_items` o cuando el próximo item haría
+    superar `presupuesto` (sumando `costo(item)`, por ejemplo tokens). Con ventana 0 no se agrupa.
+    Si `procesar_lote` falla, todos los llamadores del lote reciben la excepción; si en lugar de un
+    resultado devuelve una excepción, solo ese llamador la recibe.
+    """
+
+    def __init__(self, nombre: str, procesar_lote: Callable[[List[T]], Awaitable[List[R]]],
+                 ventana: float = 0.05, max_items: int = 8,
+                 presupuesto: Optional[int] = None, costo: Optional[Callable[[T], int]] = None):
+        self.nombre = nombre
+        self.procesar_lote = procesar_lote
+        self.ventana = ventana
+        self.max_items = max_items
+        self.presupuesto = presupuesto
+        self.costo = costo
+        self._pendientes: List[Tuple[T, asyncio.Future]] = []
+        self._costo_pendiente = 0
+        self._temporizador: Optional[asyncio.TimerHandle] = None
+        self._loop = None
+        self._tareas = set()
+        self.lotes = 0
+        self.items = 0
+
+    async def pedir(self, item: T) -> R:
+        if self.ventana <= 0 or self.max_items <= 1:
+            self.lotes += 1
+            self.items += 1
+            resultado = (await self.procesar_lote([item]))[0]
+            if isinstance(resultado, Exception):
+                raise resultado
+            return resultado
+
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # Los futures quedan atados al event loop en el que se crean
+            self._loop = loop
+            self._pendientes, self._costo_pendiente, self._temporizador = [], 0, None
+
+        costo = self.costo(item) if self.costo else 0
+        if self._pendientes and self.presupuesto and self._costo_pendiente + costo > self.presupuesto:
+            self._despachar()
+
+        futuro = loop.create_future()
+        self._pendientes.append((item, futuro))
+        self._costo_pendiente += costo
+        if len(self._pendientes) >= self.max_items:
+            self._despachar()
+        elif self._temporizador is None:
+            self._temporizador = loop.call_later(self.ventana, self._despachar)
+        return await futuro
+
+    def _despachar(self):
+        if self._temporizador is not None:
+            self._temporizador.cancel()
+            self._temporizador = None
+        lote, self._pendientes, self._costo_pendiente = self._pendientes, [], 0
+        if not lote:
+            return
+        self.lotes += 1
+        self.items += len(lote)
+        tarea = self._loop.create_task(self._resolver(lote))
+        # Referencia fuerte para que la tarea no sea recolectada antes de terminar
+        self._tareas.add(tarea)
+        tarea.add_done_callback(self._tareas.discard)
+
+    async def _resolver(self, lote: List[Tuple[T, asyncio.Future]]):
+        if len(lote) > 1:
+            print(f"📨 {self.nombre}: {len(lote)} pedidos en un solo request")
+        try:
+            resultados = await self.procesar_lote([item for item, _ in lote])
+        except Exception as e:
+            for _, futuro in lote:
+                if not futuro.done():
+                    futuro.set_exception(e)
+            return
+        for (_, futuro), resultado in zip(lote, resultados):
+            if futuro.done():
+                continue
+            if isinstance(resultado, Exception):
+                futuro.set_exception(resultado)
+            else:
+                futuro.set_result(resultado)
+
+    def estadisticas(self) -> dict:
+        return {
+            "ventana_ms": round(self.ventana * 1000),
+            "lotes": self.lotes,
+            "items": self.items,
+            "promedio_por_lote": round(self.items / self.lotes, 2) if self.lotes else 0,
+        }
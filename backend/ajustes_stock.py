@@ -0,0 +1,107 @@
+"""
+Ajustes masivos de stock (conteos físicos, importaciones): filas {id|codigo, delta|absoluto} en JSON,
+CSV o NDJSON que se aplican en una sola transacción del repositorio, con un resultado por fila.
+"""
+import csv
+import io
+import json
+from typing import Callable, Iterable, List, Optional
+
+from repositorio_stock import ConflictoVersion
+
+
+class SimulacionAjustes(Exception):
+    """Corta la transacción de un dry-run después de calcular los resultados, así no se guarda nada"""
+
+    def __init__(self, resultados: List[dict]):
+        super().__init__("dry-run")
+        self.resultados = resultados
+
+
+def formato_de(tipo_contenido: str) -> str:
+    """json, csv o ndjson según el Content-Type (json si no se reconoce)"""
+    tipo = (tipo_contenido or '').split(';')[0].strip().lower()
+    if tipo in ('text/csv', 'application/csv'):
+        return 'csv'
+    if tipo in ('application/x-ndjson', 'application/ndjson', 'application/jsonl'):
+        return 'ndjson'
+    return 'json'
+
+
+def leer_filas(contenido: bytes, formato: str) -> List[dict]:
+    """Filas del cuerpo del request; ValueError si el formato no se puede leer"""
+    try:
+        texto = contenido.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise ValueError("El contenido no está en UTF-8")
+    if formato == 'csv':
+        lector = csv.DictReader(io.StringIO(texto))
+        if not lector.fieldnames:
+            return []
+        return [{clave.strip().lower(): (valor or '').strip() for clave, valor in fila.items() if clave}
+                for fila in lector]
+    try:
+        if formato == 'ndjson':
+            filas = [json.loads(linea) for linea in texto.splitlines() if linea.strip()]
+        else:
+            datos = json.loads(texto) if texto.strip() else []
+            filas = datos.get('ajustes', []) if isinstance(datos, dict) else datos
+    except json.JSONDecodeError as e:
+        raise ValueError(f"JSON inválido: {e}")
+    if not isinstance(filas, list) or not all(isinstance(fila, dict) for fila in filas):
+        raise ValueError("Se esperaba una lista de objetos {id|codigo, delta|absoluto}")
+    return filas
+
+
+def _entero(fila: dict, campo: str) -> Optional[int]:
+    valor = fila.get(campo)
+    if valor is None or valor == '':
+        return None
+    if isinstance(valor, bool):
+        raise ValueError(f"'{campo}' debe ser un número entero")
+    if isinstance(valor, float) and valor.is_integer():
+        return int(valor)
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        raise ValueError(f"'{campo}' debe ser un número entero")
+
+
+def aplicar_ajustes(tx, filas: Iterable[dict], obtener_por_codigo: Callable) -> List[dict]:
+    """
+    Aplica las filas sobre la transacción en orden (varias filas del mismo producto se acumulan).
+    Una fila con error no frena a las demás: queda con estado 'error' y su motivo
+    """
+    resultados = []
+    for numero, fila in enumerate(filas, start=1):
+        resultado = {"fila": numero, "id": fila.get('id') or None, "codigo": fila.get('codigo') or None}
+        try:
+            producto_id = _entero(fila, 'id')
+            delta, absoluto = _entero(fila, 'delta'), _entero(fila, 'absoluto')
+            if (producto_id is None) == (not resultado["codigo"]):
+                raise ValueError("Cada fila lleva 'id' o 'codigo' (uno solo)")
+            if (delta is None) == (absoluto is None):
+                raise ValueError("Cada fila lleva 'delta' o 'absoluto' (uno solo)")
+            if absoluto is not None and absoluto < 0:
+                raise ValueError("'absoluto' no puede ser negativo")
+
+            if producto_id is None:
+                encontrado = obtener_por_codigo(str(resultado["codigo"]))
+                producto_id = encontrado.id if encontrado else None
+            producto = tx.obtener(producto_id) if producto_id is not None else None
+            if producto is None:
+                raise LookupError("Producto no encontrado")
+
+            resultado.update(id=producto.id, codigo=producto.codigo, nombre=producto.nombre,
+                             stock_anterior=producto.stock)
+            if absoluto is not None:
+                delta = absoluto - producto.stock
+            if delta:
+                producto = tx.ajustar_stock(producto.id, delta, version_esperada=_entero(fila, 'version'))
+            resultado.update(delta=delta, stock_nuevo=producto.stock, estado="ok" if delta else "sin_cambios")
+        except ConflictoVersion as e:
+            resultado.update(estado="error", error=f"Conflicto de versión (actual {e.version_actual})")
+        except (ValueError, LookupError) as e:
+            resultado.update(estado="error", error=str(e))
+        resultados.append(resultado)
+    return resultados
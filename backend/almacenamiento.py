@@ -0,0 +1,93 @@
+import os
+from abc import ABC, abstractmethod
+from typing import ContextManager, Dict, List, Optional
+
+from modelos import ProductoStock, Proveedor
+
+
+class RepositorioStockBase(ABC):
+    """
+    Interfaz común de almacenamiento de stock y proveedores.
+    Implementaciones: RepositorioStock (JSON + journal) y RepositorioStockSQLite (SQLite en modo WAL).
+
+    transaccion() devuelve un objeto con obtener / ajustar_stock / agregar / reemplazar y el
+    dict `cambios`; los cambios se confirman juntos al salir del bloque sin errores.
+    """
+
+    # --- Lecturas ---
+
+    @abstractmethod
+    def listar(self) -> List[ProductoStock]:
+        ...
+
+    @abstractmethod
+    def obtener(self, producto_id: int) -> Optional[ProductoStock]:
+        ...
+
+    @abstractmethod
+    def obtener_por_codigo(self, codigo: str) -> Optional[ProductoStock]:
+        ...
+
+    @abstractmethod
+    def listar_por_proveedor(self, proveedor_id: int) -> List[ProductoStock]:
+        ...
+
+    @abstractmethod
+    def buscar_por_nombre(self, nombre: str) -> List[ProductoStock]:
+        """Productos cuyo nombre normalizado coincide exactamente"""
+
+    @abstractmethod
+    def buscar_texto(self, texto: str, limite: int = 50) -> List[ProductoStock]:
+        """Productos cuyo nombre contiene todas las palabras del texto"""
+
+    @abstractmethod
+    def listar_criticos(self, limite: Optional[int] = None, proveedor_id: Optional[int] = None) -> List[ProductoStock]:
+        """Productos con stock <= stock_minimo, del más faltante al menos faltante (empates por id)"""
+
+    @abstractmethod
+    def criticos_por_proveedor(self, limite_por_proveedor: Optional[int] = None) -> Dict[int, List[ProductoStock]]:
+        """Los críticos agrupados por proveedor_id, cada grupo en el orden de listar_criticos"""
+
+    @abstractmethod
+    def listar_proveedores(self) -> List[Proveedor]:
+        ...
+
+    def revision(self):
+        """
+        Valor que cambia cada vez que cambian los productos (para invalidar caches en este proceso).
+        None si la implementación no lo sabe: quien cachea debe recalcular siempre
+        """
+        return None
+
+    # --- Escrituras ---
+
+    @abstractmethod
+    def transaccion(self) -> ContextManager:
+        ...
+
+    @abstractmethod
+    def reemplazar_todo(self, productos: List[ProductoStock]):
+        ...
+
+    def compactar(self):
+        """Mantenimiento del almacenamiento (no-op si la implementación no lo necesita)"""
+
+
+def crear_repositorio_stock(tipo: str, data_dir: str, compactar_cada: int = 1000) -> RepositorioStockBase:
+    """
+    Crea el almacenamiento configurado: 'json' (por defecto) o 'sqlite'
+    """
+    if tipo == 'sqlite':
+        from repositorio_sqlite import RepositorioStockSQLite
+        ruta_db = os.getenv("STOCKAI_SQLITE_PATH", os.path.join(data_dir, 'stockai.db'))
+        return RepositorioStockSQLite(ruta_db)
+
+    if tipo != 'json':
+        raise ValueError(f"Almacenamiento desconocido: {tipo} (usar 'json' o 'sqlite')")
+
+    from repositorio_stock import RepositorioStock
+    return RepositorioStock(
+        os.path.join(data_dir, 'stock.json'),
+        ruta_proveedores=os.path.join(data_dir, 'proveedores.json'),
+        compactar_cada=compactar_cada
+    )
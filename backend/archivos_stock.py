@@ -0,0 +1,438 @@
+"""
+Exportación e importación de stock en CSV y Excel (XLSX), por streaming.
+
+La exportación recorre la TablaStock de vista_stock por bloques, en el orden y con los filtros de
+la consulta, y escribe cada bloque apenas se arma: la memoria no crece con el tamaño del archivo.
+El XLSX se arma sin dependencias con zipfile sobre una salida que no admite seek (los tamaños de
+cada entrada van al final, en un descriptor) y con el texto inline en las celdas, sin tabla de
+strings compartidos que habría que juntar entera antes de escribir.
+
+La importación lee listas de precios de proveedores (CSV o XLSX) fila por fila desde el archivo
+subido y las aplica de a bloques, cada uno en su propia transacción del repositorio.
+"""
+import csv
+import io
+import re
+import zipfile
+from datetime import datetime
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+from ajustes_stock import SimulacionAjustes, aplicar_ajustes
+from vista_stock import CAMPOS_RESPUESTA, ConsultaStock, TablaStock
+
+# Filas por bloque escrito: los bloques de TablaStock.recorrer (hasta 65536) se parten en estos
+BLOQUE_EXPORTACION = 5000
+# Filas de una hoja de Excel, contando el encabezado
+MAX_FILAS_XLSX = 1048576
+# Filas de la lista de precios por transacción
+BLOQUE_IMPORTACION = 5000
+# Errores con detalle en el resumen de una importación (el resto solo se cuenta)
+MAX_ERRORES_DETALLE = 100
+
+TIPOS_CONTENIDO = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+# --- Exportación ---
+
+_NS_HOJA = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_NS_RELACIONES = "http://schemas.openxmlformats.org/package/2006/relationships"
+_TIPO_DOCUMENTO = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_XML = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+_PARTES_XLSX = {
+    '[Content_Types].xml': _XML + (
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': _XML + (
+        f'<Relationships xmlns="{_NS_RELACIONES}">'
+        f'<Relationship Id="rId1" Type="{_TIPO_DOCUMENTO}/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/workbook.xml': _XML + (
+        f'<workbook xmlns="{_NS_HOJA}" xmlns:r="{_TIPO_DOCUMENTO}">'
+        '<sheets><sheet name="Stock" sheetId="1" r:id="rId1"/></sheets></workbook>'
+    ),
+    'xl/_rels/workbook.xml.rels': _XML + (
+        f'<Relationships xmlns="{_NS_RELACIONES}">'
+        f'<Relationship Id="rId1" Type="{_TIPO_DOCUMENTO}/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+# Caracteres de control que XML no admite
+_INVALIDOS_XML = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+class _SalidaEnBloques(io.RawIOBase):
+    """Archivo de solo escritura y sin seek: junta lo escrito hasta que se retira con `vaciar`"""
+
+    def __init__(self):
+        super().__init__()
+        self._partes: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, datos) -> int:
+        self._partes.append(bytes(datos))
+        return len(datos)
+
+    def vaciar(self) -> bytes:
+        datos = b"".join(self._partes)
+        self._partes.clear()
+        return datos
+
+
+def _campos(consulta: ConsultaStock) -> List[str]:
+    return list(consulta.campos) if consulta.campos else CAMPOS_RESPUESTA
+
+
+def _bloques(tabla: TablaStock, consulta: ConsultaStock) -> Iterator[np.ndarray]:
+    for filas in tabla.recorrer(consulta):
+        for inicio in range(0, len(filas), BLOQUE_EXPORTACION):
+            yield filas[inicio:inicio + BLOQUE_EXPORTACION]
+
+
+def _columnas(tabla: TablaStock, filas: np.ndarray, campos: List[str]) -> List[list]:
+    return [tabla.columnas[campo][filas].tolist() for campo in campos]
+
+
+def exportar_csv(tabla: TablaStock, consulta: ConsultaStock) -> Iterator[bytes]:
+    """
+    Las filas de la consulta como CSV con encabezado, un bloque por vez. Lleva BOM para que Excel
+    reconozca el UTF-8
+    """
+    campos = _campos(consulta)
+    texto = io.StringIO()
+    escritor = csv.writer(texto)
+    texto.write('\ufeff')
+    escritor.writerow(campos)
+    for filas in _bloques(tabla, consulta):
+        escritor.writerows(zip(*_columnas(tabla, filas, campos)))
+        yield texto.getvalue().encode('utf-8')
+        texto.seek(0)
+        texto.truncate()
+    yield texto.getvalue().encode('utf-8')
+
+
+def _texto_xml(valor) -> str:
+    texto = escape(str(valor))
+    return _INVALIDOS_XML.sub('', texto) if _INVALIDOS_XML.search(texto) else texto
+
+
+def _fila_xlsx(valores: Iterable[str]) -> str:
+    return '<row>' + ''.join(f'<c t="inlineStr"><is><t>{_texto_xml(v)}</t></is></c>' for v in valores) + '</row>'
+
+
+def exportar_xlsx(tabla: TablaStock, consulta: ConsultaStock) -> Iterator[bytes]:
+    """
+    Las filas de la consulta como libro de Excel de una hoja, un bloque por vez. Los campos
+    numéricos van como números; si hay más filas de las que entran en una hoja, se cortan ahí
+    """
+    campos = _campos(consulta)
+    numericos = [tabla.columnas[campo].dtype != object for campo in campos]
+    salida = _SalidaEnBloques()
+    with zipfile.ZipFile(salida, 'w', zipfile.ZIP_DEFLATED) as libro:
+        for nombre, contenido in _PARTES_XLSX.items():
+            libro.writestr(nombre, contenido)
+        with libro.open('xl/worksheets/sheet1.xml', 'w') as hoja:
+            hoja.write((_XML + f'<worksheet xmlns="{_NS_HOJA}"><sheetData>' + _fila_xlsx(campos)).encode('utf-8'))
+            restantes = MAX_FILAS_XLSX - 1
+            for filas in _bloques(tabla, consulta):
+                if len(filas) > restantes:
+                    print(f"⚠️ Exportación XLSX cortada en {MAX_FILAS_XLSX - 1} productos (máximo de una hoja)")
+                    filas = filas[:restantes]
+                restantes -= len(filas)
+                celdas = [
+                    [f'<c><v>{v}</v></c>' for v in valores] if numerico else
+                    [f'<c t="inlineStr"><is><t>{_texto_xml(v)}</t></is></c>' for v in valores]
+                    for valores, numerico in zip(_columnas(tabla, filas, campos), numericos)
+                ]
+                hoja.write(''.join('<row>' + ''.join(fila) + '</row>' for fila in zip(*celdas)).encode('utf-8'))
+                yield salida.vaciar()
+                if not restantes:
+                    break
+            hoja.write(b'</sheetData></worksheet>')
+    yield salida.vaciar()
+
+
+# --- Importación de listas de precios ---
+
+# Nombres de columna habituales en las listas de los proveedores
+ALIAS_COLUMNAS = {
+    'código': 'codigo', 'cod': 'codigo', 'sku': 'codigo',
+    'descripcion': 'nombre', 'descripción': 'nombre', 'producto': 'nombre',
+    'precio': 'precio_base', 'precio_sin_impuestos': 'precio_base', 'costo': 'precio_base',
+    'categoría': 'categoria', 'rubro': 'categoria',
+}
+
+
+def formato_de_archivo(nombre: Optional[str], tipo_contenido: Optional[str]) -> str:
+    """xlsx o csv según la extensión o el Content-Type del archivo subido (csv si no se reconoce)"""
+    if (nombre or '').lower().endswith('.xlsx') or (tipo_contenido or '').startswith(TIPOS_CONTENIDO['xlsx']):
+        return 'xlsx'
+    return 'csv'
+
+
+def _filas_csv(ruta: str) -> Iterator[List[str]]:
+    with open(ruta, newline='', encoding='utf-8-sig') as archivo:
+        try:
+            muestra = archivo.read(4096)
+            archivo.seek(0)
+            # Muchas listas vienen de Excel en español, separadas por punto y coma
+            delimitador = ';' if muestra.count(';') > muestra.count(',') else ','
+            yield from csv.reader(archivo, delimiter=delimitador)
+        except UnicodeDecodeError:
+            raise ValueError("El CSV no está en UTF-8")
+
+
+def _indice_columna(referencia: str) -> int:
+    """Columna (desde 0) de una referencia de celda como 'AB12'"""
+    indice = 0
+    for letra in referencia:
+        if not letra.isalpha():
+            break
+        indice = indice * 26 + ord(letra.upper()) - ord('A') + 1
+    return indice - 1
+
+
+def _filas_xlsx(ruta: str) -> Iterator[List[str]]:
+    """Filas de la primera hoja, leídas de a una con iterparse (solo los strings compartidos quedan en memoria)"""
+    celda, fila, valor, texto = (f'{{{_NS_HOJA}}}{etiqueta}' for etiqueta in ('c', 'row', 'v', 't'))
+    try:
+        libro = zipfile.ZipFile(ruta)
+    except zipfile.BadZipFile:
+        raise ValueError("El archivo no es un XLSX válido")
+    with libro:
+        nombres = set(libro.namelist())
+        compartidos = []
+        if 'xl/sharedStrings.xml' in nombres:
+            with libro.open('xl/sharedStrings.xml') as archivo:
+                for _, elemento in ElementTree.iterparse(archivo):
+                    if elemento.tag == f'{{{_NS_HOJA}}}si':
+                        compartidos.append(''.join(t.text or '' for t in elemento.iter(texto)))
+                        elemento.clear()
+        hojas = sorted(n for n in nombres if n.startswith('xl/worksheets/') and n.endswith('.xml'))
+        if not hojas:
+            raise ValueError("El XLSX no tiene hojas")
+        hoja = 'xl/worksheets/sheet1.xml' if 'xl/worksheets/sheet1.xml' in nombres else hojas[0]
+        with libro.open(hoja) as archivo:
+            padre = None
+            for evento, elemento in ElementTree.iterparse(archivo, events=('start', 'end')):
+                if evento == 'start':
+                    if elemento.tag == f'{{{_NS_HOJA}}}sheetData':
+                        padre = elemento
+                    continue
+                if elemento.tag != fila:
+                    continue
+                valores = {}
+                for posicion, c in enumerate(elemento.iter(celda)):
+                    referencia = c.get('r')
+                    columna = _indice_columna(referencia) if referencia else posicion
+                    tipo = c.get('t')
+                    if tipo == 'inlineStr':
+                        valores[columna] = ''.join(t.text or '' for t in c.iter(texto))
+                    else:
+                        v = c.find(valor)
+                        contenido = v.text if v is not None and v.text else ''
+                        valores[columna] = compartidos[int(contenido)] if tipo == 's' and contenido else contenido
+                # Las filas ya leídas se sueltan, así la hoja no se acumula en memoria
+                if padre is not None:
+                    padre.clear()
+                yield [valores.get(i, '') for i in range(max(valores) + 1)] if valores else []
+
+
+def leer_lista_precios(ruta: str, formato: str) -> Iterator[Tuple[int, dict]]:
+    """
+    (número de fila, fila) de la lista de precios, con las columnas normalizadas (minúsculas y
+    ALIAS_COLUMNAS). El encabezado es la primera fila no vacía; ValueError si el archivo no se lee
+    """
+    encabezado = None
+    for numero, valores in enumerate(_filas_xlsx(ruta) if formato == 'xlsx' else _filas_csv(ruta), start=1):
+        valores = [str(v).strip() for v in valores]
+        if not any(valores):
+            continue
+        if encabezado is None:
+            encabezado = [ALIAS_COLUMNAS.get(v.lower(), v.lower()) for v in valores]
+            if 'codigo' not in encabezado and 'nombre' not in encabezado:
+                raise ValueError("La lista necesita una columna 'codigo' o 'nombre'")
+            continue
+        yield numero, {columna: valor for columna, valor in zip(encabezado, valores) if columna}
+
+
+def bloques(filas: Iterable, tamano: int = BLOQUE_IMPORTACION) -> Iterator[list]:
+    bloque = []
+    for fila in filas:
+        bloque.append(fila)
+        if len(bloque) == tamano:
+            yield bloque
+            bloque = []
+    if bloque:
+        yield bloque
+
+
+def _precio(valor: str) -> Optional[float]:
+    """Precio de la lista: acepta '$', separador de miles y coma decimal ('$ 1.234,50')"""
+    if not valor:
+        return None
+    texto = valor.replace('$', '').replace(' ', '')
+    if ',' in texto and '.' in texto:
+        texto = texto.replace('.', '').replace(',', '.') if texto.rfind(',') > texto.rfind('.') else texto.replace(',', '')
+    elif ',' in texto:
+        texto = texto.replace(',', '.')
+    try:
+        precio = float(texto)
+    except ValueError:
+        raise ValueError(f"Precio inválido: '{valor}'")
+    if precio < 0:
+        raise ValueError("El precio no puede ser negativo")
+    return round(precio, 2)
+
+
+def _cantidad(fila: dict, campo: str) -> Optional[int]:
+    valor = fila.get(campo)
+    if not valor:
+        return None
+    try:
+        numero = float(valor.replace(',', '.'))
+    except ValueError:
+        numero = None
+    if numero is None or not numero.is_integer() or numero < 0:
+        raise ValueError(f"'{campo}' debe ser un entero no negativo")
+    return int(numero)
+
+
+def aplicar_precios(tx, filas: Iterable[Tuple[int, dict]], proveedor_id: int, crear_nuevos: bool,
+                    obtener_por_codigo: Callable, buscar_por_nombre: Callable) -> List[dict]:
+    """
+    Aplica las filas de la lista sobre la transacción: el producto se busca por código o, si no
+    tiene, por nombre exacto entre los del proveedor; se actualizan precio, categoría y stock mínimo,
+    y los que no existen se crean (si `crear_nuevos`). La `cantidad` de los productos que ya
+    existían no se toca acá: queda en el resultado como entrada, para aplicarla como movimiento
+    """
+    resultados = []
+    nuevos_por_codigo = {}
+    for numero, fila in filas:
+        codigo, nombre = fila.get('codigo') or None, fila.get('nombre') or None
+        resultado = {"fila": numero, "codigo": codigo, "nombre": nombre}
+        try:
+            precio = _precio(fila.get('precio_base'))
+            cantidad = _cantidad(fila, 'cantidad')
+            stock_minimo = _cantidad(fila, 'stock_minimo')
+            if codigo is None and nombre is None:
+                raise ValueError("La fila no tiene código ni nombre")
+
+            producto = None
+            if codigo is not None:
+                producto = nuevos_por_codigo.get(codigo) or obtener_por_codigo(codigo)
+                if producto is not None and producto.proveedor_id != proveedor_id:
+                    raise ValueError(f"El código '{codigo}' pertenece a otro proveedor")
+            elif nombre is not None:
+                producto = next((p for p in buscar_por_nombre(nombre) if p.proveedor_id == proveedor_id), None)
+            if producto is not None:
+                producto = tx.obtener(producto.id)
+
+            if producto is None:
+                if not crear_nuevos:
+                    raise LookupError("Producto no encontrado")
+                if nombre is None or precio is None:
+                    raise ValueError("Para crear el producto hacen falta 'nombre' y 'precio'")
+                campos = {"codigo": codigo} if codigo else {}
+                producto = tx.agregar(nombre=nombre, stock=cantidad or 0, stock_minimo=5 if stock_minimo is None
+                                      else stock_minimo, precio_base=precio, categoria=fila.get('categoria') or "Nuevo",
+                                      proveedor_id=proveedor_id, **campos)
+                nuevos_por_codigo[producto.codigo] = producto
+                resultado.update(id=producto.id, estado="nuevo")
+            else:
+                cambios = {}
+                if precio is not None and precio != producto.precio_base:
+                    cambios['precio_base'] = precio
+                if fila.get('categoria') and fila['categoria'] != producto.categoria:
+                    cambios['categoria'] = fila['categoria']
+                if stock_minimo is not None and stock_minimo != producto.stock_minimo:
+                    cambios['stock_minimo'] = stock_minimo
+                if cambios:
+                    cambios['ultima_actualizacion'] = datetime.now().isoformat()
+                    tx.reemplazar(producto.model_copy(update=cambios))
+                resultado.update(id=producto.id, precio_anterior=producto.precio_base,
+                                 estado="actualizado" if cambios else "sin_cambios")
+                if cantidad:
+                    resultado["entrada"] = cantidad
+        except (ValueError, LookupError) as e:
+            resultado.update(estado="error", error=str(e))
+        resultados.append(resultado)
+    return resultados
+
+
+_CLAVES_RESUMEN = {"actualizado": "actualizados", "nuevo": "nuevos", "sin_cambios": "sin_cambios", "error": "errores"}
+
+
+def importar_lista_precios(repositorio, filas: Iterable[Tuple[int, dict]], proveedor_id: int,
+                           crear_nuevos: bool = True, dry_run: bool = False,
+                           al_confirmar: Callable = None) -> Tuple[dict, list]:
+    """
+    Aplica la lista de a BLOQUE_IMPORTACION filas. En cada bloque, una transacción con los precios y
+    los productos nuevos y otra con las entradas (`cantidad`) de los que ya existían, así quedan
+    como movimientos de stock. `al_confirmar(tx)` se llama después de cada transacción guardada.
+    Devuelve el resumen y los productos creados
+    """
+    resumen = {"filas": 0, "actualizados": 0, "nuevos": 0, "sin_cambios": 0, "entradas": 0, "errores": 0,
+               "bloques": 0, "detalle_errores": []}
+    creados = []
+    try:
+        for bloque in bloques(filas):
+            _importar_bloque(repositorio, bloque, proveedor_id, crear_nuevos, dry_run, al_confirmar, resumen, creados)
+    except ValueError as e:
+        # Un archivo que se rompe a mitad de camino conserva los bloques ya aplicados
+        if not resumen["bloques"]:
+            raise
+        resumen["interrumpida"] = str(e)
+    return resumen, creados
+
+
+def _importar_bloque(repositorio, bloque: list, proveedor_id: int, crear_nuevos: bool, dry_run: bool,
+                     al_confirmar: Optional[Callable], resumen: dict, creados: list):
+    try:
+        with repositorio.transaccion() as tx:
+            resultados = aplicar_precios(tx, bloque, proveedor_id, crear_nuevos,
+                                         repositorio.obtener_por_codigo, repositorio.buscar_por_nombre)
+            if dry_run:
+                raise SimulacionAjustes(resultados)
+    except SimulacionAjustes as simulacion:
+        resultados = simulacion.resultados
+    else:
+        creados += [p for p in tx.cambios.values() if p.version == 0]
+        if al_confirmar:
+            al_confirmar(tx)
+
+    entradas = [r for r in resultados if r.get("entrada")]
+    if entradas and not dry_run:
+        with repositorio.transaccion() as tx:
+            ajustes = aplicar_ajustes(tx, [{"id": r["id"], "delta": r["entrada"]} for r in entradas],
+                                      repositorio.obtener_por_codigo)
+        if al_confirmar:
+            al_confirmar(tx)
+        for resultado, ajuste in zip(entradas, ajustes):
+            if ajuste["estado"] == "error":
+                resultado.update(estado="error", error=ajuste["error"])
+
+    resumen["bloques"] += 1
+    resumen["filas"] += len(resultados)
+    resumen["entradas"] += sum(r["entrada"] for r in entradas if r["estado"] != "error")
+    for resultado in resultados:
+        resumen[_CLAVES_RESUMEN[resultado["estado"]]] += 1
+        if resultado["estado"] == "error" and len(resumen["detalle_errores"]) < MAX_ERRORES_DETALLE:
+            resumen["detalle_errores"].append(resultado)
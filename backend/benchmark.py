@@ -0,0 +1,649 @@
+"""
+Benchmarks del backend de StockAI.
+
+Uso:
+    python benchmark.py concurrencia --requests 200 --workers 4 [--almacenamiento sqlite]
+    python benchmark.py carga-ia --requests 50 --latencia 0.5
+    python benchmark.py subidas --tamano-mb 20 --concurrentes 8
+    python benchmark.py indice --productos 100000
+    python benchmark.py stock --filas 10000 100000 1000000
+    python benchmark.py movimientos --anios 3 --productos 2000 --por-dia 400
+    python benchmark.py exportacion --filas 1000000
+"""
+import argparse
+import asyncio
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _puerto_libre() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _levantar_servidor(data_dir: str, workers: int, puerto: int, almacenamiento: str = "json") -> subprocess.Popen:
+    """Levanta el backend como en producción (gunicorn + uvicorn workers) sin APIs externas"""
+    env = {**os.environ, "STOCKAI_DATA_DIR": data_dir, "STOCKAI_ALMACENAMIENTO": almacenamiento,
+           "OPENAI_API_KEY": "", "AWS_ACCESS_KEY_ID": "", "AWS_SECRET_ACCESS_KEY": ""}
+    if importlib.util.find_spec("gunicorn") and os.name != "nt":
+        cmd = [sys.executable, "-m", "gunicorn", "main:app", "-w", str(workers),
+               "-k", "uvicorn.workers.UvicornWorker", "--bind", f"127.0.0.1:{puerto}"]
+    else:
+        cmd = [sys.executable, "-m", "uvicorn", "main:app", "--workers", str(workers),
+               "--host", "127.0.0.1", "--port", str(puerto)]
+    return subprocess.Popen(cmd, cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _esperar_servidor(url: str, timeout: float = 30):
+    limite = time.time() + timeout
+    while time.time() < limite:
+        try:
+            if httpx.get(f"{url}/health", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("El servidor no respondió a /health")
+
+
+async def _disparar_puts(url: str, n_requests: int, ids: list):
+    """Cada request suma 1 unidad a cada producto existente y crea un producto nuevo"""
+    async with httpx.AsyncClient(timeout=120) as client:
+        async def un_put(i: int):
+            productos = [
+                {"nombre": f"ID {pid}", "cantidad": 1, "accion": "entrada", "producto_id": pid}
+                for pid in ids
+            ]
+            productos.append({"nombre": f"BENCH NUEVO {i}", "cantidad": 1, "accion": "entrada", "es_nuevo": True})
+            respuesta = await client.put(f"{url}/api/stock", json={"productos_actualizados": productos})
+            respuesta.raise_for_status()
+
+        await asyncio.gather(*(un_put(i) for i in range(n_requests)))
+
+
+def benchmark_concurrencia(args):
+    """
+    Dispara N PUT /api/stock en paralelo contra varios workers y verifica que los conteos finales sean exactos
+    """
+    data_dir = _copiar_datos()
+    with open(os.path.join(data_dir, "stock.json"), encoding="utf-8") as f:
+        inicial = {p["id"]: p["stock"] for p in json.load(f)}
+    if args.almacenamiento == "sqlite":
+        from repositorio_sqlite import migrar_desde_json
+        migrar_desde_json(data_dir, os.path.join(data_dir, "stockai.db"))
+
+    puerto = _puerto_libre()
+    url = f"http://127.0.0.1:{puerto}"
+    servidor = _levantar_servidor(data_dir, args.workers, puerto, args.almacenamiento)
+    try:
+        _esperar_servidor(url)
+        inicio = time.perf_counter()
+        asyncio.run(_disparar_puts(url, args.requests, list(inicial)))
+        duracion = time.perf_counter() - inicio
+
+        stock = httpx.get(f"{url}/api/stock", timeout=60).json()["stock"]
+    finally:
+        servidor.terminate()
+        servidor.wait()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    finales = {p["id"]: p["stock"] for p in stock}
+    errores = [
+        f"ID {pid}: esperado {inicial[pid] + args.requests}, obtenido {finales.get(pid)}"
+        for pid in inicial if finales.get(pid) != inicial[pid] + args.requests
+    ]
+    nuevos = [p for p in stock if p["nombre"].startswith("BENCH NUEVO")]
+    ids_nuevos = [p["id"] for p in nuevos]
+    if len(nuevos) != args.requests:
+        errores.append(f"Productos nuevos: esperados {args.requests}, obtenidos {len(nuevos)}")
+    if len(set(ids_nuevos)) != len(ids_nuevos) or len({p["id"] for p in stock}) != len(stock):
+        errores.append("Hay IDs de producto duplicados")
+
+    print(f"{args.requests} PUT en paralelo con {args.workers} workers ({args.almacenamiento}): {duracion:.2f}s "
+          f"({args.requests / duracion:.1f} req/s)")
+    if errores:
+        print("❌ Conteos incorrectos:")
+        for error in errores:
+            print(f"  - {error}")
+        sys.exit(1)
+    print(f"✅ Conteos exactos en {len(inicial)} productos y {len(nuevos)} altas con IDs únicos")
+
+
+def _importar_backend(data_dir: str):
+    """Importa main.py apuntando a un directorio de datos temporal y sin APIs externas"""
+    os.environ.update({"STOCKAI_DATA_DIR": data_dir, "OPENAI_API_KEY": "", "CACHE_RESULTADOS": "0",
+                       "AWS_ACCESS_KEY_ID": "", "AWS_SECRET_ACCESS_KEY": ""})
+    sys.path.insert(0, BACKEND_DIR)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main as backend
+    return backend
+
+
+def _copiar_datos() -> str:
+    data_dir = tempfile.mkdtemp(prefix="stockai_bench_")
+    shutil.copy(os.path.join(BACKEND_DIR, "data", "stock.json"), data_dir)
+    shutil.copy(os.path.join(BACKEND_DIR, "data", "proveedores.json"), data_dir)
+    return data_dir
+
+
+class _Medidor:
+    """Cuenta cuántas llamadas simuladas hubo en total y en vuelo al mismo tiempo"""
+
+    def __init__(self):
+        self.total = 0
+        self.en_vuelo = 0
+        self.maximo = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def llamada(self):
+        with self._lock:
+            self.total += 1
+            self.en_vuelo += 1
+            self.maximo = max(self.maximo, self.en_vuelo)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.en_vuelo -= 1
+
+
+class TextractSimulado:
+    """Cliente boto3 de Textract simulado: bloquea el hilo como el real"""
+
+    def __init__(self, latencia: float, medidor: _Medidor):
+        self.latencia = latencia
+        self.medidor = medidor
+
+    def detect_document_text(self, Document):
+        with self.medidor.llamada():
+            time.sleep(self.latencia)
+        # La segunda línea la resuelve el parser; la tercera no tiene un formato conocido y va al LLM
+        lineas = ["HIF HIH Distribuciones", "300063098 TWISTOS MINIT JAMON 95GX30X1 2.00 Unidades $1849.96",
+                  "300063300 TWISTOS SURTIDO CAJA MIXTA 2 Bultos $3500"]
+        return {"Blocks": [{"BlockType": "LINE", "Text": linea} for linea in lineas]}
+
+
+class OpenAISimulado:
+    """
+    Cliente de OpenAI simulado. Con bloqueante=True imita al cliente síncrono
+    (duerme el hilo del event loop); si no, espera con asyncio como AsyncOpenAI
+    """
+
+    def __init__(self, latencia: float, medidor: _Medidor, bloqueante: bool):
+        self.latencia = latencia
+        self.medidor = medidor
+        self.bloqueante = bloqueante
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._crear))
+
+    async def _crear(self, **kwargs):
+        with self.medidor.llamada():
+            if self.bloqueante:
+                time.sleep(self.latencia)
+            else:
+                await asyncio.sleep(self.latencia)
+        productos = [
+            {"nombre": "TWISTOS MINIT JAMON 95G", "cantidad": 2, "precio_sin_impuestos": 924.98, "confianza": 95}
+        ]
+        # Pedidos agrupados: los textos llegan marcados con [id N] y se responde por cada uno
+        ids = re.findall(r'^\[id (\d+)\]$', kwargs["messages"][-1]["content"], re.MULTILINE)
+        if ids:
+            contenido = json.dumps({"textos": [{"id": int(i), "productos": productos} for i in ids]})
+        else:
+            contenido = json.dumps({"productos": productos})
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=contenido))],
+            usage=SimpleNamespace(prompt_tokens=0, completion_tokens=0)
+        )
+
+
+async def _disparar_facturas(app, n_requests: int) -> float:
+    transporte = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transporte, base_url="http://bench", timeout=600) as client:
+        async def una_factura(i: int):
+            archivos = {"file": (f"factura_{i}.png", f"imagen {i}".encode(), "image/png")}
+            respuesta = await client.post("/process-invoice", files=archivos)
+            respuesta.raise_for_status()
+
+        inicio = time.perf_counter()
+        await asyncio.gather(*(una_factura(i) for i in range(n_requests)))
+        return time.perf_counter() - inicio
+
+
+def benchmark_carga_ia(args):
+    """
+    Dispara N facturas concurrentes contra un solo worker con Textract y OpenAI simulados,
+    comparando el cliente bloqueante (como antes) con AsyncOpenAI + pool de Textract,
+    sin y con agrupación de pedidos al LLM
+    """
+    data_dir = _copiar_datos()
+    try:
+        backend = _importar_backend(data_dir)
+        llamada_directa = backend.ejecutar_en_pool_textract
+        # Los servicios simulados no tienen cuota: se mide la concurrencia, no el límite de tasa
+        backend.TEXTRACT_LIMITE_TPS = backend.OPENAI_LIMITE_RPM = backend.OPENAI_LIMITE_TPM = 1e9
+
+        async def textract_en_el_loop(funcion, *a, **kw):
+            return funcion(*a, **kw)
+
+        ventana = backend.agrupador_extraccion.ventana
+        for modo in ("bloqueante", "async", "agrupado"):
+            medidor_ocr, medidor_llm = _Medidor(), _Medidor()
+            backend.agrupador_extraccion.ventana = ventana if modo == "agrupado" else 0
+            backend.textract_client = TextractSimulado(args.latencia, medidor_ocr)
+            backend.openai_client = OpenAISimulado(args.latencia, medidor_llm, bloqueante=(modo == "bloqueante"))
+            backend.ejecutar_en_pool_textract = textract_en_el_loop if modo == "bloqueante" else llamada_directa
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                duracion = asyncio.run(_disparar_facturas(backend.app, args.requests))
+            print(f"{modo:>10}: {args.requests} facturas en {duracion:.2f}s "
+                  f"({args.requests / duracion:.1f} facturas/s) | máx. en vuelo: "
+                  f"Textract {medidor_ocr.maximo}, OpenAI {medidor_llm.maximo} | "
+                  f"requests a OpenAI: {medidor_llm.total}")
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+async def _leer_upload_completo(file, max_bytes: int, suffix: str = "", directorio: str = None) -> str:
+    """Comportamiento anterior de las subidas: todo el archivo en memoria y después a disco"""
+    contenido = await file.read()
+    if len(contenido) > max_bytes:
+        raise RuntimeError("Archivo muy grande")
+    fd, ruta = tempfile.mkstemp(suffix=suffix, dir=directorio)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(contenido)
+    return ruta
+
+
+def _servir_subidas(puerto: int, modo: str):
+    """
+    Corre en el subproceso del benchmark de subidas: backend con Whisper y chat simulados.
+    Con modo='memoria' restaura la lectura completa del archivo para comparar
+    """
+    import uvicorn
+    backend = _importar_backend(os.environ["STOCKAI_DATA_DIR"])
+
+    async def transcribir(file, **kwargs):
+        # Como el SDK de OpenAI con un archivo abierto: lo envía por bloques
+        while file.read(1024 * 1024):
+            pass
+        return SimpleNamespace(text="llegaron 10 twistos minit jamon")
+
+    cliente = OpenAISimulado(0, _Medidor(), bloqueante=False)
+    cliente.audio = SimpleNamespace(transcriptions=SimpleNamespace(create=transcribir))
+    backend.openai_client = cliente
+    if modo == "memoria":
+        backend.guardar_upload_en_disco = _leer_upload_completo
+    uvicorn.run(backend.app, host="127.0.0.1", port=puerto, log_level="warning")
+
+
+def _memoria_proceso(pid: int) -> dict:
+    """VmRSS y VmHWM (pico) del proceso en MB, leídos de /proc (solo Linux)"""
+    memoria = {}
+    with open(f"/proc/{pid}/status") as f:
+        for linea in f:
+            clave, _, valor = linea.partition(":")
+            if clave in ("VmRSS", "VmHWM"):
+                memoria[clave] = int(valor.split()[0]) / 1024
+    return memoria
+
+
+async def _disparar_subidas(url: str, ruta_audio: str, concurrentes: int):
+    async with httpx.AsyncClient(timeout=300) as client:
+        async def una_subida():
+            with open(ruta_audio, "rb") as audio:
+                respuesta = await client.post(f"{url}/process-audio",
+                                              files={"file": ("audio.mp3", audio, "audio/mpeg")})
+            respuesta.raise_for_status()
+
+        await asyncio.gather(*(una_subida() for _ in range(concurrentes)))
+
+
+def benchmark_subidas(args):
+    """
+    Mide el pico de RSS del servidor con N subidas de audio concurrentes, comparando la lectura
+    completa del archivo en memoria (como antes) con la copia a disco por bloques
+    """
+    if not os.path.exists("/proc/self/status"):
+        print("Este benchmark lee la memoria de /proc y solo funciona en Linux")
+        sys.exit(1)
+
+    fd, ruta_audio = tempfile.mkstemp(suffix=".mp3")
+    with os.fdopen(fd, "wb") as f:
+        for _ in range(args.tamano_mb):
+            f.write(os.urandom(1024 * 1024))
+
+    try:
+        for modo in ("memoria", "bloques"):
+            data_dir = _copiar_datos()
+            puerto = _puerto_libre()
+            url = f"http://127.0.0.1:{puerto}"
+            env = {**os.environ, "STOCKAI_DATA_DIR": data_dir}
+            servidor = subprocess.Popen(
+                [sys.executable, "-c", f"import benchmark; benchmark._servir_subidas({puerto}, {modo!r})"],
+                cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            try:
+                _esperar_servidor(url)
+                base = _memoria_proceso(servidor.pid)["VmRSS"]
+                inicio = time.perf_counter()
+                asyncio.run(_disparar_subidas(url, ruta_audio, args.concurrentes))
+                duracion = time.perf_counter() - inicio
+                pico = _memoria_proceso(servidor.pid)["VmHWM"]
+            finally:
+                servidor.terminate()
+                servidor.wait()
+                shutil.rmtree(data_dir, ignore_errors=True)
+
+            print(f"{modo:>8}: {args.concurrentes} subidas de {args.tamano_mb}MB en {duracion:.2f}s | "
+                  f"RSS base {base:.0f}MB, pico {pico:.0f}MB "
+                  f"(+{(pico - base) / args.concurrentes:.1f}MB por subida concurrente)")
+    finally:
+        os.unlink(ruta_audio)
+
+
+_MARCAS = ["TWISTOS", "SMIRNOFF", "COCA COLA", "SPRITE", "FANTA", "QUILMES", "SER", "MATARAZZO",
+           "LA SERENISIMA", "ARCOR", "BAGLEY", "TERRABUSI", "PEPSI", "LAYS", "KNORR", "MAROLIO"]
+_PRODUCTOS = ["MINIT", "LATA", "ZERO", "LIGHT", "CLASICA", "YOGUR", "GALLETITAS", "PAPAS", "SOPA",
+              "FIDEOS", "LECHE", "AGUA", "JUGO", "ALFAJOR", "CHOCOLATE", "TOSTADAS"]
+_VARIANTES = ["JAMON", "QUESO", "FRUTILLA", "LIMA", "NARANJA", "POMELO", "VAINILLA", "DULCE DE LECHE",
+              "CLASICO", "INTEGRAL", "PICANTE", "LIMON", "DURAZNO", "MANZANA", "CEBOLLA", "OLIVA"]
+_TAMANOS = ["40G", "95G", "150G", "250G", "500G", "1KG", "200ML", "350ML", "500ML", "1L", "1.5L", "2L"]
+
+
+def _nombre_sintetico(i: int) -> str:
+    """Nombre de producto distinto para cada i (marca, producto, variante, tamaño y un código)"""
+    partes = [_MARCAS[i % 16], _PRODUCTOS[i // 16 % 16], _VARIANTES[i // 256 % 16], _TAMANOS[i // 4096 % 12]]
+    return " ".join(partes) + f" L{i // 49152}"
+
+
+def _con_ruido(nombre: str, i: int) -> str:
+    """Nombre como llega de una factura: sin el código y con un error de OCR"""
+    nombre = nombre.rsplit(" ", 1)[0]
+    posicion = 3 + i % max(1, len(nombre) - 3)
+    return nombre[:posicion] + nombre[posicion].lower() + nombre[posicion + 1:] if i % 2 else nombre.replace("O", "0", 1)
+
+
+def benchmark_indice(args):
+    """
+    Índice semántico a escala de catálogo: construcción, guardado, arranque con mmap y latencia
+    de búsqueda top-k; y resolver() del matcher con y sin el índice acotando los candidatos
+    """
+    import statistics
+    sys.path.insert(0, BACKEND_DIR)
+    from indice_semantico import IndiceSemantico
+    from matcher_productos import MatcherProductos
+
+    productos = [{"id": i + 1, "nombre": _nombre_sintetico(i)} for i in range(args.productos)]
+    consultas = [_con_ruido(productos[(i * 7919) % len(productos)]["nombre"], i) for i in range(args.consultas)]
+    directorio = tempfile.mkdtemp(prefix="stockai_indice_")
+    try:
+        indice = IndiceSemantico(directorio)
+        inicio = time.perf_counter()
+        indice.sincronizar(productos)
+        construccion = time.perf_counter() - inicio
+        with contextlib.redirect_stdout(io.StringIO()):
+            inicio = time.perf_counter()
+            indice.guardar()
+            guardado = time.perf_counter() - inicio
+            inicio = time.perf_counter()
+            indice = IndiceSemantico(directorio)
+            indice.sincronizar(productos)
+            arranque = time.perf_counter() - inicio
+        print(f"{len(productos)} productos | construcción {construccion:.2f}s | guardado {guardado:.2f}s | "
+              f"arranque con mmap + sincronización {arranque:.2f}s")
+
+        latencias = []
+        for consulta in consultas:
+            inicio = time.perf_counter()
+            indice.buscar(consulta, args.k)
+            latencias.append((time.perf_counter() - inicio) * 1000)
+        latencias.sort()
+        print(f"buscar top-{args.k}: p50 {statistics.median(latencias):.2f}ms | "
+              f"p95 {latencias[int(len(latencias) * 0.95)]:.2f}ms")
+
+        for nombre, matcher in (("matcher sin índice", MatcherProductos()), ("matcher con índice", MatcherProductos(indice))):
+            matcher.sincronizar(productos)
+            inicio = time.perf_counter()
+            for consulta in consultas:
+                matcher.resolver(consulta)
+            print(f"{nombre}: resolver {(time.perf_counter() - inicio) * 1000 / len(consultas):.2f}ms por nombre")
+    finally:
+        shutil.rmtree(directorio, ignore_errors=True)
+
+
+def benchmark_stock(args):
+    """
+    GET /api/stock: enriquecimiento fila por fila con model_dump + JSONResponse (la implementación
+    anterior) contra la vista columnar, recién construida y cacheada
+    """
+    sys.path.insert(0, BACKEND_DIR)
+    from fastapi.responses import JSONResponse
+    from modelos import ProductoStock, Proveedor
+    from vista_stock import ConsultaStock, VistaStock
+
+    proveedores = [Proveedor(id=i + 1, nombre=f"Proveedor {i + 1}", impuesto=(21, 10.5, 27)[i % 3], telefono="")
+                   for i in range(args.proveedores)]
+
+    def anterior(stock):
+        stock_enriquecido = []
+        for producto in stock:
+            proveedor = next((p for p in proveedores if p.id == producto.proveedor_id), None)
+            impuesto = proveedor.impuesto if proveedor else 21
+            producto_dict = producto.model_dump()
+            producto_dict['precio_con_impuestos'] = round(producto.precio_base * (1 + impuesto / 100), 2)
+            producto_dict['proveedor_nombre'] = proveedor.nombre if proveedor else "Desconocido"
+            stock_enriquecido.append(producto_dict)
+        return JSONResponse({"stock": stock_enriquecido, "success": True}).body
+
+    for filas in args.filas:
+        stock = [ProductoStock(id=i + 1, nombre=_nombre_sintetico(i), stock=i % 50, stock_minimo=10,
+                               precio_base=100 + i % 900 * 1.37, categoria="Almacén", codigo=f"P{i + 1:07d}",
+                               # Algunos con proveedor inexistente
+                               proveedor_id=i % (args.proveedores + 1) + 1,
+                               ultima_actualizacion="2024-01-01T00:00:00")
+                 for i in range(filas)]
+        repositorio = SimpleNamespace(listar=lambda: stock, listar_proveedores=lambda: proveedores, revision=lambda: 1)
+
+        inicio = time.perf_counter()
+        cuerpo_anterior = anterior(stock)
+        t_anterior = time.perf_counter() - inicio
+
+        vista = VistaStock(repositorio)
+        inicio = time.perf_counter()
+        cuerpo = vista.json_completo()
+        t_columnar = time.perf_counter() - inicio
+        inicio = time.perf_counter()
+        vista.json_completo()
+        t_cacheado = time.perf_counter() - inicio
+
+        iguales = json.loads(cuerpo) == json.loads(cuerpo_anterior)
+        print(f"{filas:>9} filas | anterior {t_anterior * 1000:9.1f}ms | columnar {t_columnar * 1000:8.1f}ms "
+              f"({t_anterior / t_columnar:4.1f}x) | cacheado {t_cacheado * 1000:6.2f}ms | "
+              f"{len(cuerpo) / 1e6:.1f} MB | mismo JSON: {'sí' if iguales else 'NO'}")
+
+        # Página de 100 críticos por precio descendente: la primera vez incluye ordenar la tabla
+        tabla = vista.tabla()
+        consulta = ConsultaStock(criticos=True, orden="-precio_con_impuestos", campos=("id", "nombre", "stock"))
+        tiempos, cursor = [], None
+        for _ in range(3):
+            inicio = time.perf_counter()
+            productos, cursor = tabla.pagina(consulta, 100, cursor)
+            tiempos.append((time.perf_counter() - inicio) * 1000)
+        inicio = time.perf_counter()
+        next(tabla.ndjson(ConsultaStock(buscar="zero"), None))
+        primer_bloque = (time.perf_counter() - inicio) * 1000
+        print(f"{'':>9}       | página de 100: {tiempos[0]:.1f}ms (ordenando) / {tiempos[1]:.2f}ms / "
+              f"{tiempos[2]:.2f}ms | primer bloque NDJSON con búsqueda {primer_bloque:.1f}ms")
+
+
+def benchmark_movimientos(args):
+    """
+    Historial de movimientos: carga años de movimientos sintéticos (un registrar por día) y mide
+    los reportes, que leen solo los agregados
+    """
+    import random
+    import statistics
+    from datetime import date, datetime, timedelta
+    sys.path.insert(0, BACKEND_DIR)
+    from historial_movimientos import HistorialMovimientos
+
+    directorio = tempfile.mkdtemp(prefix="stockai_movimientos_")
+    try:
+        historial = HistorialMovimientos(os.path.join(directorio, "movimientos.db"))
+        azar = random.Random(42)
+        hoy = date.today()
+        inicio_historia = hoy - timedelta(days=365 * args.anios)
+        total = 0
+        inicio = time.perf_counter()
+        for dia in range(365 * args.anios + 1):
+            base = datetime.combine(inicio_historia + timedelta(days=dia), datetime.min.time())
+            movimientos = []
+            for _ in range(args.por_dia):
+                producto_id = min(int(azar.paretovariate(1.2)), args.productos)
+                movimientos.append({
+                    "producto_id": producto_id, "proveedor_id": producto_id % 20 + 1,
+                    "delta": azar.choice((-1, -1, -2, -3, 12, 24)),
+                    "ts": base + timedelta(seconds=azar.randrange(86400)),
+                })
+            total += historial.registrar(movimientos)
+        carga = time.perf_counter() - inicio
+        tamano = os.path.getsize(os.path.join(directorio, "movimientos.db")) / 1e6
+        print(f"{total} movimientos en {args.anios} años | carga {carga:.1f}s ({total / carga:.0f} movimientos/s) | "
+              f"{tamano:.0f} MB")
+
+        def medir(nombre, funcion, repeticiones=20):
+            tiempos = []
+            for _ in range(repeticiones):
+                inicio = time.perf_counter()
+                funcion()
+                tiempos.append((time.perf_counter() - inicio) * 1000)
+            print(f"{nombre:<48} p50 {statistics.median(tiempos):7.2f}ms")
+
+        medir("serie diaria total, 1 año", lambda: historial.serie(
+            "dia", (hoy - timedelta(days=365)).isoformat(), hoy.isoformat()))
+        medir("serie mensual de un producto, todo el historial", lambda: historial.serie(
+            "mes", inicio_historia.strftime("%Y-%m"), "9999", producto_id=1))
+        medir("serie diaria de un proveedor, 90 días", lambda: historial.serie(
+            "dia", (hoy - timedelta(days=90)).isoformat(), hoy.isoformat(), proveedor_id=2))
+        for dias in (30, 365, 365 * args.anios):
+            medir(f"velocidad por producto, {dias} días", lambda: historial.totales_por_producto(
+                hoy - timedelta(days=dias - 1), hoy + timedelta(days=1)))
+
+        from pronostico_demanda import PronosticoDemanda
+        pronostico = PronosticoDemanda(historial)
+        inicio = time.perf_counter()
+        pronostico.actualizar()
+        completo = (time.perf_counter() - inicio) * 1000
+        historial.registrar([{"producto_id": azar.randrange(1, args.productos + 1), "delta": -1} for _ in range(100)])
+        inicio = time.perf_counter()
+        pronostico.actualizar()
+        incremental = (time.perf_counter() - inicio) * 1000
+        print(f"pronóstico de {len(pronostico.puntos_de_pedido())} productos: completo {completo:.1f}ms | "
+              f"incremental con 100 movimientos nuevos {incremental:.1f}ms")
+    finally:
+        shutil.rmtree(directorio, ignore_errors=True)
+
+
+def benchmark_exportacion(args):
+    """
+    Exportación del stock a CSV y XLSX por streaming: tiempo, tamaño y pico de memoria de Python
+    mientras se genera el archivo (aparte de la tabla de la vista, que ya está en memoria)
+    """
+    import tracemalloc
+    sys.path.insert(0, BACKEND_DIR)
+    from archivos_stock import exportar_csv, exportar_xlsx
+    from modelos import ProductoStock, Proveedor
+    from vista_stock import ConsultaStock, TablaStock
+
+    proveedores = [Proveedor(id=i + 1, nombre=f"Proveedor {i + 1}", impuesto=(21, 10.5, 27)[i % 3], telefono="")
+                   for i in range(50)]
+    # La lista de productos solo vive mientras se arma la tabla: la exportación se mide sin ella
+    tabla = TablaStock([ProductoStock(id=i + 1, nombre=_nombre_sintetico(i), stock=i % 50, stock_minimo=10,
+                                      precio_base=100 + i % 900 * 1.37, categoria="Almacén", codigo=f"P{i + 1:07d}",
+                                      proveedor_id=i % 50 + 1, ultima_actualizacion="2024-01-01T00:00:00")
+                        for i in range(args.filas)], proveedores)
+
+    tabla.pagina(ConsultaStock(), 1)  # el orden por id se calcula una vez por tabla, no en cada exportación
+    for nombre, exportar in (("csv", exportar_csv), ("xlsx", exportar_xlsx)):
+        inicio = time.perf_counter()
+        tamano, bloques, mayor = 0, 0, 0
+        for bloque in exportar(tabla, ConsultaStock()):
+            tamano += len(bloque)
+            bloques += 1
+            mayor = max(mayor, len(bloque))
+        duracion = time.perf_counter() - inicio
+        # Segunda pasada solo para medir memoria (tracemalloc hace más lenta la generación)
+        tracemalloc.start()
+        for _ in exportar(tabla, ConsultaStock()):
+            pass
+        _, pico = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{nombre:>4} | {args.filas} filas en {duracion:.1f}s ({args.filas / duracion:.0f} filas/s) | "
+              f"{tamano / 1e6:.0f} MB en {bloques} bloques (mayor {mayor / 1e6:.1f} MB) | "
+              f"pico de memoria {pico / 1e6:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks del backend de StockAI")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    concurrencia = subparsers.add_parser("concurrencia", help="PUT /api/stock concurrentes entre workers")
+    concurrencia.add_argument("--requests", type=int, default=200)
+    concurrencia.add_argument("--workers", type=int, default=4)
+    concurrencia.add_argument("--almacenamiento", choices=["json", "sqlite"], default="json")
+    concurrencia.set_defaults(func=benchmark_concurrencia)
+
+    carga_ia = subparsers.add_parser("carga-ia", help="Facturas concurrentes con Textract/OpenAI simulados")
+    carga_ia.add_argument("--requests", type=int, default=50)
+    carga_ia.add_argument("--latencia", type=float, default=0.5, help="Segundos por llamada simulada")
+    carga_ia.set_defaults(func=benchmark_carga_ia)
+
+    subidas = subparsers.add_parser("subidas", help="Pico de memoria con subidas de audio concurrentes")
+    subidas.add_argument("--tamano-mb", type=int, default=20)
+    subidas.add_argument("--concurrentes", type=int, default=8)
+    subidas.set_defaults(func=benchmark_subidas)
+
+    indice = subparsers.add_parser("indice", help="Índice semántico de productos a escala de catálogo")
+    indice.add_argument("--productos", type=int, default=100000)
+    indice.add_argument("--consultas", type=int, default=200)
+    indice.add_argument("-k", type=int, default=10)
+    indice.set_defaults(func=benchmark_indice)
+
+    stock = subparsers.add_parser("stock", help="GET /api/stock: enriquecimiento y serialización del catálogo")
+    stock.add_argument("--filas", type=int, nargs="+", default=[10000, 100000, 1000000])
+    stock.add_argument("--proveedores", type=int, default=50)
+    stock.set_defaults(func=benchmark_stock)
+
+    movimientos = subparsers.add_parser("movimientos", help="Historial de movimientos y reportes agregados")
+    movimientos.add_argument("--anios", type=int, default=3)
+    movimientos.add_argument("--productos", type=int, default=2000)
+    movimientos.add_argument("--por-dia", type=int, default=400)
+    movimientos.set_defaults(func=benchmark_movimientos)
+
+    exportacion = subparsers.add_parser("exportacion", help="Exportación del stock a CSV y XLSX por streaming")
+    exportacion.add_argument("--filas", type=int, default=1000000)
+    exportacion.set_defaults(func=benchmark_exportacion)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
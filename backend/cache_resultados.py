@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+
+_SIN_VALOR = object()
+
+
+def clave_hash(*partes: Any) -> str:
+    """
+    Clave de contenido: sha256 de las partes (bytes tal cual, el resto serializado como JSON ordenado)
+    """
+    h = hashlib.sha256()
+    for parte in partes:
+        if isinstance(parte, (bytes, bytearray, memoryview)):
+            h.update(bytes(parte))
+        else:
+            h.update(json.dumps(parte, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8'))
+        h.update(b'\x00')
+    return h.hexdigest()
+
+
+class CacheResultados:
+    """
+    Cache de resultados por contenido con dos niveles:
+    - memoria: LRU acotada por cantidad de entradas
+    - disco: un archivo JSON por clave, compartido entre workers, acotado por tamaño total
+    Ambos niveles respetan el TTL. Los valores deben ser serializables a JSON.
+    """
+
+    def __init__(self, nombre: str, directorio: str, max_entradas_memoria: int = 256,
+                 max_bytes_disco: int = 200 * 1024 * 1024, ttl_segundos: float = 7 * 24 * 3600):
+        self.nombre = nombre
+        self.directorio = os.path.join(directorio, nombre)
+        self.max_entradas_memoria = max_entradas_memoria
+        self.max_bytes_disco = max_bytes_disco
+        self.ttl_segundos = ttl_segundos
+        self._memoria: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits_memoria = 0
+        self.hits_disco = 0
+        self.misses = 0
+        self.evicciones = 0
+        os.makedirs(self.directorio, exist_ok=True)
+        self._bytes_disco = sum(
+            os.path.getsize(os.path.join(self.directorio, archivo))
+            for archivo in os.listdir(self.directorio) if archivo.endswith('.json')
+        )
+
+    def _ruta(self, clave: str) -> str:
+        return os.path.join(self.directorio, f"{clave}.json")
+
+    def _vencido(self, creado: float) -> bool:
+        return time.time() - creado > self.ttl_segundos
+
+    def obtener(self, clave: str, por_defecto: Any = None) -> Any:
+        with self._lock:
+            entrada = self._memoria.get(clave)
+            if entrada is not None:
+                creado, valor = entrada
+                if not self._vencido(creado):
+                    self._memoria.move_to_end(clave)
+                    self.hits_memoria += 1
+                    return valor
+                del self._memoria[clave]
+
+        valor = self._leer_disco(clave)
+        with self._lock:
+            if valor is _SIN_VALOR:
+                self.misses += 1
+                return por_defecto
+            self.hits_disco += 1
+            return valor
+
+    def _leer_disco(self, clave: str) -> Any:
+        ruta = self._ruta(clave)
+        try:
+            with open(ruta, 'r', encoding='utf-8') as f:
+                entrada = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return _SIN_VALOR
+
+        if self._vencido(entrada['creado']):
+            self._borrar_disco(ruta)
+            return _SIN_VALOR
+
+        with self._lock:
+            self._guardar_memoria(clave, entrada['creado'], entrada['valor'])
+        return entrada['valor']
+
+    def guardar(self, clave: str, valor: Any):
+        creado = time.time()
+        with self._lock:
+            self._guardar_memoria(clave, creado, valor)
+
+        contenido = json.dumps({'creado': creado, 'valor': valor}, ensure_ascii=False)
+        ruta = self._ruta(clave)
+        fd, ruta_tmp = tempfile.mkstemp(dir=self.directorio, prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(contenido)
+            # Si la clave ya estaba en disco, el archivo reemplazado deja de contar
+            try:
+                tamano_anterior = os.path.getsize(ruta)
+            except FileNotFoundError:
+                tamano_anterior = 0
+            os.replace(ruta_tmp, ruta)
+        except OSError as e:
+            print(f"No se pudo guardar en cache {self.nombre}: {e}")
+            if os.path.exists(ruta_tmp):
+                os.unlink(ruta_tmp)
+            return
+
+        with self._lock:
+            self._bytes_disco += len(contenido.encode('utf-8')) - tamano_anterior
+            excedido = self._bytes_disco > self.max_bytes_disco
+        if excedido:
+            self._recortar_disco()
+
+    def _guardar_memoria(self, clave: str, creado: float, valor: Any):
+        self._memoria[clave] = (creado, valor)
+        self._memoria.move_to_end(clave)
+        while len(self._memoria) > self.max_entradas_memoria:
+            self._memoria.popitem(last=False)
+            self.evicciones += 1
+
+    def _borrar_disco(self, ruta: str):
+        try:
+            tamano = os.path.getsize(ruta)
+            os.unlink(ruta)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._bytes_disco -= tamano
+            self.evicciones += 1
+
+    def _recortar_disco(self):
+        """Borra las entradas más viejas hasta quedar en el 90% del tamaño máximo"""
+        archivos = []
+        for archivo in os.listdir(self.directorio):
+            if archivo.endswith('.json'):
+                ruta = os.path.join(self.directorio, archivo)
+                try:
+                    stat = os.stat(ruta)
+                except FileNotFoundError:
+                    continue
+                archivos.append((stat.st_mtime, stat.st_size, ruta))
+
+        total = sum(tamano for _, tamano, _ in archivos)
+        with self._lock:
+            self._bytes_disco = total
+        objetivo = self.max_bytes_disco * 0.9
+        for _, tamano, ruta in sorted(archivos):
+            if total <= objetivo:
+                break
+            self._borrar_disco(ruta)
+            total -= tamano
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            consultas = self.hits_memoria + self.hits_disco + self.misses
+            return {
+                "hits_memoria": self.hits_memoria,
+                "hits_disco": self.hits_disco,
+                "misses": self.misses,
+                "tasa_hits": round((self.hits_memoria + self.hits_disco) / consultas, 3) if consultas else 0,
+                "evicciones": self.evicciones,
+                "entradas_memoria": len(self._memoria),
+                "bytes_disco": self._bytes_disco,
+            }
@@ -0,0 +1,287 @@
+"""
+Capa común para las llamadas salientes a OpenAI y Textract. Cada servicio (modelo o endpoint) tiene
+su cliente con:
+- límite de tasa con token bucket (requests y, opcionalmente, tokens por llamada)
+- reintentos de los errores transitorios (429, 5xx, timeouts, throttling) con backoff exponencial y jitter
+- circuit breaker: después de varias fallas seguidas deja de llamar por un rato
+- latencia y errores por servicio
+
+Si el servicio no está disponible se lanza ServicioDegradado: quien llama responde "degradado"
+(503 con Retry-After, o reintenta más tarde) en lugar de inventar un resultado.
+"""
+import asyncio
+import email.utils
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+import openai
+from botocore.exceptions import ClientError, ConnectionError as ErrorConexionBoto, HTTPClientError
+
+T = TypeVar('T')
+
+# Códigos de error de AWS que indican sobrecarga o una falla del servicio, no del pedido
+ERRORES_AWS_TRANSITORIOS = {
+    "ThrottlingException", "ProvisionedThroughputExceededException", "LimitExceededException",
+    "InternalServerError", "ServiceUnavailable", "ServiceUnavailableException", "RequestTimeout",
+}
+
+
+class ServicioDegradado(Exception):
+    """El servicio externo no está disponible: circuito abierto, límite de tasa o errores transitorios seguidos"""
+
+    def __init__(self, servicio: str, motivo: str, reintentar_en: float = None):
+        super().__init__(f"{servicio} no disponible: {motivo}")
+        self.servicio = servicio
+        self.motivo = motivo
+        self.reintentar_en = reintentar_en
+
+
+def error_transitorio_openai(error: Exception) -> bool:
+    if isinstance(error, openai.RateLimitError):
+        # Sin crédito no se arregla esperando
+        return getattr(error, 'code', None) != 'insufficient_quota'
+    if isinstance(error, openai.APIConnectionError):  # incluye timeouts
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409) or error.status_code >= 500
+    return False
+
+
+def error_transitorio_aws(error: Exception) -> bool:
+    if isinstance(error, ClientError):
+        codigo = error.response.get('Error', {}).get('Code')
+        estado = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        return codigo in ERRORES_AWS_TRANSITORIOS or estado >= 500
+    return isinstance(error, (ErrorConexionBoto, HTTPClientError))
+
+
+def espera_sugerida(error: Exception) -> Optional[float]:
+    """Segundos de Retry-After (o retry-after-ms) de la respuesta del error, si los trae"""
+    respuesta = getattr(error, 'response', None)
+    encabezados = getattr(respuesta, 'headers', None)
+    if not encabezados:
+        return None
+    if encabezados.get('retry-after-ms'):
+        try:
+            return float(encabezados['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    valor = encabezados.get('retry-after')
+    if not valor:
+        return None
+    try:
+        return float(valor)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(valor).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class LimitadorTasa:
+    """
+    Token bucket: se reponen `tasa` fichas por segundo hasta `capacidad` (la ráfaga permitida).
+    Las fichas se reservan al pedirlas, así que los pedidos que llegan juntos esperan en orden
+    """
+
+    def __init__(self, tasa: float, capacidad: float = None):
+        self.tasa = tasa
+        self.capacidad = capacidad or max(1.0, tasa)
+        self._fichas = self.capacidad
+        self._ultima = time.monotonic()
+
+    def _reponer(self):
+        ahora = time.monotonic()
+        self._fichas = min(self.capacidad, self._fichas + (ahora - self._ultima) * self.tasa)
+        self._ultima = ahora
+
+    def espera(self, costo: float = 1) -> float:
+        """Segundos hasta que haya `costo` fichas, sin reservarlas"""
+        self._reponer()
+        return max(0.0, (costo - self._fichas) / self.tasa)
+
+    async def adquirir(self, costo: float = 1, espera_max: float = None):
+        """
+        Reserva `costo` fichas y espera a que estén disponibles. Si habría que esperar más de
+        `espera_max` segundos no reserva nada y lanza TimeoutError con la espera en el mensaje
+        """
+        espera = self.espera(costo)
+        if espera_max is not None and espera > espera_max:
+            raise TimeoutError(espera)
+        self._fichas -= costo
+        if espera > 0:
+            await asyncio.sleep(espera)
+
+
+class CircuitoBreaker:
+    """
+    cerrado: las llamadas pasan. Con `umbral_fallas` fallas seguidas pasa a abierto y rechaza todo
+    durante `tiempo_abierto` segundos; después queda semiabierto y deja pasar una sola llamada de
+    prueba: si anda se cierra, si falla vuelve a abrirse
+    """
+
+    def __init__(self, umbral_fallas: int = 5, tiempo_abierto: float = 30.0):
+        self.umbral_fallas = umbral_fallas
+        self.tiempo_abierto = tiempo_abierto
+        self.estado = 'cerrado'
+        self.fallas_seguidas = 0
+        self.aperturas = 0
+        self._abierto_hasta = 0.0
+        self._prueba_en_curso = False
+
+    def permitir(self) -> bool:
+        if self.estado == 'abierto':
+            if time.monotonic() < self._abierto_hasta:
+                return False
+            self.estado = 'semiabierto'
+            self._prueba_en_curso = False
+        if self.estado == 'semiabierto':
+            if self._prueba_en_curso:
+                return False
+            self._prueba_en_curso = True
+        return True
+
+    def exito(self):
+        self.estado = 'cerrado'
+        self.fallas_seguidas = 0
+        self._prueba_en_curso = False
+
+    def falla(self):
+        self.fallas_seguidas += 1
+        self._prueba_en_curso = False
+        if self.estado == 'semiabierto' or self.fallas_seguidas >= self.umbral_fallas:
+            if self.estado != 'abierto':
+                self.aperturas += 1
+            self.estado = 'abierto'
+            self._abierto_hasta = time.monotonic() + self.tiempo_abierto
+
+    def liberar(self):
+        """La llamada de prueba no llegó a hacerse (se canceló o no hubo cupo): otra puede probar"""
+        self._prueba_en_curso = False
+
+    def reintentar_en(self) -> float:
+        return max(0.0, self._abierto_hasta - time.monotonic()) if self.estado == 'abierto' else 0.0
+
+
+class ClienteExterno:
+    """
+    Ejecuta las llamadas a un servicio externo con límite de tasa, reintentos y circuit breaker.
+    `es_transitorio(error)` decide qué errores se reintentan; los demás (un pedido inválido, por
+    ejemplo) se lanzan tal cual y no cuentan como falla del servicio
+    """
+
+    def __init__(self, nombre: str, es_transitorio: Callable[[Exception], bool],
+                 limitador: LimitadorTasa, limitador_costo: LimitadorTasa = None,
+                 max_reintentos: int = 3, backoff_base: float = 0.5, backoff_max: float = 20.0,
+                 umbral_fallas: int = 5, tiempo_abierto: float = 30.0, espera_max: float = 10.0):
+        self.nombre = nombre
+        self.es_transitorio = es_transitorio
+        self.limitador = limitador
+        self.limitador_costo = limitador_costo
+        self.max_reintentos = max_reintentos
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.espera_max = espera_max
+        self.circuito = CircuitoBreaker(umbral_fallas, tiempo_abierto)
+        self.llamadas = 0
+        self.errores = 0
+        self.reintentos = 0
+        self.rechazadas = 0
+        self.ultimo_error = None
+        self._latencias = deque(maxlen=1000)
+
+    async def llamar(self, funcion: Callable[[], Awaitable[T]], costo: int = 0) -> T:
+        """
+        Llama a `funcion()` (una nueva corrutina por intento). `costo` se descuenta del limitador
+        de costo, por ejemplo los tokens estimados del request
+        """
+        for intento in range(self.max_reintentos + 1):
+            if not self.circuito.permitir():
+                self.rechazadas += 1
+                raise ServicioDegradado(self.nombre, "circuito abierto por errores seguidos",
+                                        self.circuito.reintentar_en() or self.circuito.tiempo_abierto)
+            try:
+                await self.limitador.adquirir(1, self.espera_max)
+                if costo and self.limitador_costo:
+                    await self.limitador_costo.adquirir(min(costo, self.limitador_costo.capacidad), self.espera_max)
+            except TimeoutError as e:
+                self.circuito.liberar()
+                self.rechazadas += 1
+                raise ServicioDegradado(self.nombre, "límite de tasa alcanzado", e.args[0] if e.args else None)
+            except BaseException:
+                self.circuito.liberar()
+                raise
+
+            inicio = time.monotonic()
+            try:
+                resultado = await funcion()
+            except asyncio.CancelledError:
+                self.circuito.liberar()
+                raise
+            except Exception as e:
+                self.llamadas += 1
+                self.errores += 1
+                self._latencias.append(time.monotonic() - inicio)
+                if not self.es_transitorio(e):
+                    # El servicio respondió: el error es del pedido
+                    self.circuito.exito()
+                    raise
+                self.ultimo_error = f"{type(e).__name__}: {e}"
+                self.circuito.falla()
+                if intento == self.max_reintentos or self.circuito.estado == 'abierto':
+                    raise ServicioDegradado(self.nombre, self.ultimo_error,
+                                            self.circuito.reintentar_en() or espera_sugerida(e)) from e
+                espera = espera_sugerida(e) or self._espera(intento + 1)
+                self.reintentos += 1
+                print(f"🔁 {self.nombre}: {type(e).__name__}, reintento {intento + 1}/{self.max_reintentos} en {espera:.1f}s")
+                await asyncio.sleep(espera)
+                continue
+            self.llamadas += 1
+            self._latencias.append(time.monotonic() - inicio)
+            self.circuito.exito()
+            return resultado
+
+    def _espera(self, intentos: int) -> float:
+        """Backoff exponencial con jitter: entre la mitad y el total de base * 2^(intentos-1)"""
+        espera = min(self.backoff_max, self.backoff_base * 2 ** (intentos - 1))
+        return espera / 2 + random.uniform(0, espera / 2)
+
+    def estadisticas(self) -> dict:
+        latencias = sorted(self._latencias)
+
+        def percentil(p: float) -> float:
+            return round(latencias[min(len(latencias) - 1, int(p * len(latencias)))] * 1000, 1) if latencias else 0
+
+        return {
+            "circuito": self.circuito.estado,
+            "reintentar_en": round(self.circuito.reintentar_en(), 1),
+            "llamadas": self.llamadas,
+            "errores": self.errores,
+            "reintentos": self.reintentos,
+            "rechazadas": self.rechazadas,
+            "aperturas_circuito": self.circuito.aperturas,
+            "ultimo_error": self.ultimo_error,
+            "latencia_ms": {"p50": percentil(0.5), "p95": percentil(0.95), "max": percentil(1.0)},
+        }
+
+
+class RegistroClientes:
+    """Un ClienteExterno por servicio (p. ej. "openai:chat:gpt-3.5-turbo"), creado al primer uso"""
+
+    def __init__(self):
+        self._clientes: Dict[str, ClienteExterno] = {}
+
+    def obtener(self, nombre: str, crear: Callable[[str], ClienteExterno]) -> ClienteExterno:
+        cliente = self._clientes.get(nombre)
+        if cliente is None:
+            cliente = self._clientes[nombre] = crear(nombre)
+        return cliente
+
+    def degradados(self) -> list:
+        return [nombre for nombre, cliente in self._clientes.items() if cliente.circuito.estado != 'cerrado']
+
+    def estadisticas(self) -> dict:
+        return {nombre: cliente.estadisticas() for nombre, cliente in self._clientes.items()}
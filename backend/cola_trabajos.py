@@ -0,0 +1,352 @@
+import asyncio
+import json
+import os
+import random
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+# Manejador de un tipo de trabajo: recibe el payload y la ruta del archivo de entrada (o None)
+# y devuelve un resultado serializable a JSON
+Manejador = Callable[[dict, Optional[str]], Awaitable[dict]]
+
+ESTADOS_FINALES = ('completado', 'fallido')
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS trabajos (
+    id TEXT PRIMARY KEY,
+    tipo TEXT NOT NULL,
+    estado TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    archivo TEXT,
+    intentos INTEGER NOT NULL DEFAULT 0,
+    max_intentos INTEGER NOT NULL,
+    disponible_en REAL NOT NULL,
+    lease_hasta REAL,
+    resultado TEXT,
+    error TEXT,
+    creado REAL NOT NULL,
+    actualizado REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_trabajos_estado ON trabajos(estado, disponible_en);
+"""
+
+
+class ErrorPermanente(Exception):
+    """Error que no se resuelve reintentando (p. ej. entrada inválida): el trabajo pasa directo a fallidos"""
+
+
+class ColaTrabajos:
+    """
+    Cola de trabajos en SQLite compartida por todos los workers de gunicorn.
+
+    Cada proceso corre `n` workers asyncio que toman trabajos con BEGIN IMMEDIATE, así un trabajo
+    nunca lo ejecutan dos workers. Un trabajo tomado tiene un lease que el worker renueva mientras
+    lo ejecuta: si el proceso muere, al vencer vuelve a la cola, y el resultado de un worker que
+    perdió el lease se descarta. Los errores se reintentan con backoff exponencial y jitter; al agotar
+    los intentos (o ante un ErrorPermanente) el trabajo queda en estado 'fallido' (dead letter)
+    con su archivo de entrada, para poder reintentarlo a mano.
+
+    SQLite puede esperar hasta 30s el lock de escritura de otro proceso: los workers lo usan desde
+    threads, y los métodos públicos (bloqueantes) se llaman con asyncio.to_thread desde el event loop.
+    """
+
+    def __init__(self, ruta_db: str, directorio_archivos: str, max_intentos: int = 4,
+                 backoff_base: float = 2.0, backoff_max: float = 300.0,
+                 duracion_lease: float = 600.0, intervalo_sondeo: float = 1.0):
+        self.ruta_db = ruta_db
+        self.directorio_archivos = directorio_archivos
+        self.max_intentos = max_intentos
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.duracion_lease = duracion_lease
+        self.intervalo_sondeo = intervalo_sondeo
+        self._manejadores: Dict[str, Manejador] = {}
+        self._workers: List[asyncio.Task] = []
+        self._hay_trabajo: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+        os.makedirs(directorio_archivos, exist_ok=True)
+        with self._conexion() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(ESQUEMA)
+
+    @contextmanager
+    def _conexion(self):
+        conn = sqlite3.connect(self.ruta_db, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def registrar(self, tipo: str, manejador: Manejador):
+        self._manejadores[tipo] = manejador
+
+    def _avisar(self):
+        """Despierta a los workers de este proceso; se puede llamar desde cualquier thread"""
+        if self._hay_trabajo is not None:
+            self._loop.call_soon_threadsafe(self._hay_trabajo.set)
+
+    # --- Encolar y consultar ---
+
+    def encolar(self, tipo: str, payload: dict, archivo: Optional[str] = None) -> dict:
+        """
+        Encola el trabajo. Si hay archivo de entrada, la cola lo mueve a su directorio y pasa a ser
+        su dueña (conviene crearlo en `directorio_archivos` para que sea un rename). Devuelve el estado inicial
+        """
+        if tipo not in self._manejadores:
+            raise ValueError(f"Tipo de trabajo desconocido: {tipo}")
+
+        trabajo_id = uuid.uuid4().hex
+        ruta_archivo = None
+        if archivo is not None:
+            ruta_archivo = os.path.join(self.directorio_archivos, f"{trabajo_id}{os.path.splitext(archivo)[1]}")
+            shutil.move(archivo, ruta_archivo)
+
+        ahora = time.time()
+        with self._conexion() as conn:
+            conn.execute(
+                "INSERT INTO trabajos (id, tipo, estado, payload, archivo, max_intentos, disponible_en, creado, actualizado) "
+                "VALUES (?, ?, 'pendiente', ?, ?, ?, ?, ?, ?)",
+                (trabajo_id, tipo, json.dumps(payload, ensure_ascii=False), ruta_archivo,
+                 self.max_intentos, ahora, ahora, ahora)
+            )
+        self._avisar()
+        return self.obtener(trabajo_id)
+
+    def obtener(self, trabajo_id: str) -> Optional[dict]:
+        with self._conexion() as conn:
+            fila = conn.execute("SELECT * FROM trabajos WHERE id = ?", (trabajo_id,)).fetchone()
+        return _fila_a_dict(fila) if fila else None
+
+    def listar(self, estado: Optional[str] = None, limite: int = 100) -> List[dict]:
+        """Trabajos más recientes primero; estado='fallido' es la lista de dead letter"""
+        with self._conexion() as conn:
+            if estado:
+                filas = conn.execute(
+                    "SELECT * FROM trabajos WHERE estado = ? ORDER BY actualizado DESC LIMIT ?", (estado, limite)
+                ).fetchall()
+            else:
+                filas = conn.execute(
+                    "SELECT * FROM trabajos ORDER BY actualizado DESC LIMIT ?", (limite,)
+                ).fetchall()
+        return [_fila_a_dict(fila) for fila in filas]
+
+    def reintentar(self, trabajo_id: str) -> bool:
+        """Vuelve a encolar un trabajo fallido con los intentos en cero"""
+        with self._conexion() as conn:
+            cursor = conn.execute(
+                "UPDATE trabajos SET estado = 'pendiente', intentos = 0, error = NULL, disponible_en = ?, "
+                "actualizado = ? WHERE id = ? AND estado = 'fallido'",
+                (time.time(), time.time(), trabajo_id)
+            )
+        if cursor.rowcount:
+            self._avisar()
+        return bool(cursor.rowcount)
+
+    def purgar(self, antiguedad_segundos: float) -> int:
+        """Borra los trabajos completados más viejos que la antigüedad indicada"""
+        limite = time.time() - antiguedad_segundos
+        with self._conexion() as conn:
+            cursor = conn.execute(
+                "DELETE FROM trabajos WHERE estado = 'completado' AND actualizado < ?", (limite,)
+            )
+        return cursor.rowcount
+
+    async def eventos(self, trabajo_id: str, intervalo: float = 0.5) -> AsyncIterator[dict]:
+        """Emite el estado del trabajo cada vez que cambia, hasta que termina (para SSE)"""
+        ultimo = None
+        while True:
+            trabajo = await asyncio.to_thread(self.obtener, trabajo_id)
+            if trabajo is None:
+                return
+            firma = (trabajo['estado'], trabajo['intentos'], trabajo['actualizado'])
+            if firma != ultimo:
+                ultimo = firma
+                yield trabajo
+            if trabajo['estado'] in ESTADOS_FINALES:
+                return
+            await asyncio.sleep(intervalo)
+
+    # --- Workers ---
+
+    def iniciar_workers(self, cantidad: int):
+        self._loop = asyncio.get_running_loop()
+        self._hay_trabajo = asyncio.Event()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(cantidad)]
+        print(f"🧵 Cola de trabajos: {cantidad} workers")
+
+    async def detener_workers(self):
+        for tarea in self._workers:
+            tarea.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _worker(self):
+        while True:
+            try:
+                trabajo = await asyncio.to_thread(self._tomar)
+            except sqlite3.Error as e:
+                print(f"Error leyendo la cola de trabajos: {e}")
+                trabajo = None
+            if trabajo is None:
+                self._hay_trabajo.clear()
+                try:
+                    await asyncio.wait_for(self._hay_trabajo.wait(), self.intervalo_sondeo)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._ejecutar(trabajo)
+
+    def _tomar(self) -> Optional[dict]:
+        """Toma el próximo trabajo disponible (o con lease vencido) de los tipos registrados"""
+        ahora = time.time()
+        tipos = list(self._manejadores)
+        if not tipos:
+            return None
+        marcadores = ','.join('?' * len(tipos))
+        with self._conexion() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                while True:
+                    fila = conn.execute(
+                        f"SELECT * FROM trabajos WHERE tipo IN ({marcadores}) AND "
+                        "((estado = 'pendiente' AND disponible_en <= ?) OR (estado = 'procesando' AND lease_hasta < ?)) "
+                        "ORDER BY disponible_en LIMIT 1",
+                        (*tipos, ahora, ahora)
+                    ).fetchone()
+                    if fila is None:
+                        conn.execute("COMMIT")
+                        return None
+                    if fila['estado'] == 'procesando' and fila['intentos'] >= fila['max_intentos']:
+                        # El worker que lo tenía murió en el último intento
+                        conn.execute(
+                            "UPDATE trabajos SET estado = 'fallido', error = ?, lease_hasta = NULL, actualizado = ? WHERE id = ?",
+                            ("El worker se detuvo durante el procesamiento", ahora, fila['id'])
+                        )
+                        continue
+                    conn.execute(
+                        "UPDATE trabajos SET estado = 'procesando', intentos = intentos + 1, lease_hasta = ?, "
+                        "actualizado = ? WHERE id = ?",
+                        (ahora + self.duracion_lease, ahora, fila['id'])
+                    )
+                    conn.execute("COMMIT")
+                    trabajo = _fila_a_dict(fila)
+                    trabajo['intentos'] += 1
+                    # El lease actual: lo renueva el heartbeat y cerca el UPDATE final (los dos bajo lock_lease)
+                    trabajo['lease_hasta'] = ahora + self.duracion_lease
+                    trabajo['lock_lease'] = threading.Lock()
+                    trabajo['payload'] = json.loads(fila['payload'])
+                    trabajo['archivo'] = fila['archivo']
+                    return trabajo
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    async def _ejecutar(self, trabajo: dict):
+        manejador = self._manejadores[trabajo['tipo']]
+        print(f"▶️ Trabajo {trabajo['id']} ({trabajo['tipo']}), intento {trabajo['intentos']}/{trabajo['max_intentos']}")
+        heartbeat = asyncio.create_task(self._heartbeat(trabajo))
+        try:
+            resultado = await manejador(trabajo['payload'], trabajo['archivo'])
+        except asyncio.CancelledError:
+            # Apagado del worker: el lease vence y otro proceso lo retoma
+            raise
+        except ErrorPermanente as e:
+            await asyncio.to_thread(self._fallar, trabajo, str(e), True)
+        except Exception as e:
+            # Un servicio externo degradado indica cuándo reintentar (reintentar_en, en segundos)
+            await asyncio.to_thread(self._fallar, trabajo, f"{type(e).__name__}: {e}", False,
+                                    getattr(e, 'reintentar_en', None) or 0)
+        else:
+            await asyncio.to_thread(self._completar, trabajo, resultado)
+        finally:
+            heartbeat.cancel()
+
+    async def _heartbeat(self, trabajo: dict):
+        """Renueva el lease cada tercio de su duración mientras el trabajo corre"""
+        while True:
+            await asyncio.sleep(self.duracion_lease / 3)
+            try:
+                renovado = await asyncio.to_thread(self._renovar_lease, trabajo)
+            except sqlite3.Error as e:
+                print(f"Error renovando el lease del trabajo {trabajo['id']}: {e}")
+                continue
+            if not renovado:
+                print(f"⚠️ Trabajo {trabajo['id']}: lease perdido, otro worker lo retomó")
+                return
+
+    def _renovar_lease(self, trabajo: dict) -> bool:
+        lease_hasta = time.time() + self.duracion_lease
+        with trabajo['lock_lease'], self._conexion() as conn:
+            cursor = conn.execute(
+                "UPDATE trabajos SET lease_hasta = ? WHERE id = ? AND estado = 'procesando' AND lease_hasta = ?",
+                (lease_hasta, trabajo['id'], trabajo['lease_hasta'])
+            )
+            if cursor.rowcount:
+                trabajo['lease_hasta'] = lease_hasta
+        return bool(cursor.rowcount)
+
+    def _actualizar_con_lease(self, trabajo: dict, campos: str, valores: tuple) -> bool:
+        """
+        UPDATE final del trabajo, solo si este worker conserva el lease: si venció y otro worker
+        lo retomó, el resultado de este se descarta para no pisar el más nuevo
+        """
+        with trabajo['lock_lease'], self._conexion() as conn:
+            cursor = conn.execute(
+                f"UPDATE trabajos SET {campos}, lease_hasta = NULL WHERE id = ? AND estado = 'procesando' "
+                "AND lease_hasta = ?",
+                (*valores, trabajo['id'], trabajo['lease_hasta'])
+            )
+        if not cursor.rowcount:
+            print(f"⚠️ Trabajo {trabajo['id']}: lease perdido, se descarta el resultado de este intento")
+        return bool(cursor.rowcount)
+
+    def _completar(self, trabajo: dict, resultado: dict):
+        if not self._actualizar_con_lease(
+            trabajo, "estado = 'completado', resultado = ?, error = NULL, actualizado = ?",
+            (json.dumps(resultado, ensure_ascii=False, default=str), time.time())
+        ):
+            return
+        if trabajo['archivo'] and os.path.exists(trabajo['archivo']):
+            os.unlink(trabajo['archivo'])
+        print(f"✅ Trabajo {trabajo['id']} completado")
+
+    def _fallar(self, trabajo: dict, error: str, permanente: bool, espera_minima: float = 0):
+        ahora = time.time()
+        if permanente or trabajo['intentos'] >= trabajo['max_intentos']:
+            estado, disponible_en = 'fallido', ahora
+        else:
+            estado, disponible_en = 'pendiente', ahora + max(espera_minima, self._espera(trabajo['intentos']))
+        if not self._actualizar_con_lease(trabajo, "estado = ?, error = ?, disponible_en = ?, actualizado = ?",
+                                          (estado, error, disponible_en, ahora)):
+            return
+        if estado == 'fallido':
+            print(f"❌ Trabajo {trabajo['id']} fallido: {error}")
+        else:
+            print(f"🔁 Trabajo {trabajo['id']} reintenta en {disponible_en - ahora:.1f}s: {error}")
+
+    def _espera(self, intentos: int) -> float:
+        """Backoff exponencial con jitter: entre la mitad y el total de base * 2^(intentos-1)"""
+        espera = min(self.backoff_max, self.backoff_base * 2 ** (intentos - 1))
+        return espera / 2 + random.uniform(0, espera / 2)
+
+
+def _fila_a_dict(fila: sqlite3.Row) -> dict:
+    return {
+        "id": fila['id'],
+        "tipo": fila['tipo'],
+        "estado": fila['estado'],
+        "intentos": fila['intentos'],
+        "max_intentos": fila['max_intentos'],
+        "proximo_intento": fila['disponible_en'] if fila['estado'] == 'pendiente' else None,
+        "resultado": json.loads(fila['resultado']) if fila['resultado'] else None,
+        "error": fila['error'],
+        "creado": fila['creado'],
+        "actualizado": fila['actualizado'],
+    }
@@ -0,0 +1,138 @@
+import re
+import unicodedata
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from modelos import Proveedor
+
+# Peso de cada tipo de coincidencia; varias coincidencias se combinan como 1 - Π(1 - peso)
+PESO_CUIT = 0.99
+PESO_NOMBRE = 0.9
+PESO_ALIAS = 0.6
+
+# Alias de una sola palabra que aparecen en cualquier factura: no identifican a ningún proveedor
+PALABRAS_GENERICAS = {
+    'distribuidora', 'distribuidoras', 'distribucion', 'distribuciones', 'distribuidor', 'mayorista',
+    'central', 'comercial', 'alimentos', 'bebidas', 'cola', 'sa', 'srl', 'sas', 'hnos', 'small',
+}
+LARGO_MINIMO_ALIAS = 3
+
+_SEPARADOR_ENTRE_DIGITOS = re.compile(r'(?<=\d)[-. /](?=\d)')
+_NO_ALFANUMERICO = re.compile(r'[^a-z0-9]+')
+
+
+def normalizar_texto(texto: str) -> str:
+    """
+    Minúsculas sin acentos, separadores entre dígitos eliminados (33-71167678-9 → 33711676789)
+    y cualquier otro signo como espacio. Queda rodeado de espacios para matchear palabras completas
+    """
+    texto = unicodedata.normalize('NFKD', texto or '').encode('ascii', 'ignore').decode('ascii').lower()
+    texto = _SEPARADOR_ENTRE_DIGITOS.sub('', texto)
+    return f" {_NO_ALFANUMERICO.sub(' ', texto).strip()} "
+
+
+def _alias_especifico(alias_normalizado: str) -> bool:
+    """Un alias sirve como evidencia si tiene varias palabras o es una palabra distintiva"""
+    palabras = alias_normalizado.split()
+    if len(palabras) > 1:
+        return True
+    return bool(palabras) and len(palabras[0]) >= LARGO_MINIMO_ALIAS and palabras[0] not in PALABRAS_GENERICAS
+
+
+class DetectorProveedores:
+    """
+    Detecta el proveedor de una factura con un autómata Aho-Corasick sobre nombres, alias y CUITs
+    normalizados: una sola pasada lineal sobre el texto del OCR, sin importar cuántos proveedores haya.
+    El autómata se reconstruye solo cuando cambian los proveedores.
+    """
+
+    def __init__(self):
+        self._firma = None
+        self._proveedores: Dict[int, Proveedor] = {}
+        # Autómata: transiciones por nodo, enlace de falla y patrones que terminan en cada nodo
+        self._transiciones: List[Dict[str, int]] = [{}]
+        self._falla: List[int] = [0]
+        self._salidas: List[List[Tuple[str, int, float]]] = [[]]
+
+    def sincronizar(self, proveedores: List[Proveedor]):
+        firma = tuple((p.id, p.nombre, p.cuit, tuple(p.alias)) for p in proveedores)
+        if firma == self._firma:
+            return
+        self._construir(proveedores)
+        self._firma = firma
+
+    def _construir(self, proveedores: List[Proveedor]):
+        self._proveedores = {p.id: p for p in proveedores}
+        self._transiciones, self._falla, self._salidas = [{}], [0], [[]]
+
+        for proveedor in proveedores:
+            patrones = {normalizar_texto(proveedor.nombre): PESO_NOMBRE}
+            for alias in proveedor.alias:
+                normalizado = normalizar_texto(alias)
+                if not _alias_especifico(normalizado):
+                    print(f"⚠️ Alias '{alias}' de {proveedor.nombre} ignorado: demasiado genérico")
+                    continue
+                patrones.setdefault(normalizado, PESO_ALIAS)
+            if proveedor.cuit:
+                patrones[normalizar_texto(proveedor.cuit)] = PESO_CUIT
+            for patron, peso in patrones.items():
+                if patron.strip():
+                    self._agregar_patron(patron, proveedor.id, peso)
+
+        # Enlaces de falla por BFS
+        cola = deque()
+        for nodo in self._transiciones[0].values():
+            cola.append(nodo)
+        while cola:
+            actual = cola.popleft()
+            for caracter, siguiente in self._transiciones[actual].items():
+                cola.append(siguiente)
+                falla = self._falla[actual]
+                while falla and caracter not in self._transiciones[falla]:
+                    falla = self._falla[falla]
+                destino = self._transiciones[falla].get(caracter, 0)
+                self._falla[siguiente] = destino if destino != siguiente else 0
+                self._salidas[siguiente] = self._salidas[siguiente] + self._salidas[self._falla[siguiente]]
+
+        print(f"🏷️ Detector de proveedores construido: {len(proveedores)} proveedores, {len(self._transiciones)} nodos")
+
+    def _agregar_patron(self, patron: str, proveedor_id: int, peso: float):
+        nodo = 0
+        for caracter in patron:
+            siguiente = self._transiciones[nodo].get(caracter)
+            if siguiente is None:
+                siguiente = len(self._transiciones)
+                self._transiciones.append({})
+                self._falla.append(0)
+                self._salidas.append([])
+                self._transiciones[nodo][caracter] = siguiente
+            nodo = siguiente
+        self._salidas[nodo].append((patron.strip(), proveedor_id, peso))
+
+    def coincidencias(self, texto: str) -> Dict[int, Dict[str, float]]:
+        """Patrones encontrados en el texto por proveedor: {proveedor_id: {patron: peso}}"""
+        encontrados: Dict[int, Dict[str, float]] = {}
+        nodo = 0
+        transiciones, falla, salidas = self._transiciones, self._falla, self._salidas
+        for caracter in normalizar_texto(texto):
+            while nodo and caracter not in transiciones[nodo]:
+                nodo = falla[nodo]
+            nodo = transiciones[nodo].get(caracter, 0)
+            for patron, proveedor_id, peso in salidas[nodo]:
+                encontrados.setdefault(proveedor_id, {})[patron] = peso
+        return encontrados
+
+    def detectar(self, texto: str) -> Tuple[Optional[Proveedor], float, List[str]]:
+        """
+        Devuelve (proveedor, confianza 0..1, patrones encontrados) del proveedor con más evidencia,
+        o (None, 0.0, []) si no aparece ninguno
+        """
+        mejor: Tuple[Optional[Proveedor], float, List[str]] = (None, 0.0, [])
+        for proveedor_id, patrones in self.coincidencias(texto).items():
+            sin_evidencia = 1.0
+            for peso in patrones.values():
+                sin_evidencia *= 1 - peso
+            confianza = round(1 - sin_evidencia, 3)
+            if confianza > mejor[1] or (confianza == mejor[1] and mejor[0] and proveedor_id < mejor[0].id):
+                mejor = (self._proveedores[proveedor_id], confianza, sorted(patrones))
+        return mejor
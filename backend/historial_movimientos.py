@@ -0,0 +1,217 @@
+"""
+Historial de movimientos de stock en SQLite (data/movimientos.db, modo WAL, compartido por los workers).
+
+Cada entrada o salida queda como evento (producto, delta, acción, proveedor, factura, fecha) y en la
+misma transacción se suman a los agregados por hora, día y mes de cada producto y del total
+(producto_id 0). Los reportes leen solo los agregados: un rango largo se arma con meses completos
+y los días sueltos de los extremos, así cuesta lo mismo con semanas que con años de movimientos.
+"""
+import sqlite3
+import threading
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS movimientos (
+    id INTEGER PRIMARY KEY,
+    ts TEXT NOT NULL,
+    producto_id INTEGER NOT NULL,
+    delta INTEGER NOT NULL,
+    accion TEXT NOT NULL,
+    proveedor_id INTEGER,
+    factura TEXT,
+    origen TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_movimientos_producto ON movimientos(producto_id, ts);
+CREATE INDEX IF NOT EXISTS idx_movimientos_ts ON movimientos(ts);
+
+CREATE TABLE IF NOT EXISTS agregados (
+    granularidad TEXT NOT NULL,
+    producto_id INTEGER NOT NULL,
+    periodo TEXT NOT NULL,
+    proveedor_id INTEGER NOT NULL,
+    entradas INTEGER NOT NULL,
+    salidas INTEGER NOT NULL,
+    movimientos INTEGER NOT NULL,
+    PRIMARY KEY (granularidad, producto_id, periodo)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_agregados_periodo ON agregados(granularidad, periodo);
+CREATE INDEX IF NOT EXISTS idx_agregados_proveedor ON agregados(granularidad, proveedor_id, periodo);
+"""
+
+# Formato del período de cada granularidad: ordenan igual como texto que como fecha
+FORMATOS_PERIODO = {'hora': '%Y-%m-%dT%H', 'dia': '%Y-%m-%d', 'mes': '%Y-%m'}
+# Fila de agregados con el total de todos los productos
+TOTAL = 0
+
+
+def _fecha(valor) -> datetime:
+    return valor if isinstance(valor, datetime) else datetime.fromisoformat(valor)
+
+
+def tramos(desde: date, hasta: date) -> List[Tuple[str, str, str]]:
+    """
+    Cubre [desde, hasta) con (granularidad, periodo_desde, periodo_hasta): días sueltos hasta el
+    primer mes completo, los meses completos y los días sueltos del final
+    """
+    primer_mes = desde if desde.day == 1 else (desde.replace(day=28) + timedelta(days=4)).replace(day=1)
+    ultimo_mes = hasta.replace(day=1)
+    if primer_mes >= ultimo_mes:
+        return [('dia', desde.isoformat(), hasta.isoformat())] if desde < hasta else []
+    resultado = []
+    if desde < primer_mes:
+        resultado.append(('dia', desde.isoformat(), primer_mes.isoformat()))
+    resultado.append(('mes', primer_mes.strftime('%Y-%m'), ultimo_mes.strftime('%Y-%m')))
+    if ultimo_mes < hasta:
+        resultado.append(('dia', ultimo_mes.isoformat(), hasta.isoformat()))
+    return resultado
+
+
+class HistorialMovimientos:
+    """
+    Libro de movimientos con agregados incrementales. `registrar` recibe dicts con producto_id,
+    delta y opcionalmente accion, proveedor_id, factura, origen y ts (por defecto, ahora)
+    """
+
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        self._local = threading.local()
+        conexion = self._conexion()
+        conexion.executescript(ESQUEMA)
+
+    def _conexion(self) -> sqlite3.Connection:
+        conexion = getattr(self._local, 'conexion', None)
+        if conexion is None:
+            conexion = sqlite3.connect(self.ruta, timeout=30, isolation_level=None, check_same_thread=False)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute("PRAGMA synchronous=NORMAL")
+            conexion.execute("PRAGMA busy_timeout=30000")
+            self._local.conexion = conexion
+        return conexion
+
+    # --- Escritura ---
+
+    def registrar(self, movimientos: Iterable[dict]) -> int:
+        """Guarda los movimientos y suma sus agregados en una sola transacción; devuelve cuántos guardó"""
+        eventos = []
+        # (granularidad, producto_id, periodo) -> [proveedor_id, entradas, salidas, movimientos]
+        agregados: Dict[tuple, list] = defaultdict(lambda: [TOTAL, 0, 0, 0])
+        for movimiento in movimientos:
+            delta = int(movimiento['delta'])
+            if not delta:
+                continue
+            ts = _fecha(movimiento.get('ts') or datetime.now())
+            producto_id = movimiento['producto_id']
+            proveedor_id = movimiento.get('proveedor_id')
+            accion = movimiento.get('accion') or ('entrada' if delta > 0 else 'salida')
+            eventos.append((ts.isoformat(), producto_id, delta, accion, proveedor_id,
+                            movimiento.get('factura'), movimiento.get('origen')))
+            for granularidad, formato in FORMATOS_PERIODO.items():
+                periodo = ts.strftime(formato)
+                for clave_producto in (producto_id, TOTAL):
+                    agregado = agregados[(granularidad, clave_producto, periodo)]
+                    if clave_producto != TOTAL:
+                        agregado[0] = proveedor_id or 0
+                    agregado[1 if delta > 0 else 2] += abs(delta)
+                    agregado[3] += 1
+        if not eventos:
+            return 0
+
+        conexion = self._conexion()
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            conexion.executemany(
+                "INSERT INTO movimientos (ts, producto_id, delta, accion, proveedor_id, factura, origen) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", eventos
+            )
+            conexion.executemany(
+                "INSERT INTO agregados (granularidad, producto_id, periodo, proveedor_id, entradas, salidas, movimientos) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(granularidad, producto_id, periodo) DO UPDATE SET "
+                "proveedor_id = excluded.proveedor_id, entradas = entradas + excluded.entradas, "
+                "salidas = salidas + excluded.salidas, movimientos = movimientos + excluded.movimientos",
+                (clave + tuple(valores) for clave, valores in agregados.items())
+            )
+            conexion.execute("COMMIT")
+        except BaseException:
+            conexion.execute("ROLLBACK")
+            raise
+        return len(eventos)
+
+    # --- Lecturas ---
+
+    def listar(self, producto_id: Optional[int] = None, limite: int = 100) -> List[dict]:
+        """Últimos movimientos, del más reciente al más viejo"""
+        where, parametros = ("WHERE producto_id = ?", (producto_id,)) if producto_id is not None else ("", ())
+        filas = self._conexion().execute(
+            "SELECT id, ts, producto_id, delta, accion, proveedor_id, factura, origen FROM movimientos "
+            f"{where} ORDER BY ts DESC, id DESC LIMIT ?", parametros + (limite,)
+        )
+        columnas = ['id', 'ts', 'producto_id', 'delta', 'accion', 'proveedor_id', 'factura', 'origen']
+        return [dict(zip(columnas, fila)) for fila in filas]
+
+    def salidas_diarias(self, desde: date, hasta: date) -> Tuple[int, List[Tuple[int, str, int]]]:
+        """
+        (producto_id, día, unidades) de las salidas diarias en [desde, hasta), junto con el id del último
+        movimiento incluido; se leen en la misma transacción para poder seguir con salidas_desde
+        """
+        conexion = self._conexion()
+        conexion.execute("BEGIN")
+        try:
+            ultimo_id = conexion.execute("SELECT COALESCE(MAX(id), 0) FROM movimientos").fetchone()[0]
+            filas = conexion.execute(
+                "SELECT producto_id, periodo, salidas FROM agregados WHERE granularidad = 'dia' "
+                "AND periodo >= ? AND periodo < ? AND producto_id != 0 AND salidas > 0",
+                (desde.isoformat(), hasta.isoformat())
+            ).fetchall()
+        finally:
+            conexion.execute("COMMIT")
+        return ultimo_id, filas
+
+    def salidas_desde(self, ultimo_id: int) -> Tuple[int, List[Tuple[int, str, int]]]:
+        """(producto_id, ts, unidades) de las salidas registradas después del movimiento `ultimo_id`"""
+        filas = self._conexion().execute(
+            "SELECT id, producto_id, ts, delta FROM movimientos WHERE id > ? ORDER BY id", (ultimo_id,)
+        ).fetchall()
+        if not filas:
+            return ultimo_id, []
+        return filas[-1][0], [(producto_id, ts, -delta) for _, producto_id, ts, delta in filas if delta < 0]
+
+    def serie(self, granularidad: str, desde: str, hasta: str, producto_id: Optional[int] = None,
+              proveedor_id: Optional[int] = None) -> List[dict]:
+        """
+        Entradas y salidas por período en [desde, hasta) (períodos en el formato de la granularidad),
+        de un producto, de un proveedor o del total
+        """
+        if proveedor_id is not None and producto_id is None:
+            sql = ("SELECT periodo, SUM(entradas), SUM(salidas), SUM(movimientos) FROM agregados "
+                   "WHERE granularidad = ? AND proveedor_id = ? AND periodo >= ? AND periodo < ? "
+                   "GROUP BY periodo ORDER BY periodo")
+            parametros = (granularidad, proveedor_id, desde, hasta)
+        else:
+            sql = ("SELECT periodo, entradas, salidas, movimientos FROM agregados "
+                   "WHERE granularidad = ? AND producto_id = ? AND periodo >= ? AND periodo < ? ORDER BY periodo")
+            parametros = (granularidad, TOTAL if producto_id is None else producto_id, desde, hasta)
+        return [{"periodo": periodo, "entradas": entradas, "salidas": salidas, "movimientos": cantidad}
+                for periodo, entradas, salidas, cantidad in self._conexion().execute(sql, parametros)]
+
+    def totales_por_producto(self, desde: date, hasta: date,
+                             proveedor_id: Optional[int] = None) -> Dict[int, dict]:
+        """Entradas, salidas y movimientos de cada producto con movimientos en [desde, hasta)"""
+        partes, parametros = [], []
+        for granularidad, periodo_desde, periodo_hasta in tramos(desde, hasta):
+            filtro = "AND proveedor_id = ?" if proveedor_id is not None else "AND producto_id != 0"
+            partes.append("SELECT producto_id, entradas, salidas, movimientos FROM agregados "
+                          f"WHERE granularidad = ? AND periodo >= ? AND periodo < ? {filtro}")
+            parametros += [granularidad, periodo_desde, periodo_hasta]
+            if proveedor_id is not None:
+                parametros.append(proveedor_id)
+        if not partes:
+            return {}
+        sql = (f"SELECT producto_id, SUM(entradas), SUM(salidas), SUM(movimientos) FROM ({' UNION ALL '.join(partes)}) "
+               "GROUP BY producto_id")
+        return {
+            producto_id: {"entradas": entradas, "salidas": salidas, "movimientos": cantidad}
+            for producto_id, entradas, salidas, cantidad in self._conexion().execute(sql, parametros)
+            if producto_id != TOTAL
+        }
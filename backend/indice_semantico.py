@@ -0,0 +1,232 @@
+"""
+Índice vectorial de nombres de productos para buscar candidatos a escala de catálogo.
+
+Cada nombre se convierte en un vector de n-gramas de caracteres con hashing (sin modelo ni red):
+las palabras y sus trigramas/cuatrigramas suman en posiciones fijas de un vector de DIMENSION
+floats, y el tamaño (95g, 500ml) pesa más. La búsqueda es fuerza bruta con NumPy (similitud
+coseno contra todos los productos): a 100k productos son unos pocos milisegundos.
+
+El índice se guarda en disco (vectores .npy + metadatos) y se abre con memory-mapping, así un
+worker arranca sin recalcular los vectores; los productos nuevos o renombrados se agregan de a uno.
+"""
+import json
+import os
+import uuid
+import zlib
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from bloqueos import bloqueo_entre_procesos
+from matcher_productos import extraer_atributos, _id_y_nombre
+
+DIMENSION = 128
+# Cambia si cambia la forma de vectorizar: un índice guardado con otra versión se reconstruye
+VERSION_VECTORES = 1
+PESO_PALABRA = 1.0
+PESO_NGRAMA = 0.5
+PESO_TAMANO = 2.0
+ARCHIVO_METADATOS = "indice.json"
+# Lock entre workers para guardar (y limpiar vectores viejos) y para abrir el índice
+ARCHIVO_LOCK = "indice.lock"
+
+
+def _hash_rasgo(rasgo: str, peso: float, dimension: int) -> Tuple[int, float]:
+    # crc32 y no hash(): el hash de str cambia entre procesos y los vectores se guardan en disco
+    h = zlib.crc32(rasgo.encode('utf-8'))
+    return h % dimension, (peso if h & 0x80000000 else -peso)
+
+
+@lru_cache(maxsize=100_000)
+def _rasgos_palabra(palabra: str, dimension: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Posiciones y pesos de la palabra y sus trigramas/cuatrigramas (las palabras se repiten mucho en un catálogo)"""
+    rasgos = [_hash_rasgo("p:" + palabra, PESO_PALABRA, dimension)]
+    relleno = f" {palabra} "
+    for n in (3, 4):
+        rasgos += [_hash_rasgo(relleno[i:i + n], PESO_NGRAMA, dimension) for i in range(len(relleno) - n + 1)]
+    posiciones, pesos = zip(*rasgos)
+    return np.array(posiciones), np.array(pesos, dtype=np.float32)
+
+
+def vectorizar(nombre: str, dimension: int = DIMENSION) -> np.ndarray:
+    """Vector normalizado (norma 1) del nombre; el vector nulo si no tiene palabras ni tamaño"""
+    atributos = extraer_atributos(nombre)
+    vector = np.zeros(dimension, dtype=np.float32)
+    for palabra in atributos.palabras:
+        np.add.at(vector, *_rasgos_palabra(palabra, dimension))
+    if atributos.tamano:
+        posicion, peso = _hash_rasgo("t:" + atributos.tamano, PESO_TAMANO, dimension)
+        vector[posicion] += peso
+    norma = np.linalg.norm(vector)
+    return vector / norma if norma else vector
+
+
+class IndiceSemantico:
+    """
+    Vectores de los nombres del stock en una matriz (una fila por producto) con búsqueda top-k.
+    Se mantiene igual que MatcherProductos: `sincronizar` con la lista completa, o `agregar`/`quitar`
+    de a un producto. Si `directorio` es None no se guarda en disco
+    """
+
+    def __init__(self, directorio: Optional[str] = None, dimension: int = DIMENSION):
+        self.directorio = directorio
+        self.dimension = dimension
+        self._vectores = np.zeros((0, dimension), dtype=np.float32)
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._cantidad = 0
+        self._filas: Dict[int, int] = {}
+        self._nombres: Dict[int, str] = {}
+        self.cambios_sin_guardar = 0
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+            self.cargar()
+
+    def __len__(self) -> int:
+        return self._cantidad
+
+    def nombre(self, producto_id: int) -> Optional[str]:
+        """Nombre con el que está indexado el producto (None si no está)"""
+        return self._nombres.get(producto_id)
+
+    # --- Mantenimiento ---
+
+    def sincronizar(self, productos: Iterable):
+        """Deja el índice igual a la lista recibida, recalculando solo los productos nuevos o renombrados"""
+        vistos = set()
+        for producto in productos:
+            producto_id, nombre = _id_y_nombre(producto)
+            vistos.add(producto_id)
+            if self._nombres.get(producto_id) != nombre:
+                self.agregar(producto_id, nombre)
+        for producto_id in [producto_id for producto_id in self._nombres if producto_id not in vistos]:
+            self.quitar(producto_id)
+
+    def agregar(self, producto_id: int, nombre: str):
+        vector = vectorizar(nombre, self.dimension)
+        fila = self._filas.get(producto_id)
+        if fila is None:
+            self._asegurar_capacidad(self._cantidad + 1)
+            fila = self._cantidad
+            self._cantidad += 1
+            self._filas[producto_id] = fila
+            self._ids[fila] = producto_id
+        else:
+            self._asegurar_capacidad(self._cantidad)
+        self._vectores[fila] = vector
+        self._nombres[producto_id] = nombre
+        self.cambios_sin_guardar += 1
+
+    def quitar(self, producto_id: int):
+        fila = self._filas.pop(producto_id, None)
+        if fila is None:
+            return
+        self._nombres.pop(producto_id, None)
+        self._asegurar_capacidad(self._cantidad)
+        # La última fila ocupa el lugar de la quitada
+        ultima = self._cantidad - 1
+        if fila != ultima:
+            self._vectores[fila] = self._vectores[ultima]
+            self._ids[fila] = self._ids[ultima]
+            self._filas[int(self._ids[fila])] = fila
+        self._cantidad = ultima
+        self.cambios_sin_guardar += 1
+
+    def _asegurar_capacidad(self, filas: int):
+        """Pasa a memoria los vectores abiertos con mmap (solo lectura) y duplica la capacidad si hace falta"""
+        if not isinstance(self._vectores, np.memmap) and filas <= len(self._vectores):
+            return
+        capacidad = max(filas, 2 * self._cantidad, 16)
+        vectores = np.zeros((capacidad, self.dimension), dtype=np.float32)
+        vectores[:self._cantidad] = self._vectores[:self._cantidad]
+        ids = np.zeros(capacidad, dtype=np.int64)
+        ids[:self._cantidad] = self._ids[:self._cantidad]
+        self._vectores, self._ids = vectores, ids
+
+    # --- Búsqueda ---
+
+    def buscar(self, nombre: str, k: int = 10, score_minimo: float = 0.0) -> List[Tuple[float, int]]:
+        """Top-k (similitud coseno, producto_id) para un nombre, de mayor a menor"""
+        if not self._cantidad:
+            return []
+        consulta = vectorizar(nombre, self.dimension)
+        if not consulta.any():
+            return []
+        scores = self._vectores[:self._cantidad] @ consulta
+        k = min(k, self._cantidad)
+        mejores = np.argpartition(-scores, k - 1)[:k] if k < self._cantidad else np.arange(self._cantidad)
+        mejores = mejores[np.argsort(-scores[mejores], kind='stable')]
+        return [(round(float(scores[fila]), 3), int(self._ids[fila]))
+                for fila in mejores if scores[fila] >= score_minimo]
+
+    # --- Persistencia ---
+
+    def guardar(self):
+        """
+        Escribe los vectores en un archivo nuevo y después los metadatos que lo referencian
+        (reemplazo atómico): un worker que lee a la vez ve el índice anterior o el nuevo entero.
+        Todo corre con el lock entre workers, así la limpieza de un worker no borra los vectores
+        que otro acaba de guardar
+        """
+        if not self.directorio:
+            return
+        ids = [int(producto_id) for producto_id in self._ids[:self._cantidad]]
+        with bloqueo_entre_procesos(os.path.join(self.directorio, ARCHIVO_LOCK)):
+            archivo = f"vectores-{uuid.uuid4().hex}.npy"
+            np.save(os.path.join(self.directorio, archivo), self._vectores[:self._cantidad])
+            metadatos = {
+                "version": VERSION_VECTORES,
+                "dimension": self.dimension,
+                "archivo": archivo,
+                "ids": ids,
+                "nombres": [self._nombres[producto_id] for producto_id in ids],
+            }
+            ruta = os.path.join(self.directorio, ARCHIVO_METADATOS)
+            temporal = f"{ruta}.{uuid.uuid4().hex}.tmp"
+            with open(temporal, "w", encoding="utf-8") as f:
+                json.dump(metadatos, f, ensure_ascii=False)
+            os.replace(temporal, ruta)
+            self._borrar_vectores_viejos(archivo)
+        self.cambios_sin_guardar = 0
+        print(f"🧭 Índice semántico guardado: {self._cantidad} productos")
+
+    def guardar_si_hace_falta(self, cada: int):
+        if self.cambios_sin_guardar >= cada:
+            self.guardar()
+
+    def cargar(self) -> bool:
+        """Abre el índice guardado con memory-mapping; si no hay o es de otra versión empieza vacío"""
+        ruta = os.path.join(self.directorio, ARCHIVO_METADATOS)
+        try:
+            # Con el lock, los vectores que referencian los metadatos no se borran mientras se abren
+            with bloqueo_entre_procesos(os.path.join(self.directorio, ARCHIVO_LOCK)):
+                with open(ruta, encoding="utf-8") as f:
+                    metadatos = json.load(f)
+                if metadatos.get("version") != VERSION_VECTORES or metadatos.get("dimension") != self.dimension:
+                    print("🧭 Índice semántico de otra versión, se reconstruye")
+                    return False
+                vectores = np.load(os.path.join(self.directorio, metadatos["archivo"]), mmap_mode='r')
+        except (FileNotFoundError, json.JSONDecodeError, KeyError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f"⚠️ No se pudo leer el índice semántico, se reconstruye: {e}")
+            return False
+        ids = metadatos["ids"]
+        if len(ids) != len(vectores):
+            print("⚠️ Índice semántico inconsistente, se reconstruye")
+            return False
+        self._vectores = vectores
+        self._ids = np.asarray(ids, dtype=np.int64)
+        self._cantidad = len(ids)
+        self._filas = {producto_id: fila for fila, producto_id in enumerate(ids)}
+        self._nombres = dict(zip(ids, metadatos["nombres"]))
+        self.cambios_sin_guardar = 0
+        print(f"🧭 Índice semántico cargado: {self._cantidad} productos")
+        return True
+
+    def _borrar_vectores_viejos(self, actual: str):
+        for archivo in os.listdir(self.directorio):
+            if archivo.startswith("vectores-") and archivo.endswith(".npy") and archivo != actual:
+                try:
+                    os.unlink(os.path.join(self.directorio, archivo))
+                except OSError:
+                    pass
@@ -0,0 +1,301 @@
+"""
+Post-procesamiento de respuestas de Textract: reconstruye filas y columnas de la factura a partir
+de las tablas (AnalyzeDocument con TABLES) o, si no las hay, de la geometría de las palabras
+(DetectDocumentText). Las filas de una tabla con encabezado se convierten directo en productos.
+
+Uso offline con una respuesta grabada (JSON de Textract o una entrada de data/cache/textract):
+    python layout_textract.py respuesta.json
+
+Verificación contra las respuestas grabadas de fixtures/textract (cada <nombre>.json con su
+<nombre>.esperado.json: origen y productos [nombre, cantidad, precio]):
+    python layout_textract.py --verificar
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from modelos import ProductDetected
+from parser_facturas import limpiar_descripcion, parsear_numero
+from repositorio_stock import normalizar_nombre
+
+# Columnas reconocibles en el encabezado de una tabla de productos (palabras normalizadas)
+ROLES_ENCABEZADO = [
+    ('codigo', {'codigo', 'cod', 'sku', 'ean'}),
+    ('precio', {'unitario', 'unit', 'punit', 'pu'}),
+    ('cantidad', {'cantidad', 'cant', 'unidades', 'uds', 'un'}),
+    ('importe', {'importe', 'total', 'subtotal', 'monto', 'neto'}),
+    ('precio', {'precio'}),
+    ('descripcion', {'descripcion', 'producto', 'articulo', 'detalle', 'concepto', 'item'}),
+]
+_FIN_DE_TABLA = {'total', 'subtotal', 'iva', 'neto', 'percepcion', 'percepciones'}
+
+CONFIANZA_TABLA = 95
+CONFIANZA_GEOMETRIA = 90
+
+
+@dataclass
+class Celda:
+    texto: str
+    izquierda: float = 0.0
+    derecha: float = 0.0
+
+    @property
+    def centro(self) -> float:
+        return (self.izquierda + self.derecha) / 2
+
+
+@dataclass
+class AnalisisLayout:
+    """
+    texto: una línea por fila reconstruida (celdas separadas por dos espacios)
+    productos: los que salieron de una tabla con encabezado reconocido
+    lineas_dudosas: filas de esa tabla que no se pudieron interpretar
+    """
+    texto: str
+    productos: List[ProductDetected] = field(default_factory=list)
+    lineas_dudosas: List[str] = field(default_factory=list)
+    origen: str = 'lineas'
+
+
+# --- Tablas (AnalyzeDocument con FeatureTypes=['TABLES']) ---
+
+def tablas_textract(response: dict) -> List[List[List[str]]]:
+    """Cada TABLE como grilla de textos [fila][columna], usando RowIndex/ColumnIndex de las celdas"""
+    bloques = {bloque['Id']: bloque for bloque in response.get('Blocks', []) if 'Id' in bloque}
+    tablas = []
+    for bloque in response.get('Blocks', []):
+        if bloque['BlockType'] != 'TABLE':
+            continue
+        celdas = [bloques[i] for i in _hijos(bloque) if bloques.get(i, {}).get('BlockType') == 'CELL']
+        if not celdas:
+            continue
+        filas = max(c['RowIndex'] for c in celdas)
+        columnas = max(c['ColumnIndex'] for c in celdas)
+        grilla = [[''] * columnas for _ in range(filas)]
+        for celda in celdas:
+            palabras = [bloques[i]['Text'] for i in _hijos(celda) if bloques.get(i, {}).get('BlockType') == 'WORD']
+            grilla[celda['RowIndex'] - 1][celda['ColumnIndex'] - 1] = ' '.join(palabras)
+        tablas.append(grilla)
+    return tablas
+
+
+def _hijos(bloque: dict) -> List[str]:
+    return [i for relacion in bloque.get('Relationships', []) if relacion['Type'] == 'CHILD' for i in relacion['Ids']]
+
+
+# --- Geometría (DetectDocumentText) ---
+
+def filas_por_geometria(response: dict) -> List[List[Celda]]:
+    """
+    Agrupa las palabras en filas por su centro vertical y, dentro de cada fila, en celdas
+    separadas por huecos horizontales grandes. Textract a veces parte una fila de la factura en
+    varias LINE (descripción por un lado, cantidad y precio por otro); acá vuelven a quedar juntas
+    """
+    tipo = 'WORD' if any(b['BlockType'] == 'WORD' for b in response.get('Blocks', [])) else 'LINE'
+    palabras = [b for b in response.get('Blocks', []) if b['BlockType'] == tipo and 'Geometry' in b]
+    if not palabras:
+        return []
+
+    altura = statistics.median(p['Geometry']['BoundingBox']['Height'] for p in palabras) or 0.01
+    palabras.sort(key=lambda p: (p.get('Page', 1), _centro_vertical(p)))
+
+    filas: List[List[dict]] = []
+    centro_fila = None
+    pagina_fila = None
+    for palabra in palabras:
+        centro = _centro_vertical(palabra)
+        if filas and palabra.get('Page', 1) == pagina_fila and abs(centro - centro_fila) <= altura * 0.5:
+            filas[-1].append(palabra)
+            # Centro promedio de la fila, para tolerar palabras levemente desalineadas
+            centro_fila += (centro - centro_fila) / len(filas[-1])
+        else:
+            filas.append([palabra])
+            centro_fila, pagina_fila = centro, palabra.get('Page', 1)
+
+    resultado = []
+    for fila in filas:
+        fila.sort(key=lambda p: p['Geometry']['BoundingBox']['Left'])
+        celdas: List[Celda] = []
+        for palabra in fila:
+            caja = palabra['Geometry']['BoundingBox']
+            izquierda, derecha = caja['Left'], caja['Left'] + caja['Width']
+            if celdas and izquierda - celdas[-1].derecha <= altura * 1.2:
+                celdas[-1].texto += ' ' + palabra['Text']
+                celdas[-1].derecha = derecha
+            else:
+                celdas.append(Celda(palabra['Text'], izquierda, derecha))
+        resultado.append(celdas)
+    return resultado
+
+
+def _centro_vertical(bloque: dict) -> float:
+    caja = bloque['Geometry']['BoundingBox']
+    return caja['Top'] + caja['Height'] / 2
+
+
+def grilla_desde_filas(filas: List[List[Celda]]) -> Optional[List[List[str]]]:
+    """
+    Busca una fila de encabezado y alinea las filas siguientes a sus columnas por posición horizontal
+    """
+    for indice, fila in enumerate(filas):
+        if _roles_encabezado([c.texto for c in fila]) is None:
+            continue
+        columnas = fila
+        grilla = [[c.texto for c in columnas]]
+        for siguiente in filas[indice + 1:]:
+            textos = [''] * len(columnas)
+            for celda in siguiente:
+                # Columna del encabezado más cercana al centro de la celda
+                columna = min(range(len(columnas)), key=lambda i: abs(columnas[i].centro - celda.centro))
+                textos[columna] = f"{textos[columna]} {celda.texto}".strip()
+            grilla.append(textos)
+        return grilla
+    return None
+
+
+# --- Tabla → productos ---
+
+def _roles_encabezado(encabezado: List[str]) -> Optional[Dict[str, int]]:
+    """Rol de cada columna (descripcion, cantidad, precio, importe, codigo) si parece un encabezado de productos"""
+    roles: Dict[str, int] = {}
+    for columna, texto in enumerate(encabezado):
+        palabras = set(normalizar_nombre(texto).split())
+        for rol, claves in ROLES_ENCABEZADO:
+            if palabras & claves and rol not in roles:
+                roles[rol] = columna
+                break
+    if 'descripcion' in roles and 'cantidad' in roles and ('precio' in roles or 'importe' in roles):
+        return roles
+    return None
+
+
+def productos_de_grilla(grilla: List[List[str]], confianza: float):
+    """
+    Convierte una grilla [encabezado, filas...] en productos. Corta en la primera fila de totales.
+    Devuelve (productos, filas que no se pudieron interpretar)
+    """
+    productos: List[ProductDetected] = []
+    dudosas: List[str] = []
+    roles = _roles_encabezado(grilla[0]) if grilla else None
+    if roles is None:
+        return productos, dudosas
+
+    for fila in grilla[1:]:
+        if not any(fila):
+            continue
+        primera = normalizar_nombre(next(texto for texto in fila if texto)).split()
+        if primera and primera[0] in _FIN_DE_TABLA:
+            break
+
+        descripcion = limpiar_descripcion(fila[roles['descripcion']])
+        cantidad = parsear_numero(fila[roles['cantidad']])
+        precio = parsear_numero(fila[roles['precio']]) if 'precio' in roles else None
+        importe = parsear_numero(fila[roles['importe']]) if 'importe' in roles else None
+        if precio is None and importe is not None and cantidad:
+            precio = importe / cantidad
+
+        if not descripcion or not cantidad or cantidad != int(cantidad) or not precio:
+            # Sin ningún número es un título o texto al pie, no un producto a medio leer
+            if any(caracter.isdigit() for texto in fila for caracter in texto):
+                dudosas.append('  '.join(texto for texto in fila if texto))
+            continue
+        productos.append(ProductDetected(
+            nombre=descripcion,
+            cantidad=int(cantidad),
+            precio_sin_impuestos=round(precio, 2),
+            confianza=confianza
+        ))
+    return productos, dudosas
+
+
+def analizar_respuesta(response: dict) -> AnalisisLayout:
+    """
+    Texto por filas reconstruidas y, si la factura tiene una tabla de productos reconocible,
+    los productos ya interpretados (primero TABLES, después geometría)
+    """
+    filas = filas_por_geometria(response)
+    if filas:
+        texto = '\n'.join('  '.join(celda.texto for celda in fila) for fila in filas)
+    else:
+        texto = '\n'.join(b['Text'] for b in response.get('Blocks', []) if b['BlockType'] == 'LINE')
+
+    for grilla in tablas_textract(response):
+        productos, dudosas = productos_de_grilla(grilla, CONFIANZA_TABLA)
+        if productos:
+            return AnalisisLayout(texto, productos, dudosas, origen='tablas')
+
+    grilla = grilla_desde_filas(filas)
+    if grilla:
+        productos, dudosas = productos_de_grilla(grilla, CONFIANZA_GEOMETRIA)
+        if productos:
+            return AnalisisLayout(texto, productos, dudosas, origen='geometria')
+
+    return AnalisisLayout(texto)
+
+
+DIRECTORIO_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'textract')
+
+
+def _leer_respuesta(ruta: str) -> dict:
+    with open(ruta, 'r', encoding='utf-8') as f:
+        response = json.load(f)
+    # Las entradas de la cache de resultados guardan la respuesta dentro de 'valor'
+    return response.get('valor', response)
+
+
+def verificar_fixtures(directorio: str = DIRECTORIO_FIXTURES) -> bool:
+    """Compara los productos reconstruidos de cada respuesta grabada con los esperados; True si todos coinciden"""
+    todo_bien = True
+    esperados = sorted(glob.glob(os.path.join(directorio, '*.esperado.json')))
+    for ruta_esperado in esperados:
+        ruta = ruta_esperado[:-len('.esperado.json')] + '.json'
+        with open(ruta_esperado, 'r', encoding='utf-8') as f:
+            esperado = json.load(f)
+        analisis = analizar_respuesta(_leer_respuesta(ruta))
+        obtenido = {
+            "origen": analisis.origen,
+            "productos": [[p.nombre, p.cantidad, p.precio_sin_impuestos] for p in analisis.productos],
+        }
+        if obtenido == esperado:
+            print(f"✅ {os.path.basename(ruta)}: {len(analisis.productos)} productos ({analisis.origen})")
+            continue
+        todo_bien = False
+        print(f"❌ {os.path.basename(ruta)}")
+        print(f"   esperado: {esperado}")
+        print(f"   obtenido: {obtenido}")
+    if not esperados:
+        print(f"No hay respuestas grabadas en {directorio}")
+        return False
+    return todo_bien
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconstruye filas y productos de una respuesta grabada de Textract")
+    parser.add_argument("respuesta", nargs="?", help="JSON de Textract (o entrada de data/cache/textract)")
+    parser.add_argument("--verificar", nargs="?", const=DIRECTORIO_FIXTURES, metavar="DIRECTORIO",
+                        help="Verifica las respuestas grabadas contra sus .esperado.json (por defecto fixtures/textract)")
+    args = parser.parse_args()
+    if args.verificar:
+        sys.exit(0 if verificar_fixtures(args.verificar) else 1)
+    if not args.respuesta:
+        parser.error("falta la respuesta a analizar (o --verificar)")
+
+    analisis = analizar_respuesta(_leer_respuesta(args.respuesta))
+    print("=== Filas ===")
+    print(analisis.texto)
+    print(f"\n=== Productos ({analisis.origen}) ===")
+    for producto in analisis.productos:
+        print(f"- {producto.nombre} | cantidad {producto.cantidad} | precio {producto.precio_sin_impuestos}")
+    if analisis.lineas_dudosas:
+        print("\n=== Filas sin interpretar (irían al LLM) ===")
+        for linea in analisis.lineas_dudosas:
+            print(f"- {linea}")
+
+
+if __name__ == "__main__":
+    main()
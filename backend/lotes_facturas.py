@@ -0,0 +1,190 @@
+import asyncio
+import json
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+import zipfile
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+# Función de una etapa: recibe el contexto de la factura (dict) y le agrega su resultado
+FuncionEtapa = Callable[[dict], Awaitable[None]]
+
+
+def extraer_imagenes_zip(ruta_zip: str, directorio: str) -> List[Tuple[str, str]]:
+    """
+    Extrae a disco cada imagen de un zip, ignorando carpetas y metadatos de macOS.
+    Devuelve (nombre, ruta) por imagen; las entradas se copian por bloques, sin cargarlas en memoria
+    """
+    imagenes = []
+    with zipfile.ZipFile(ruta_zip) as archivo_zip:
+        for info in archivo_zip.infolist():
+            if info.is_dir() or info.filename.startswith('__MACOSX/'):
+                continue
+            tipo, _ = mimetypes.guess_type(info.filename)
+            if tipo and tipo.startswith('image/'):
+                fd, ruta = tempfile.mkstemp(dir=directorio, suffix=os.path.splitext(info.filename)[1])
+                with os.fdopen(fd, 'wb') as destino, archivo_zip.open(info) as origen:
+                    shutil.copyfileobj(origen, destino, 1024 * 1024)
+                imagenes.append((info.filename, ruta))
+    return imagenes
+
+
+class LoteFacturas:
+    """
+    Estado de un lote: una entrada por factura con la etapa en la que está y su resultado
+    """
+
+    def __init__(self, lote_id: str, nombres: List[str]):
+        self.id = lote_id
+        self.creado = time.time()
+        self.actualizado = self.creado
+        self.facturas = [
+            {"indice": i, "archivo": nombre, "estado": "pendiente", "etapa": None, "error": None, "resultado": None}
+            for i, nombre in enumerate(nombres)
+        ]
+
+    @property
+    def terminado(self) -> bool:
+        return all(f["estado"] in ("completada", "error") for f in self.facturas)
+
+    def actualizar(self, indice: int, **campos):
+        self.facturas[indice].update(campos)
+        self.actualizado = time.time()
+
+    def a_dict(self) -> dict:
+        conteo: Dict[str, int] = {}
+        etapas: Dict[str, Dict[str, int]] = {}
+        for factura in self.facturas:
+            conteo[factura["estado"]] = conteo.get(factura["estado"], 0) + 1
+            if factura["estado"] in ("en_cola", "procesando"):
+                por_estado = etapas.setdefault(factura["etapa"], {"en_cola": 0, "procesando": 0})
+                por_estado[factura["estado"]] += 1
+        return {
+            "lote_id": self.id,
+            "estado": "completado" if self.terminado else "en_proceso",
+            "total": len(self.facturas),
+            "completadas": conteo.get("completada", 0),
+            "errores": conteo.get("error", 0),
+            "etapas": etapas,
+            "creado": self.creado,
+            "actualizado": self.actualizado,
+            "facturas": self.facturas,
+        }
+
+
+class PipelineFacturas:
+    """
+    Procesa lotes de facturas como un pipeline de etapas (Textract → proveedor → LLM → matching).
+    Cada factura avanza por las etapas en orden, pero las facturas corren en paralelo: mientras una
+    está en el LLM otra ya está en Textract. Cada etapa tiene su propio límite de concurrencia,
+    compartido por todos los lotes del worker, así el throughput lo marcan los límites de las APIs.
+
+    El estado de cada lote se guarda en `directorio/<lote_id>.json` para que cualquier worker
+    pueda responder el progreso. Las imágenes esperan en disco (`directorio_subidas`) y cada
+    factura arranca con el contexto {"ruta": ...}; el archivo se borra al terminar el lote.
+    """
+
+    def __init__(self, etapas: List[Tuple[str, FuncionEtapa, int]], directorio: str,
+                 intervalo_guardado: float = 0.5):
+        self.etapas = etapas
+        self.directorio = directorio
+        self.intervalo_guardado = intervalo_guardado
+        self._lotes: Dict[str, LoteFacturas] = {}
+        self._tareas = set()
+        self._semaforos: Dict[str, asyncio.Semaphore] = {}
+        self._loop = None
+        self.directorio_subidas = os.path.join(directorio, 'subidas')
+        os.makedirs(self.directorio_subidas, exist_ok=True)
+
+    def _semaforo(self, etapa: str, limite: int) -> asyncio.Semaphore:
+        # Los semáforos quedan atados al event loop en el que se crean
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._semaforos = {}
+        if etapa not in self._semaforos:
+            self._semaforos[etapa] = asyncio.Semaphore(limite)
+        return self._semaforos[etapa]
+
+    def iniciar(self, archivos: List[Tuple[str, str]]) -> LoteFacturas:
+        """Crea el lote con los archivos (nombre, ruta) y lo procesa en segundo plano. Devuelve enseguida"""
+        lote = LoteFacturas(uuid.uuid4().hex, [nombre for nombre, _ in archivos])
+        self._lotes[lote.id] = lote
+        self._guardar(lote)
+
+        tarea = asyncio.create_task(self._procesar_lote(lote, [ruta for _, ruta in archivos]))
+        # Referencia fuerte para que la tarea no sea recolectada antes de terminar
+        self._tareas.add(tarea)
+        tarea.add_done_callback(self._tareas.discard)
+        return lote
+
+    def obtener(self, lote_id: str) -> Optional[dict]:
+        if not re.fullmatch(r'[0-9a-f]{32}', lote_id):
+            return None
+        lote = self._lotes.get(lote_id)
+        if lote is not None:
+            return lote.a_dict()
+        # El lote puede haberse iniciado en otro worker
+        try:
+            with open(self._ruta(lote_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    async def _procesar_lote(self, lote: LoteFacturas, rutas: List[str]):
+        print(f"📦 Lote {lote.id}: {len(rutas)} facturas")
+        guardado = asyncio.create_task(self._guardar_periodicamente(lote))
+        try:
+            await asyncio.gather(*(
+                self._procesar_factura(lote, indice, {"ruta": ruta})
+                for indice, ruta in enumerate(rutas)
+            ))
+        finally:
+            guardado.cancel()
+            for ruta in rutas:
+                if os.path.exists(ruta):
+                    os.unlink(ruta)
+            self._guardar(lote)
+            # Los lotes terminados se sirven desde disco
+            self._lotes.pop(lote.id, None)
+        resumen = lote.a_dict()
+        print(f"✅ Lote {lote.id}: {resumen['completadas']} completadas, {resumen['errores']} con error")
+
+    async def _procesar_factura(self, lote: LoteFacturas, indice: int, contexto: dict):
+        for nombre, funcion, limite in self.etapas:
+            lote.actualizar(indice, etapa=nombre, estado="en_cola")
+            try:
+                async with self._semaforo(nombre, limite):
+                    lote.actualizar(indice, estado="procesando")
+                    await funcion(contexto)
+            except Exception as e:
+                print(f"Error en lote {lote.id}, factura {indice} ({nombre}): {e}")
+                lote.actualizar(indice, estado="error", error=f"{nombre}: {e}")
+                return
+        lote.actualizar(indice, etapa=None, estado="completada", resultado=contexto.get("resultado"))
+
+    async def _guardar_periodicamente(self, lote: LoteFacturas):
+        ultimo = lote.actualizado
+        while True:
+            await asyncio.sleep(self.intervalo_guardado)
+            if lote.actualizado != ultimo:
+                ultimo = lote.actualizado
+                self._guardar(lote)
+
+    def _ruta(self, lote_id: str) -> str:
+        return os.path.join(self.directorio, f"{lote_id}.json")
+
+    def _guardar(self, lote: LoteFacturas):
+        fd, ruta_tmp = tempfile.mkstemp(dir=self.directorio, prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(lote.a_dict(), f, ensure_ascii=False, default=str)
+            os.replace(ruta_tmp, self._ruta(lote.id))
+        except OSError as e:
+            print(f"No se pudo guardar el estado del lote {lote.id}: {e}")
+            if os.path.exists(ruta_tmp):
+                os.unlink(ruta_tmp)
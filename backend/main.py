@@ -1,19 +1,52 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import json
 import base64
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 import os
 from pydantic import BaseModel
 import openai
 from dotenv import load_dotenv
 import re
-from datetime import datetime
+from datetime import date, datetime, timedelta
 import tempfile
 import shutil
+import zipfile
+import asyncio
+import threading
+import functools
+import itertools
+import math
+from concurrent.futures import ThreadPoolExecutor
+from modelos import Proveedor, ProductoStock, ProductDetected, ResumenFactura, OCRResponse
+from almacenamiento import crear_repositorio_stock
+from repositorio_stock import ConflictoVersion
+from cache_resultados import CacheResultados, clave_hash
+from matcher_productos import MatcherProductos, ResultadoMatch
+from indice_semantico import IndiceSemantico
+from vista_stock import ConsultaStock, VistaStock, dumps_json
+from historial_movimientos import FORMATOS_PERIODO, HistorialMovimientos
+from pronostico_demanda import PronosticoDemanda
+from ajustes_stock import SimulacionAjustes, aplicar_ajustes, formato_de, leer_filas
+from archivos_stock import (TIPOS_CONTENIDO, exportar_csv, exportar_xlsx, formato_de_archivo, importar_lista_precios,
+                            leer_lista_precios)
+from detector_proveedores import DetectorProveedores
+from parser_facturas import ParserFacturas
+from layout_textract import AnalisisLayout, analizar_respuesta
+from respuestas_llm import (ExtraccionLote, ExtraccionProductos, MatchingStock, MatchingTexto, MatchingTextoLote,
+                            completar_estructurado, extraer_json)
+from agrupador_llm import AgrupadorSolicitudes
+from presupuesto_tokens import (RegistroTokens, agrupar_por_presupuesto, contar_tokens, contar_tokens_mensajes,
+                                dividir_texto, max_tokens_respuesta, recortar_a_presupuesto)
+from lotes_facturas import PipelineFacturas, extraer_imagenes_zip
+from cola_trabajos import ColaTrabajos, ErrorPermanente
+from clientes_externos import (ClienteExterno, LimitadorTasa, RegistroClientes, ServicioDegradado,
+                               error_transitorio_aws, error_transitorio_openai)
 
 # Cargar variables de entorno
 load_dotenv()
@@ -52,6 +85,15 @@ print(f"AWS_ACCESS_KEY_ID: {'Configured' if aws_access_key else 'Missing'}")
 print(f"AWS_SECRET_ACCESS_KEY: {'Configured' if aws_secret_key else 'Missing'}")
 print(f"OPENAI_API_KEY: {'Configured' if OPENAI_API_KEY else 'Missing'}")
 
+# Directorio de datos (configurable para correr varias instancias o benchmarks)
+DATA_DIR = os.getenv("STOCKAI_DATA_DIR", "data")
+
+# boto3 es síncrono: las llamadas a Textract corren en un pool acotado para no bloquear el event loop
+TEXTRACT_MAX_CONCURRENCIA = int(os.getenv("TEXTRACT_MAX_CONCURRENCIA", "8"))
+executor_textract = ThreadPoolExecutor(max_workers=TEXTRACT_MAX_CONCURRENCIA, thread_name_prefix="textract")
+# AnalyzeDocument con TABLES devuelve la tabla de productos ya armada, pero cuesta más por página
+TEXTRACT_TABLAS = os.getenv("TEXTRACT_TABLAS", "0") == "1"
+
 # Configuración de AWS Textract (solo si las credenciales están disponibles)
 textract_client = None
 if aws_access_key and aws_secret_key:
@@ -59,161 +101,345 @@ if aws_access_key and aws_secret_key:
         'textract',
         region_name=os.getenv('AWS_REGION', 'us-east-1'),
         aws_access_key_id=aws_access_key,
-        aws_secret_access_key=aws_secret_key
+        aws_secret_access_key=aws_secret_key,
+        # Los reintentos los hace la capa de clientes externos (backoff + circuit breaker), no boto3
+        config=Config(max_pool_connections=TEXTRACT_MAX_CONCURRENCIA, retries={'max_attempts': 1, 'mode': 'standard'})
     )
 
-# Configuración de OpenAI (solo si la API key está disponible)
-openai_client = openai.OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
-
-# Definir modelos primero
-class Proveedor(BaseModel):
-    id: int
-    nombre: str
-    impuesto: float
-    telefono: str
-    cuit: str = None
-    email: str = None
-    direccion: str = None
-
-class ProductoStock(BaseModel):
-    id: int
-    nombre: str
-    stock: int
-    stock_minimo: int
-    precio_base: float
-    categoria: str
-    codigo: str
-    proveedor_id: int
-    ultima_actualizacion: str
-
-class ProductDetected(BaseModel):
-    nombre: str
-    cantidad: int
-    precio_sin_impuestos: float = None
-    precio_con_impuestos: float = None
-    confianza: float
-
-class ResumenFactura(BaseModel):
-    subtotal: float
-    impuestos: float
-    total: float
-
-class OCRResponse(BaseModel):
-    productos: List[ProductDetected]
-    proveedor: Proveedor = None
-    resumen: ResumenFactura = None
-    texto_completo: str
-    success: bool
-
-# Funciones para manejar datos JSON
-def cargar_proveedores() -> List[Proveedor]:
+# Configuración de OpenAI (solo si la API key está disponible).
+# Cliente asíncrono: un worker puede tener muchas llamadas a OpenAI en vuelo a la vez
+# (sin reintentos propios: los hace la capa de clientes externos)
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT_SEGUNDOS", "60"))
+openai_client = openai.AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0, timeout=OPENAI_TIMEOUT) if OPENAI_API_KEY else None
+MODELO_CHAT = os.getenv("OPENAI_MODELO", "gpt-3.5-turbo")
+
+# Presupuesto de tokens para los datos variables de cada prompt (texto de la factura, inventario,
+# candidatos). Las instrucciones son fijas, así el tamaño de cada request no crece con el catálogo:
+# las facturas largas se parten en fragmentos que se procesan en paralelo
+LLM_PRESUPUESTO_DATOS = int(os.getenv("LLM_PRESUPUESTO_DATOS", "2000"))
+
+# Agrupación de pedidos al LLM: los textos que llegan dentro de la ventana (hasta
+# LLM_MAX_TEXTOS_POR_REQUEST y el presupuesto de tokens) van en un solo request.
+# Los lotes y la cola de trabajos no tienen a nadie esperando y usan una ventana más larga
+LLM_VENTANA_AGRUPACION = float(os.getenv("LLM_VENTANA_AGRUPACION_MS", "50")) / 1000
+LLM_VENTANA_AGRUPACION_DIFERIDA = float(os.getenv("LLM_VENTANA_AGRUPACION_DIFERIDA_MS", "1000")) / 1000
+LLM_MAX_TEXTOS_POR_REQUEST = int(os.getenv("LLM_MAX_TEXTOS_POR_REQUEST", "8"))
+registro_tokens = RegistroTokens()
+
+# Llamadas salientes (ver clientes_externos.py): límite de tasa por modelo o endpoint, reintentos con
+# backoff y jitter, y circuit breaker. Si el servicio no responde se devuelve 503 "degradado".
+# Los límites son por worker: con varios workers hay que repartir la cuota de la cuenta
+OPENAI_LIMITE_RPM = float(os.getenv("OPENAI_LIMITE_RPM", "3000"))
+OPENAI_LIMITE_TPM = float(os.getenv("OPENAI_LIMITE_TPM", "250000"))
+TEXTRACT_LIMITE_TPS = float(os.getenv("TEXTRACT_LIMITE_TPS", "10"))
+_config_clientes = dict(
+    max_reintentos=int(os.getenv("EXTERNOS_MAX_REINTENTOS", "3")),
+    umbral_fallas=int(os.getenv("EXTERNOS_UMBRAL_FALLAS", "5")),
+    tiempo_abierto=float(os.getenv("EXTERNOS_CIRCUITO_ABIERTO_SEGUNDOS", "30")),
+    espera_max=float(os.getenv("EXTERNOS_ESPERA_MAX_SEGUNDOS", "10"))
+)
+clientes_externos = RegistroClientes()
+
+def _cliente_openai(nombre: str) -> ClienteExterno:
+    # Requests y tokens por minuto, con ráfagas de hasta 10 segundos de cuota
+    return ClienteExterno(
+        nombre, error_transitorio_openai,
+        LimitadorTasa(OPENAI_LIMITE_RPM / 60, OPENAI_LIMITE_RPM / 6),
+        LimitadorTasa(OPENAI_LIMITE_TPM / 60, OPENAI_LIMITE_TPM / 6),
+        **_config_clientes
+    )
+
+def _cliente_textract(nombre: str) -> ClienteExterno:
+    return ClienteExterno(nombre, error_transitorio_aws, LimitadorTasa(TEXTRACT_LIMITE_TPS), **_config_clientes)
+
+# Cache por contenido de resultados de Textract y OpenAI (memoria LRU + disco, con TTL)
+CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(DATA_DIR, "cache"))
+CACHE_HABILITADA = os.getenv("CACHE_RESULTADOS", "1") != "0"
+_config_cache = dict(
+    max_entradas_memoria=int(os.getenv("CACHE_MAX_ENTRADAS", "256")),
+    max_bytes_disco=int(float(os.getenv("CACHE_MAX_MB", "200")) * 1024 * 1024),
+    ttl_segundos=float(os.getenv("CACHE_TTL_HORAS", "168")) * 3600
+)
+cache_textract = CacheResultados("textract", CACHE_DIR, **_config_cache)
+cache_llm = CacheResultados("llm", CACHE_DIR, **_config_cache)
+
+async def ejecutar_en_pool_textract(funcion, *args, **kwargs):
+    """
+    Ejecuta una llamada bloqueante de boto3 en el pool de Textract sin bloquear el event loop
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor_textract, functools.partial(funcion, *args, **kwargs))
+
+async def detectar_texto_textract(image_bytes: bytes) -> dict:
+    """
+    Llama a Textract detect_document_text (o analyze_document con TABLES si TEXTRACT_TABLAS=1)
+    con cache por hash de la imagen: re-subir la misma factura no vuelve a pagar el OCR.
+    Si Textract no está disponible lanza ServicioDegradado
+    """
+    operacion = "analyze_document_tables" if TEXTRACT_TABLAS else "detect_document_text"
+    clave = clave_hash(operacion, image_bytes)
+    if CACHE_HABILITADA:
+        respuesta = cache_textract.obtener(clave)
+        if respuesta is not None:
+            print("⚡ Textract desde cache")
+            return respuesta
+
+    cliente = clientes_externos.obtener(f"textract:{operacion}", _cliente_textract)
+    if TEXTRACT_TABLAS:
+        respuesta = await cliente.llamar(lambda: ejecutar_en_pool_textract(
+            textract_client.analyze_document,
+            Document={'Bytes': image_bytes},
+            FeatureTypes=['TABLES']
+        ))
+    else:
+        respuesta = await cliente.llamar(lambda: ejecutar_en_pool_textract(
+            textract_client.detect_document_text,
+            Document={'Bytes': image_bytes}
+        ))
+    respuesta.pop('ResponseMetadata', None)
+    if CACHE_HABILITADA:
+        cache_textract.guardar(clave, respuesta)
+    return respuesta
+
+async def completar_chat(operacion: str, **parametros) -> str:
+    """
+    Llama a chat.completions de OpenAI y devuelve el texto de la respuesta.
+    El resultado se cachea por hash de prompt + modelo + temperatura (y demás parámetros).
+    Los tokens de entrada y salida se registran por `operacion`. Si la respuesta es una llamada a
+    herramienta (salida estructurada, ver respuestas_llm.py) se devuelven sus argumentos.
+    Si OpenAI no está disponible lanza ServicioDegradado
+    """
+    clave = clave_hash("chat.completions", parametros)
+    if CACHE_HABILITADA:
+        content = cache_llm.obtener(clave)
+        if content is not None:
+            print(f"⚡ Respuesta de {parametros.get('model')} desde cache")
+            registro_tokens.registrar(operacion, parametros['model'], 0, 0, desde_cache=True)
+            return content
+
+    tokens_prompt = contar_tokens_mensajes(parametros['messages'], parametros['model'])
+    cliente = clientes_externos.obtener(f"openai:chat:{parametros['model']}", _cliente_openai)
+    response = await cliente.llamar(
+        lambda: openai_client.chat.completions.create(**parametros),
+        costo=tokens_prompt + parametros.get('max_tokens', 0)
+    )
+    mensaje = response.choices[0].message
+    llamadas_herramienta = getattr(mensaje, 'tool_calls', None)
+    content = (llamadas_herramienta[0].function.arguments if llamadas_herramienta else mensaje.content or '').strip()
+    uso = getattr(response, 'usage', None)
+    registro_tokens.registrar(
+        operacion, parametros['model'],
+        uso.prompt_tokens if uso else tokens_prompt,
+        uso.completion_tokens if uso else contar_tokens(content, parametros['model']),
+        max_tokens=parametros.get('max_tokens')
+    )
+    # Solo se cachean respuestas que son JSON válido, para no repetir una respuesta rota
+    if CACHE_HABILITADA and _es_json_valido(content):
+        cache_llm.guardar(clave, content)
+    return content
+
+def _es_json_valido(content: str) -> bool:
     try:
-        with open('data/proveedores.json', 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            return [Proveedor(**item) for item in data]
-    except FileNotFoundError:
-        return []
+        extraer_json(content)
+        return True
+    except ValueError:
+        return False
+
+# Almacenamiento de stock y proveedores: 'json' (stock.json + journal, por defecto) o 'sqlite'.
+# En JSON el stock vive en memoria indexado y los cambios van a un journal append-only
+# que se compacta cada STOCKAI_COMPACTAR_CADA registros
+repositorio_stock = crear_repositorio_stock(
+    os.getenv("STOCKAI_ALMACENAMIENTO", "json"),
+    DATA_DIR,
+    compactar_cada=int(os.getenv("STOCKAI_COMPACTAR_CADA", "1000"))
+)
+
+# Matcher local de productos: resuelve coincidencias exactas y de alta confianza sin llamar al LLM.
+# Se sincroniza con el stock en cada uso, re-indexando solo los productos nuevos o renombrados.
+# El índice semántico (vectores de n-gramas de los nombres, en data/indice_semantico) acota los
+# candidatos en catálogos grandes y se usa en el matching sin OpenAI. Se abre con mmap al arrancar
+# y se guarda cada INDICE_GUARDAR_CADA cambios y al apagar
+indice_semantico = IndiceSemantico(os.path.join(DATA_DIR, "indice_semantico"))
+INDICE_GUARDAR_CADA = int(os.getenv("INDICE_GUARDAR_CADA", "500"))
+matcher_stock = MatcherProductos(indice_semantico)
+# El matcher y el índice semántico no son thread-safe: se sincronizan y consultan en un thread
+# (sincronizar recorre el catálogo), siempre con este lock tomado
+lock_matcher_stock = threading.Lock()
+
+# Stock enriquecido (proveedor y precio con impuestos) en columnas NumPy para GET /api/stock;
+# la tabla y el JSON se recalculan solo cuando cambia la revisión del stock o los proveedores
+vista_stock = VistaStock(repositorio_stock)
+
+# Historial de movimientos de stock con agregados por hora, día y mes para los reportes
+historial_movimientos = HistorialMovimientos(os.path.join(DATA_DIR, "movimientos.db"))
+
+# Pronóstico de demanda sobre las salidas del historial: stock_minimo dinámico y cantidades a reponer.
+# PRONOSTICO_DIAS_ENTREGA es la demora del proveedor; PRONOSTICO_DIAS_COBERTURA, los días que cubre cada pedido
+pronostico_demanda = PronosticoDemanda(
+    historial_movimientos,
+    dias_entrega=int(os.getenv("PRONOSTICO_DIAS_ENTREGA", "7")),
+    dias_cobertura=int(os.getenv("PRONOSTICO_DIAS_COBERTURA", "14"))
+)
+
+# Detector de proveedores (Aho-Corasick sobre nombres, alias y CUITs); se reconstruye si cambian los proveedores
+detector_proveedores = DetectorProveedores()
+
+# Funciones para manejar datos
+def cargar_proveedores() -> List[Proveedor]:
+    return repositorio_stock.listar_proveedores()
 
 def cargar_stock() -> List[ProductoStock]:
-    try:
-        with open('data/stock.json', 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            return [ProductoStock(**item) for item in data]
-    except FileNotFoundError:
-        return []
+    return repositorio_stock.listar()
 
 def guardar_stock(productos: List[ProductoStock]):
     try:
-        data = [producto.model_dump() for producto in productos]
-        with open('data/stock.json', 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        repositorio_stock.reemplazar_todo(productos)
     except Exception as e:
         print(f"Error guardando stock: {e}")
+        raise
 
-def detectar_proveedor(texto_factura: str) -> Proveedor:
-    """Detecta el proveedor basado en el texto de la factura con búsqueda flexible"""
+def detectar_proveedor_con_confianza(texto_factura: str) -> Tuple[Proveedor, float]:
+    """
+    Detecta el proveedor por nombre, alias o CUIT en una sola pasada sobre el texto de la factura.
+    Devuelve el proveedor y la confianza (0..1); sin coincidencias usa el primero con confianza 0
+    """
     proveedores = cargar_proveedores()
-    texto_lower = texto_factura.lower()
-    
-    print(f"🔍 Detectando proveedor en texto: '{texto_factura}'")
-    print(f"📋 Proveedores disponibles: {[p.nombre for p in proveedores]}")
+    detector_proveedores.sincronizar(proveedores)
+    proveedor, confianza, coincidencias = detector_proveedores.detectar(texto_factura)
     
-    # Mapeo específico para cada proveedor
-    mapeos_proveedores = {
-        "HIF HIH Distribuciones": [
-            "h&h", "hih", "hif", "hyf", "h & h", "distribuciones",
-            "h&h distribuciones", "hif hih", "distribuciones h&h"
-        ],
-        "SMALL TASTES": [
-            "small", "tastes", "small tastes"
-        ],
-        "Coca-Cola FEMSA": [
-            "coca", "cola", "coca-cola", "femsa", "coca cola"
-        ],
-        "Distribuidora Central": [
-            "central", "distribuidora", "dist central", "distribuidora central"
-        ]
-    }
+    if proveedor:
+        print(f"✅ Proveedor detectado: {proveedor.nombre} (confianza {confianza}, coincidencias: {coincidencias})")
+        return proveedor, confianza
     
-    # 1. Buscar coincidencias directas por nombre completo
-    for proveedor in proveedores:
-        if proveedor.nombre.lower() in texto_lower:
-            print(f"✅ Proveedor encontrado por nombre completo: {proveedor.nombre}")
-            return proveedor
-        
-        # Buscar por CUIT si está disponible
-        if proveedor.cuit and proveedor.cuit in texto_factura:
-            print(f"✅ Proveedor encontrado por CUIT: {proveedor.nombre}")
-            return proveedor
-    
-    # 2. Buscar usando mapeos específicos
-    mejor_coincidencia = None
-    mejor_score = 0
+    print(f"❌ No se encontró proveedor específico. Usando fallback: {proveedores[0].nombre if proveedores else 'None'}")
+    # Si no se encuentra, devolver el primero como fallback
+    return (proveedores[0] if proveedores else None), 0.0
+
+def detectar_proveedor(texto_factura: str) -> Proveedor:
+    """Detecta el proveedor basado en el texto de la factura"""
+    return detectar_proveedor_con_confianza(texto_factura)[0]
+
+def armar_respuesta_factura(texto_completo: str, proveedor_detectado: Proveedor,
+                            productos_detectados: List[ProductDetected],
+                            confianza_proveedor: float = None) -> OCRResponse:
+    """
+    Calcula precios con impuestos y el resumen de la factura según el proveedor
+    """
+    # Calcular impuestos y resumen
+    productos_con_impuestos = []
+    subtotal = 0
     
-    for proveedor in proveedores:
-        palabras_clave = mapeos_proveedores.get(proveedor.nombre, [])
-        score = 0
-        coincidencias_encontradas = []
-        
-        for palabra_clave in palabras_clave:
-            if palabra_clave.lower() in texto_lower:
-                score += len(palabra_clave)  # Dar más peso a palabras más largas
-                coincidencias_encontradas.append(palabra_clave)
-        
-        print(f"🎯 {proveedor.nombre}: score={score}, coincidencias={coincidencias_encontradas}")
+    for producto in productos_detectados:
+        if producto.precio_sin_impuestos:
+            impuesto_porcentaje = proveedor_detectado.impuesto if proveedor_detectado else 21
+            precio_con_impuestos = producto.precio_sin_impuestos * (1 + impuesto_porcentaje / 100)
+            
+            producto.precio_con_impuestos = round(precio_con_impuestos, 2)
+            subtotal += producto.precio_sin_impuestos * producto.cantidad
         
-        if score > mejor_score:
-            mejor_score = score
-            mejor_coincidencia = proveedor
+        productos_con_impuestos.append(producto)
     
-    if mejor_coincidencia and mejor_score > 0:
-        print(f"✅ Proveedor encontrado por mapeo: {mejor_coincidencia.nombre} (score: {mejor_score})")
-        return mejor_coincidencia
+    # Calcular resumen
+    impuesto_porcentaje = proveedor_detectado.impuesto if proveedor_detectado else 21
+    impuestos_total = subtotal * (impuesto_porcentaje / 100)
+    total = subtotal + impuestos_total
     
-    # 3. Búsqueda fuzzy por palabras individuales
-    for proveedor in proveedores:
-        palabras_proveedor = proveedor.nombre.lower().split()
-        palabras_texto = texto_lower.split()
-        
-        coincidencias = 0
-        for palabra_prov in palabras_proveedor:
-            if len(palabra_prov) > 2:  # Ignorar palabras muy cortas
-                for palabra_texto in palabras_texto:
-                    # Verificar si las palabras son similares
-                    if (palabra_prov in palabra_texto or palabra_texto in palabra_prov or
-                        abs(len(palabra_prov) - len(palabra_texto)) <= 2):
-                        coincidencias += 1
-                        break
-        
-        print(f"🔤 {proveedor.nombre}: {coincidencias} coincidencias de palabra")
-        
-        if coincidencias >= 1:
-            print(f"✅ Proveedor encontrado por coincidencia de palabras: {proveedor.nombre}")
-            return proveedor
+    resumen = ResumenFactura(
+        subtotal=round(subtotal, 2),
+        impuestos=round(impuestos_total, 2),
+        total=round(total, 2)
+    )
     
-    print(f"❌ No se encontró proveedor específico. Usando fallback: {proveedores[0].nombre if proveedores else 'None'}")
-    # Si no se encuentra, devolver el primero como fallback
-    return proveedores[0] if proveedores else None
+    return OCRResponse(
+        productos=productos_con_impuestos,
+        proveedor=proveedor_detectado,
+        resumen=resumen,
+        texto_completo=texto_completo,
+        success=True,
+        confianza_proveedor=confianza_proveedor
+    )
+
+# --- Subidas de archivos ---
+# Los archivos se leen por bloques y se corta apenas superan el límite, sin cargarlos enteros en memoria
+TAMANO_BLOQUE_SUBIDA = 1024 * 1024
+MAX_AUDIO_BYTES = 25 * 1024 * 1024  # Límite de Whisper
+MAX_IMAGEN_BYTES = 10 * 1024 * 1024  # Límite de Textract para documentos síncronos
+MAX_AJUSTES_BYTES = int(os.getenv("AJUSTES_MAX_MB", "20")) * 1024 * 1024
+# Las listas de precios se leen desde el temporal, así que pueden ser mucho más grandes
+MAX_IMPORTACION_BYTES = int(os.getenv("IMPORTACION_MAX_MB", "200")) * 1024 * 1024
+
+def _error_archivo_grande(max_bytes: int) -> HTTPException:
+    return HTTPException(status_code=400, detail=f"El archivo es muy grande (máximo {max_bytes // (1024 * 1024)}MB)")
+
+async def guardar_upload_en_disco(file: UploadFile, max_bytes: int, suffix: str = "", directorio: str = None) -> str:
+    """
+    Copia el archivo subido a un temporal por bloques y devuelve su ruta (quien llama lo borra).
+    Si supera max_bytes corta la copia, borra el temporal y responde 400
+    """
+    fd, ruta = tempfile.mkstemp(suffix=suffix, dir=directorio)
+    try:
+        total = 0
+        with os.fdopen(fd, 'wb') as destino:
+            while True:
+                bloque = await file.read(TAMANO_BLOQUE_SUBIDA)
+                if not bloque:
+                    break
+                total += len(bloque)
+                if total > max_bytes:
+                    raise _error_archivo_grande(max_bytes)
+                destino.write(bloque)
+    except BaseException:
+        os.unlink(ruta)
+        raise
+    return ruta
+
+async def leer_upload_limitado(file: UploadFile, max_bytes: int) -> bytes:
+    """Lee el archivo subido por bloques, cortando con 400 apenas supera max_bytes"""
+    bloques = []
+    total = 0
+    while True:
+        bloque = await file.read(TAMANO_BLOQUE_SUBIDA)
+        if not bloque:
+            break
+        total += len(bloque)
+        if total > max_bytes:
+            raise _error_archivo_grande(max_bytes)
+        bloques.append(bloque)
+    return b"".join(bloques)
+
+# Rechazo temprano por Content-Length, antes de recibir el cuerpo (margen para el encabezado multipart)
+LIMITES_SUBIDA = {
+    "/process-invoice": MAX_IMAGEN_BYTES,
+    "/api/trabajos/factura": MAX_IMAGEN_BYTES,
+    "/process-audio": MAX_AUDIO_BYTES,
+    "/api/trabajos/audio": MAX_AUDIO_BYTES,
+    "/api/stock/ajustes": MAX_AJUSTES_BYTES,
+    "/api/stock/importar": MAX_IMPORTACION_BYTES,
+}
+MARGEN_MULTIPART = 1024 * 1024
+
+@app.middleware("http")
+async def limitar_tamano_subidas(request, call_next):
+    limite = LIMITES_SUBIDA.get(request.url.path)
+    largo = request.headers.get("content-length", "")
+    if limite and largo.isdigit() and int(largo) > limite + MARGEN_MULTIPART:
+        return JSONResponse(status_code=413, content={"detail": _error_archivo_grande(limite).detail})
+    return await call_next(request)
+
+@app.exception_handler(ServicioDegradado)
+async def responder_servicio_degradado(request, e: ServicioDegradado):
+    """
+    OpenAI o Textract no están disponibles: 503 "degradado" con Retry-After, en lugar de devolver
+    productos inventados. El cliente reintenta más tarde (o encola el archivo en /api/trabajos)
+    """
+    reintentar_en = math.ceil(e.reintentar_en) if e.reintentar_en else None
+    print(f"🚧 {e}")
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(e), "estado": "degradado", "servicio": e.servicio,
+                 "reintentar_en": reintentar_en, "success": False},
+        headers={"Retry-After": str(reintentar_en)} if reintentar_en else None
+    )
 
 @app.get("/")
 async def root():
@@ -241,106 +467,184 @@ async def process_invoice(file: UploadFile = File(...)):
                 success=True
             )
         
-        # Leer el archivo
-        image_bytes = await file.read()
+        # Leer el archivo por bloques, cortando apenas supera el límite de Textract
+        image_bytes = await leer_upload_limitado(file, MAX_IMAGEN_BYTES)
         
-        # Procesar con Textract
+        # Procesar con Textract (si no está disponible, ServicioDegradado responde 503)
         try:
-            response = textract_client.detect_document_text(
-                Document={'Bytes': image_bytes}
-            )
+            response = await detectar_texto_textract(image_bytes)
         except ClientError as e:
-            # Si hay error en Textract, usar fallback
-            texto_completo = f"Error en AWS Textract: {str(e)}\nUsando datos simulados..."
-            productos_detectados = procesar_texto_fallback(texto_completo)
-            return OCRResponse(
-                productos=productos_detectados,
-                texto_completo=texto_completo,
-                success=True
-            )
-        
-        # Extraer texto de la respuesta
-        texto_completo = ""
-        lineas = []
+            # Textract rechazó la imagen: no se inventan productos
+            raise HTTPException(status_code=400, detail=f"Error en AWS Textract: {str(e)}")
         
-        for block in response['Blocks']:
-            if block['BlockType'] == 'LINE':
-                texto_completo += block['Text'] + "\n"
-                lineas.append(block['Text'])
+        # Reconstruir filas (y la tabla de productos, si la hay) a partir de la geometría
+        layout = analizar_respuesta(response)
+        texto_completo = layout.texto
         
         # Detectar proveedor y procesar productos con impuestos
-        proveedor_detectado = detectar_proveedor(texto_completo)
-        productos_detectados = await procesar_texto_con_openai(texto_completo)
-        
-        # Calcular impuestos y resumen
-        productos_con_impuestos = []
-        subtotal = 0
+        proveedor_detectado, confianza_proveedor = detectar_proveedor_con_confianza(texto_completo)
+        productos_detectados = await extraer_productos_factura(texto_completo, proveedor_detectado, layout)
         
-        for producto in productos_detectados:
-            if producto.precio_sin_impuestos:
-                impuesto_porcentaje = proveedor_detectado.impuesto if proveedor_detectado else 21
-                precio_con_impuestos = producto.precio_sin_impuestos * (1 + impuesto_porcentaje / 100)
-                
-                producto.precio_con_impuestos = round(precio_con_impuestos, 2)
-                subtotal += producto.precio_sin_impuestos * producto.cantidad
-            
-            productos_con_impuestos.append(producto)
-        
-        # Calcular resumen
-        impuesto_porcentaje = proveedor_detectado.impuesto if proveedor_detectado else 21
-        impuestos_total = subtotal * (impuesto_porcentaje / 100)
-        total = subtotal + impuestos_total
-        
-        resumen = ResumenFactura(
-            subtotal=round(subtotal, 2),
-            impuestos=round(impuestos_total, 2),
-            total=round(total, 2)
-        )
-        
-        return OCRResponse(
-            productos=productos_con_impuestos,
-            proveedor=proveedor_detectado,
-            resumen=resumen,
-            texto_completo=texto_completo,
-            success=True
-        )
+        return armar_respuesta_factura(texto_completo, proveedor_detectado, productos_detectados, confianza_proveedor)
         
+    except (HTTPException, ServicioDegradado):
+        raise
     except Exception as e:
-        # En caso de cualquier error, usar fallback
-        texto_fallback = "Error procesando imagen - usando datos simulados\nCoca-Cola 2L - 1 unidad\nPan Lactal - 2 unidades"
-        productos_fallback = procesar_texto_fallback(texto_fallback)
+        print(f"Error procesando factura: {e}")
         return OCRResponse(
-            productos=productos_fallback,
-            texto_completo=f"Error: {str(e)}\n{texto_fallback}",
+            productos=[],
+            texto_completo=f"Error: {str(e)}",
             success=False
         )
 
-async def procesar_texto_con_openai(texto_completo: str) -> List[ProductDetected]:
+# --- Procesamiento de facturas por lotes ---
+# Cada etapa tiene su límite de concurrencia por worker (LOTE_CONCURRENCIA_<ETAPA>).
+# La etapa "llm" usa el parser determinista y solo llama a OpenAI para las líneas que no entiende
+
+async def _etapa_textract(factura: dict):
+    with open(factura['ruta'], 'rb') as f:
+        image_bytes = f.read()
+    response = await detectar_texto_textract(image_bytes)
+    factura['layout'] = analizar_respuesta(response)
+    factura['texto'] = factura['layout'].texto
+
+async def _etapa_proveedor(factura: dict):
+    factura['proveedor'], factura['confianza_proveedor'] = detectar_proveedor_con_confianza(factura['texto'])
+
+async def _etapa_llm(factura: dict):
+    factura['productos'] = await extraer_productos_factura(factura['texto'], factura['proveedor'], factura['layout'],
+                                                           interactivo=False)
+
+async def _etapa_matching(factura: dict):
+    respuesta = armar_respuesta_factura(factura['texto'], factura['proveedor'], factura['productos'],
+                                        factura['confianza_proveedor'])
+    # Propuesta de actualización: se confirma después con PUT /api/stock
+    matching = await procesar_matching_con_openai(
+        [{**p.model_dump(), "accion": "entrada"} for p in respuesta.productos]
+    )
+    factura['resultado'] = {**respuesta.model_dump(), "matching": matching}
+
+LOTE_MAX_FACTURAS = int(os.getenv("LOTE_MAX_FACTURAS", "500"))
+LOTE_MAX_ZIP_BYTES = int(float(os.getenv("LOTE_MAX_ZIP_MB", "1024")) * 1024 * 1024)
+pipeline_facturas = PipelineFacturas(
+    [
+        ("textract", _etapa_textract, int(os.getenv("LOTE_CONCURRENCIA_TEXTRACT", str(TEXTRACT_MAX_CONCURRENCIA)))),
+        ("proveedor", _etapa_proveedor, int(os.getenv("LOTE_CONCURRENCIA_PROVEEDOR", "4"))),
+        # Facturas en la etapa a la vez: 4 requests a OpenAI con hasta LLM_MAX_TEXTOS_POR_REQUEST textos cada uno
+        ("llm", _etapa_llm, int(os.getenv("LOTE_CONCURRENCIA_LLM", str(4 * LLM_MAX_TEXTOS_POR_REQUEST)))),
+        ("matching", _etapa_matching, int(os.getenv("LOTE_CONCURRENCIA_MATCHING", "2"))),
+    ],
+    os.path.join(DATA_DIR, "lotes")
+)
+
+@app.post("/process-invoice/batch")
+async def process_invoice_batch(files: List[UploadFile] = File(...)):
+    """
+    Recibe muchas imágenes de facturas (o zips con imágenes) y las procesa en segundo plano.
+    Devuelve un lote_id para consultar el progreso en GET /process-invoice/batch/{lote_id}
+    """
+    if not textract_client:
+        raise HTTPException(status_code=503, detail="AWS Textract no está configurado")
+    
+    # Las imágenes se copian a disco por bloques: un lote de cientos de facturas no vive en memoria
+    archivos = []
+    try:
+        for file in files:
+            es_zip = bool(file.filename and file.filename.lower().endswith('.zip'))
+            if not es_zip and not (file.content_type and file.content_type.startswith('image/')):
+                raise HTTPException(status_code=400, detail=f"{file.filename} no es una imagen ni un zip")
+            
+            if es_zip:
+                ruta_zip = await guardar_upload_en_disco(file, LOTE_MAX_ZIP_BYTES, suffix='.zip',
+                                                         directorio=pipeline_facturas.directorio_subidas)
+                try:
+                    archivos.extend(extraer_imagenes_zip(ruta_zip, pipeline_facturas.directorio_subidas))
+                except zipfile.BadZipFile:
+                    raise HTTPException(status_code=400, detail=f"{file.filename} no es un zip válido")
+                finally:
+                    os.unlink(ruta_zip)
+            else:
+                ruta = await guardar_upload_en_disco(file, MAX_IMAGEN_BYTES, suffix=os.path.splitext(file.filename or "")[1],
+                                                     directorio=pipeline_facturas.directorio_subidas)
+                archivos.append((file.filename, ruta))
+        
+        if not archivos:
+            raise HTTPException(status_code=400, detail="No se recibieron imágenes de facturas")
+        if len(archivos) > LOTE_MAX_FACTURAS:
+            raise HTTPException(status_code=400, detail=f"El lote supera el máximo de {LOTE_MAX_FACTURAS} facturas")
+    except BaseException:
+        for _, ruta in archivos:
+            os.unlink(ruta)
+        raise
+    
+    lote = pipeline_facturas.iniciar(archivos)
+    return {"lote_id": lote.id, "total": len(archivos), "estado": "en_proceso", "success": True}
+
+@app.get("/process-invoice/batch/{lote_id}")
+async def estado_lote_facturas(lote_id: str):
+    """
+    Progreso de un lote: estado y etapa de cada factura, y su resultado cuando termina
+    """
+    lote = pipeline_facturas.obtener(lote_id)
+    if lote is None:
+        raise HTTPException(status_code=404, detail="Lote no encontrado")
+    return lote
+
+parser_facturas = ParserFacturas()
+
+async def extraer_productos_factura(texto_completo: str, proveedor: Proveedor = None,
+                                    layout: AnalisisLayout = None, interactivo: bool = True) -> List[ProductDetected]:
+    """
+    Extracción escalonada: primero la tabla de productos reconstruida del layout de Textract,
+    si no hay tabla el parser determinista con las gramáticas del proveedor, y OpenAI solo para
+    las líneas que no se pudieron interpretar (o para todo el texto si no se reconoció nada)
+    """
+    if layout is not None and layout.productos:
+        print(f"📐 Tabla de la factura ({layout.origen}): {len(layout.productos)} productos, {len(layout.lineas_dudosas)} filas para el LLM")
+        if layout.lineas_dudosas:
+            return layout.productos + await procesar_texto_con_openai('\n'.join(layout.lineas_dudosas), interactivo)
+        return layout.productos
+
+    resultado = parser_facturas.parsear(texto_completo, proveedor)
+    print(f"🧾 Parser de facturas: {len(resultado.productos)} productos, {len(resultado.lineas_dudosas)} líneas para el LLM")
+    
+    if not resultado.productos:
+        return await procesar_texto_con_openai(texto_completo, interactivo)
+    if resultado.lineas_dudosas:
+        return resultado.productos + await procesar_texto_con_openai('\n'.join(resultado.lineas_dudosas), interactivo)
+    return resultado.productos
+
+async def procesar_texto_con_openai(texto_completo: str, interactivo: bool = True) -> List[ProductDetected]:
     """
-    Usa OpenAI para procesar el texto extraído de la factura y detectar productos
+    Usa OpenAI para procesar el texto extraído de la factura y detectar productos.
+    Si el texto supera el presupuesto de tokens se divide por líneas en fragmentos que se
+    procesan en paralelo y se unen los productos. Los fragmentos pasan por el agrupador, que
+    junta en un solo request los textos de varias facturas que llegan a la vez
+    (`interactivo=False` usa una ventana más larga, para lotes y trabajos en segundo plano)
     """
     # Si OpenAI no está configurado, usar fallback directamente
     if not openai_client:
-        print("OpenAI no configurado, usando procesamiento fallback")
+        print("⚠️ OpenAI no configurado: usando datos SIMULADOS (modo desarrollo)")
         return procesar_texto_fallback(texto_completo)
     
-    try:
-        # Base de datos de productos conocidos (en producción esto vendría de una BD)
-        productos_conocidos = [
-            "Coca-Cola 2L", "Pan Lactal", "Leche Entera 1L", "Agua Mineral 500ml",
-            "Yogur Ser", "Fideos Matarazzo", "Chicles Beldent", "Cerveza Quilmes",
-            "Aceite Natura", "Arroz Gallo", "Azúcar Ledesma", "Cafe La Virginia",
-            "Galletas Oreo", "Queso Cremoso", "Manteca La Serenísima", "Tomate Enlatado"
-        ]
-        
-        prompt = f"""
-Eres un experto en procesamiento de facturas. Analiza el texto y extrae productos con ESPECIFICACIONES COMPLETAS y PRECIOS.
-
-TEXTO DE LA FACTURA:
-{texto_completo}
+    fragmentos = dividir_texto(texto_completo, LLM_PRESUPUESTO_DATOS, MODELO_CHAT)
+    if len(fragmentos) > 1:
+        print(f"✂️ Factura larga: {len(fragmentos)} fragmentos en paralelo")
+    agrupador = agrupador_extraccion if interactivo else agrupador_extraccion_diferida
+    resultados = await asyncio.gather(*(agrupador.pedir(fragmento) for fragmento in fragmentos))
+    return [producto for productos in resultados for producto in productos]
+
+# Base de datos de productos conocidos (en producción esto vendría de una BD)
+PRODUCTOS_CONOCIDOS = [
+    "Coca-Cola 2L", "Pan Lactal", "Leche Entera 1L", "Agua Mineral 500ml",
+    "Yogur Ser", "Fideos Matarazzo", "Chicles Beldent", "Cerveza Quilmes",
+    "Aceite Natura", "Arroz Gallo", "Azúcar Ledesma", "Cafe La Virginia",
+    "Galletas Oreo", "Queso Cremoso", "Manteca La Serenísima", "Tomate Enlatado"
+]
 
+INSTRUCCIONES_EXTRACCION = f"""
 PRODUCTOS CONOCIDOS EN NUESTRO INVENTARIO:
-{', '.join(productos_conocidos)}
+{', '.join(PRODUCTOS_CONOCIDOS)}
 
 INSTRUCCIONES CRÍTICAS PARA ESPECIFICACIONES:
 1. INCLUYE SIEMPRE especificaciones de tamaño en el nombre del producto:
@@ -365,19 +669,16 @@ INSTRUCCIONES CRÍTICAS PARA ESPECIFICACIONES:
    - "300063098 TWISTOS MINIT JAMON 95GX30X1 2.00 $1849.96"
    - "CÓDIGO PRODUCTO ESPECIFICACION CANTIDAD PRECIO"
    - "Marca Producto Tamaño cantidad precio"
+"""
 
-FORMATO DE RESPUESTA (JSON):
-{{
-    "productos": [
-        {{
+_PRODUCTO_EXTRAIDO_JSON = """{
             "nombre": "MARCA PRODUCTO ESPECIFICACION_COMPLETA",
             "cantidad": numero_entero_exacto,
             "precio_sin_impuestos": precio_unitario_sin_impuestos,
             "confianza": porcentaje_de_confianza_0_a_100
-        }}
-    ]
-}}
+        }"""
 
+REGLAS_EXTRACCION = """
 REGLAS IMPORTANTES:
 - SIEMPRE incluye gramajes (G) y volúmenes (ML/L) en el nombre
 - NO omitas especificaciones de tamaño (95G, 40G, 500ML, etc.)
@@ -387,64 +688,118 @@ REGLAS IMPORTANTES:
 Responde SOLO con el JSON válido, sin explicaciones adicionales.
 """
 
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
+def prompt_extraccion(textos: List[str]) -> str:
+    """
+    Prompt de extracción de productos para uno o varios textos de factura. Con varios textos las
+    instrucciones van una sola vez y cada texto lleva su id para devolver sus productos por separado
+    """
+    if len(textos) == 1:
+        bloque_textos = f"TEXTO DE LA FACTURA:\n{textos[0]}"
+        formato = f"""FORMATO DE RESPUESTA (JSON):
+{{
+    "productos": [
+        {_PRODUCTO_EXTRAIDO_JSON}
+    ]
+}}"""
+    else:
+        bloque_textos = "TEXTOS DE LAS FACTURAS (cada uno con su id; no mezcles productos de textos distintos):\n" + \
+            "\n".join(f"[id {i}]\n{texto}\n" for i, texto in enumerate(textos))
+        formato = f"""FORMATO DE RESPUESTA (JSON), un elemento por cada texto con su id:
+{{
+    "textos": [
+        {{
+            "id": id_del_texto,
+            "productos": [
+                {_PRODUCTO_EXTRAIDO_JSON}
+            ]
+        }}
+    ]
+}}"""
+    return f"""
+Eres un experto en procesamiento de facturas. Analiza el texto y extrae productos con ESPECIFICACIONES COMPLETAS y PRECIOS.
+
+{bloque_textos}
+{INSTRUCCIONES_EXTRACCION}
+{formato}
+{REGLAS_EXTRACCION}"""
+
+async def _procesar_fragmento_con_openai(texto_completo: str) -> List[ProductDetected]:
+    try:
+        prompt = prompt_extraccion([texto_completo])
+
+        resultado = await completar_estructurado(
+            completar_chat, "extraccion_factura", ExtraccionProductos,
+            model=MODELO_CHAT,
             messages=[
                 {"role": "system", "content": "Eres un asistente experto en procesamiento de facturas. Respondes solo con JSON válido."},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.1,
-            max_tokens=1000
+            # Cada línea del texto puede ser un producto (~50 tokens de JSON)
+            max_tokens=max_tokens_respuesta(len(texto_completo.splitlines()), 50)
         )
+        return resultado.productos
         
-        # Extraer y parsear la respuesta
-        content = response.choices[0].message.content.strip()
-        
-        # Limpiar la respuesta si tiene marcadores de código
-        if content.startswith('```'):
-            content = content.split('```')[1]
-            if content.startswith('json'):
-                content = content[4:]
-        
-        # Parsear JSON
-        result = json.loads(content)
-        
-        # Convertir a objetos ProductDetected
-        productos = []
-        for item in result.get('productos', []):
-            # Mejorar el procesamiento de precios sin impuestos
-            precio_raw = item.get('precio_sin_impuestos') or item.get('precio')  # fallback para compatibilidad
-            precio_procesado = None
-            
-            if precio_raw is not None:
-                try:
-                    # Limpiar el precio: remover símbolos y normalizar decimales
-                    precio_str = str(precio_raw)
-                    # Remover símbolos como $, espacios
-                    precio_str = precio_str.replace('$', '').replace(' ', '')
-                    # Normalizar decimales (convertir comas a puntos)
-                    precio_str = precio_str.replace(',', '.')
-                    precio_procesado = float(precio_str)
-                except (ValueError, TypeError):
-                    precio_procesado = None
-            
-            productos.append(ProductDetected(
-                nombre=item['nombre'],
-                cantidad=item['cantidad'],
-                precio_sin_impuestos=precio_procesado,
-                confianza=item['confianza']
-            ))
-        
-        return productos
-        
+    except ValueError as e:
+        # La respuesta no se pudo leer: degradado, nunca productos simulados que terminen en el stock
+        raise respuesta_llm_invalida("extracción de factura", e)
+
+async def _procesar_textos_con_openai(textos: List[str]) -> List[List[ProductDetected]]:
+    """
+    Extrae los productos de varios textos en un solo request (las instrucciones se pagan una vez).
+    Los textos que el modelo no devolvió, o todos si el request falla, se procesan de a uno
+    """
+    if len(textos) == 1:
+        return [await _procesar_fragmento_con_openai(textos[0])]
+    try:
+        resultado = await completar_estructurado(
+            completar_chat, "extraccion_factura_lote", ExtraccionLote,
+            model=MODELO_CHAT,
+            messages=[
+                {"role": "system", "content": "Eres un asistente experto en procesamiento de facturas. Respondes solo con JSON válido."},
+                {"role": "user", "content": prompt_extraccion(textos)}
+            ],
+            temperature=0.1,
+            max_tokens=max_tokens_respuesta(sum(len(texto.splitlines()) for texto in textos), 50)
+        )
+        por_id = {item.id: item.productos for item in resultado.textos if 0 <= item.id < len(textos)}
+    except ServicioDegradado:
+        raise
     except Exception as e:
-        print(f"Error en OpenAI: {e}")
-        # Fallback a procesamiento básico
-        return procesar_texto_fallback(texto_completo)
+        print(f"Error en OpenAI con {len(textos)} textos agrupados: {e}")
+        por_id = {}
+    
+    faltantes = [i for i in range(len(textos)) if i not in por_id]
+    if faltantes:
+        print(f"Reprocesando de a uno {len(faltantes)} de {len(textos)} textos agrupados")
+        for i, productos in zip(faltantes, await asyncio.gather(*(_procesar_fragmento_con_openai(textos[i]) for i in faltantes))):
+            por_id[i] = productos
+    return [por_id[i] for i in range(len(textos))]
+
+def _tokens_texto(texto: str) -> int:
+    return contar_tokens(texto, MODELO_CHAT)
+
+agrupador_extraccion = AgrupadorSolicitudes(
+    "extraccion_factura", _procesar_textos_con_openai, LLM_VENTANA_AGRUPACION,
+    LLM_MAX_TEXTOS_POR_REQUEST, LLM_PRESUPUESTO_DATOS, _tokens_texto
+)
+agrupador_extraccion_diferida = AgrupadorSolicitudes(
+    "extraccion_factura_diferida", _procesar_textos_con_openai, LLM_VENTANA_AGRUPACION_DIFERIDA,
+    LLM_MAX_TEXTOS_POR_REQUEST, LLM_PRESUPUESTO_DATOS, _tokens_texto
+)
+
+def respuesta_llm_invalida(contexto: str, error: Exception) -> ServicioDegradado:
+    """
+    Error para una respuesta de OpenAI que no se pudo leer ni validar: el cliente recibe 503
+    "degradado" (y los trabajos en cola reintentan) en lugar de datos simulados
+    """
+    print(f"Respuesta inválida de OpenAI ({contexto}): {error}")
+    return ServicioDegradado("OpenAI", f"respuesta inválida en {contexto}")
 
 def procesar_texto_fallback(texto: str) -> List[ProductDetected]:
     """
-    Procesamiento fallback sin IA para cuando OpenAI no esté disponible
+    SOLO PARA DESARROLLO, cuando OpenAI no está configurado: productos SIMULADOS a partir de
+    palabras clave, no una extracción real. Nunca se usa si la llamada a OpenAI falla
     """
     productos = []
     
@@ -490,7 +845,7 @@ async def process_text(input_data: TextInput):
         # Cargar productos actuales del stock si no se proporcionaron
         productos_actuales = input_data.productos_actuales
         if not productos_actuales:
-            stock_actual = cargar_stock()
+            stock_actual = await asyncio.to_thread(cargar_stock)
             productos_actuales = [producto.model_dump() for producto in stock_actual]
         
         # Procesar con matching inteligente usando OpenAI
@@ -546,13 +901,143 @@ async def process_text(input_data: TextInput):
             "proveedor": proveedor_detectado,
             "resumen": resumen,
             "analisis_ia": resultado_matching.get("analisis_ia", ""),
+            # True solo en desarrollo sin OpenAI: los productos no salen de una extracción real
+            "simulado": resultado_matching.get("simulado", False),
             "texto_procesado": input_data.texto,
             "success": True
         }
         
+    except ServicioDegradado:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error procesando el texto: {str(e)}")
 
+def extension_audio(content_type: str) -> str:
+    """Extensión de archivo para Whisper según el tipo de audio (mp3 por defecto)"""
+    extensiones = {"audio/wav": ".wav", "audio/m4a": ".m4a", "audio/webm": ".webm", "audio/flac": ".flac"}
+    return extensiones.get(content_type, ".mp3")
+
+async def procesar_audio_guardado(ruta_audio: str, productos_actuales_list: List[dict]) -> dict:
+    """
+    Transcribe un audio ya guardado en disco con Whisper y hace matching inteligente del texto.
+    Lanza HTTPException 400 si el audio no tiene contenido útil y ServicioDegradado si OpenAI no está disponible
+    """
+    # Transcribir con Whisper (cada reintento vuelve a abrir el archivo desde el principio)
+    async def transcribir():
+        with open(ruta_audio, "rb") as audio_file:
+            return await openai_client.audio.transcriptions.create(
+                model="whisper-1",
+                file=audio_file,
+                language="es",  # Especificar español para mejor precisión
+                prompt="Productos, inventario, stock, mercadería, llegaron, entraron, salieron"  # Ayudar con el contexto
+            )
+    transcript = await clientes_externos.obtener("openai:audio:whisper-1", _cliente_openai).llamar(transcribir)
+    
+    texto_transcrito = transcript.text.strip()
+    print(f"Audio transcrito: '{texto_transcrito}'")
+    
+    # Validaciones más estrictas para texto transcrito
+    if not texto_transcrito:
+        raise HTTPException(
+            status_code=400, 
+            detail="No se detectó ningún audio o el audio está en silencio"
+        )
+    
+    # Verificar que el texto tenga contenido real (no solo ruido)
+    if len(texto_transcrito) < 5:
+        raise HTTPException(
+            status_code=400,
+            detail="El audio transcrito es muy corto. Hable más claramente."
+        )
+    
+    # Detectar si el texto parece ser ruido o sin sentido
+    palabras = texto_transcrito.split()
+    if len(palabras) < 2:
+        raise HTTPException(
+            status_code=400,
+            detail="No se pudieron detectar palabras claras en el audio"
+        )
+    
+    # Verificar que hay al menos algunas palabras relacionadas con inventario
+    palabras_clave_inventario = [
+        'producto', 'productos', 'llegaron', 'llegó', 'entraron', 'entró', 
+        'salieron', 'salió', 'stock', 'inventario', 'mercadería', 'mercaderia',
+        'cantidad', 'unidades', 'cajas', 'latas', 'botellas', 'paquetes',
+        'twistos', 'smirnoff', 'coca', 'sprite', 'yogur', 'leche', 'pan'
+    ]
+    
+    texto_lower = texto_transcrito.lower()
+    tiene_contexto_inventario = any(palabra in texto_lower for palabra in palabras_clave_inventario)
+    
+    if not tiene_contexto_inventario and len(palabras) < 4:
+        print(f"Texto sin contexto de inventario: '{texto_transcrito}'")
+        raise HTTPException(
+            status_code=400,
+            detail=f"El audio no parece contener información sobre productos o inventario. Texto detectado: '{texto_transcrito}'"
+        )
+    
+    # Procesar con matching inteligente usando OpenAI
+    resultado_matching = await procesar_texto_con_matching_inteligente(
+        texto_transcrito, 
+        productos_actuales_list
+    )
+    
+    # Detectar proveedor usando el resultado de OpenAI si está disponible
+    proveedor_detectado = None
+    if resultado_matching.get("proveedor_detectado"):
+        # Buscar el proveedor por nombre exacto
+        proveedores = cargar_proveedores()
+        for prov in proveedores:
+            if prov.nombre == resultado_matching["proveedor_detectado"]:
+                proveedor_detectado = prov
+                print(f"✅ Proveedor detectado por OpenAI: {prov.nombre}")
+                break
+    
+    # Si OpenAI no detectó proveedor, usar la función fallback
+    if not proveedor_detectado:
+        proveedor_detectado = detectar_proveedor(texto_transcrito)
+        print(f"🔄 Usando detección fallback de proveedor: {proveedor_detectado.nombre if proveedor_detectado else 'None'}")
+    
+    # Calcular impuestos para productos con precio
+    productos_con_impuestos = []
+    subtotal = 0
+    
+    for producto_info in resultado_matching["productos"]:
+        if producto_info.get("precio_sin_impuestos"):
+            impuesto_porcentaje = proveedor_detectado.impuesto if proveedor_detectado else 21
+            precio_con_impuestos = producto_info["precio_sin_impuestos"] * (1 + impuesto_porcentaje / 100)
+            producto_info["precio_con_impuestos"] = round(precio_con_impuestos, 2)
+            subtotal += producto_info["precio_sin_impuestos"] * producto_info["cantidad"]
+        
+        productos_con_impuestos.append(producto_info)
+    
+    # Calcular resumen si hay precios
+    resumen = None
+    if subtotal > 0:
+        impuesto_porcentaje = proveedor_detectado.impuesto if proveedor_detectado else 21
+        impuestos_total = subtotal * (impuesto_porcentaje / 100)
+        total = subtotal + impuestos_total
+        
+        resumen = ResumenFactura(
+            subtotal=round(subtotal, 2),
+            impuestos=round(impuestos_total, 2),
+            total=round(total, 2)
+        )
+    
+    # Agregar información sobre la transcripción al análisis
+    analisis_completo = f"🎙️ Transcripción de audio: \"{texto_transcrito}\"\n\n{resultado_matching.get('analisis_ia', '')}"
+    
+    return {
+        "productos": productos_con_impuestos,
+        "proveedor": proveedor_detectado,
+        "resumen": resumen,
+        "analisis_ia": analisis_completo,
+        "simulado": resultado_matching.get("simulado", False),
+        "texto_transcrito": texto_transcrito,
+        "texto_procesado": texto_transcrito,  # Para compatibilidad
+        "success": True
+    }
+
 @app.post("/process-audio")
 async def process_audio(file: UploadFile = File(...), productos_actuales: str = Form("[]")):
     """
@@ -567,14 +1052,6 @@ async def process_audio(file: UploadFile = File(...), productos_actuales: str =
                 detail=f"Tipo de archivo no soportado. Use: {', '.join(audio_types)}"
             )
         
-        # Validar tamaño (máximo 25MB como límite de Whisper)
-        file_size = 0
-        content = await file.read()
-        file_size = len(content)
-        
-        if file_size > 25 * 1024 * 1024:  # 25MB
-            raise HTTPException(status_code=400, detail="El archivo es muy grande (máximo 25MB)")
-        
         # Verificar si OpenAI está configurado
         if not openai_client:
             raise HTTPException(
@@ -590,155 +1067,29 @@ async def process_audio(file: UploadFile = File(...), productos_actuales: str =
         
         # Cargar productos actuales del stock si no se proporcionaron
         if not productos_actuales_list:
-            stock_actual = cargar_stock()
+            stock_actual = await asyncio.to_thread(cargar_stock)
             productos_actuales_list = [producto.model_dump() for producto in stock_actual]
         
-        # Crear archivo temporal para Whisper
-        temp_file = None
+        # Copiar el audio a un archivo temporal por bloques (máximo 25MB, límite de Whisper).
+        # Whisper lee directo de ese archivo, sin cargarlo entero en memoria
+        ruta_audio = await guardar_upload_en_disco(file, MAX_AUDIO_BYTES, suffix=extension_audio(file.content_type))
         try:
-            # Crear archivo temporal con la extensión correcta
-            file_extension = ".mp3"  # Default
-            if file.content_type == "audio/wav":
-                file_extension = ".wav"
-            elif file.content_type == "audio/m4a":
-                file_extension = ".m4a"
-            elif file.content_type == "audio/webm":
-                file_extension = ".webm"
-            elif file.content_type == "audio/flac":
-                file_extension = ".flac"
-            
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=file_extension)
-            temp_file.write(content)
-            temp_file.close()
-            
             # Validar duración mínima del archivo (al menos 1 segundo)
-            file_stats = os.stat(temp_file.name)
-            if file_stats.st_size < 1000:  # Menos de 1KB probablemente es muy corto
+            if os.path.getsize(ruta_audio) < 1000:  # Menos de 1KB probablemente es muy corto
                 raise HTTPException(
                     status_code=400,
                     detail="El audio es muy corto. Grabe al menos 1-2 segundos."
                 )
             
-            # Transcribir con Whisper
-            with open(temp_file.name, "rb") as audio_file:
-                transcript = openai_client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file,
-                    language="es",  # Especificar español para mejor precisión
-                    prompt="Productos, inventario, stock, mercadería, llegaron, entraron, salieron"  # Ayudar con el contexto
-                )
-            
-            texto_transcrito = transcript.text.strip()
-            print(f"Audio transcrito: '{texto_transcrito}'")
-            
-            # Validaciones más estrictas para texto transcrito
-            if not texto_transcrito:
-                raise HTTPException(
-                    status_code=400, 
-                    detail="No se detectó ningún audio o el audio está en silencio"
-                )
-            
-            # Verificar que el texto tenga contenido real (no solo ruido)
-            if len(texto_transcrito) < 5:
-                raise HTTPException(
-                    status_code=400,
-                    detail="El audio transcrito es muy corto. Hable más claramente."
-                )
-            
-            # Detectar si el texto parece ser ruido o sin sentido
-            palabras = texto_transcrito.split()
-            if len(palabras) < 2:
-                raise HTTPException(
-                    status_code=400,
-                    detail="No se pudieron detectar palabras claras en el audio"
-                )
-            
-            # Verificar que hay al menos algunas palabras relacionadas con inventario
-            palabras_clave_inventario = [
-                'producto', 'productos', 'llegaron', 'llegó', 'entraron', 'entró', 
-                'salieron', 'salió', 'stock', 'inventario', 'mercadería', 'mercaderia',
-                'cantidad', 'unidades', 'cajas', 'latas', 'botellas', 'paquetes',
-                'twistos', 'smirnoff', 'coca', 'sprite', 'yogur', 'leche', 'pan'
-            ]
-            
-            texto_lower = texto_transcrito.lower()
-            tiene_contexto_inventario = any(palabra in texto_lower for palabra in palabras_clave_inventario)
-            
-            if not tiene_contexto_inventario and len(palabras) < 4:
-                print(f"Texto sin contexto de inventario: '{texto_transcrito}'")
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"El audio no parece contener información sobre productos o inventario. Texto detectado: '{texto_transcrito}'"
-                )
-            
-            # Procesar con matching inteligente usando OpenAI
-            resultado_matching = await procesar_texto_con_matching_inteligente(
-                texto_transcrito, 
-                productos_actuales_list
-            )
-            
-            # Detectar proveedor usando el resultado de OpenAI si está disponible
-            proveedor_detectado = None
-            if resultado_matching.get("proveedor_detectado"):
-                # Buscar el proveedor por nombre exacto
-                proveedores = cargar_proveedores()
-                for prov in proveedores:
-                    if prov.nombre == resultado_matching["proveedor_detectado"]:
-                        proveedor_detectado = prov
-                        print(f"✅ Proveedor detectado por OpenAI: {prov.nombre}")
-                        break
-            
-            # Si OpenAI no detectó proveedor, usar la función fallback
-            if not proveedor_detectado:
-                proveedor_detectado = detectar_proveedor(texto_transcrito)
-                print(f"🔄 Usando detección fallback de proveedor: {proveedor_detectado.nombre if proveedor_detectado else 'None'}")
-            
-            # Calcular impuestos para productos con precio
-            productos_con_impuestos = []
-            subtotal = 0
-            
-            for producto_info in resultado_matching["productos"]:
-                if producto_info.get("precio_sin_impuestos"):
-                    impuesto_porcentaje = proveedor_detectado.impuesto if proveedor_detectado else 21
-                    precio_con_impuestos = producto_info["precio_sin_impuestos"] * (1 + impuesto_porcentaje / 100)
-                    producto_info["precio_con_impuestos"] = round(precio_con_impuestos, 2)
-                    subtotal += producto_info["precio_sin_impuestos"] * producto_info["cantidad"]
-                
-                productos_con_impuestos.append(producto_info)
-            
-            # Calcular resumen si hay precios
-            resumen = None
-            if subtotal > 0:
-                impuesto_porcentaje = proveedor_detectado.impuesto if proveedor_detectado else 21
-                impuestos_total = subtotal * (impuesto_porcentaje / 100)
-                total = subtotal + impuestos_total
-                
-                resumen = ResumenFactura(
-                    subtotal=round(subtotal, 2),
-                    impuestos=round(impuestos_total, 2),
-                    total=round(total, 2)
-                )
-            
-            # Agregar información sobre la transcripción al análisis
-            analisis_completo = f"🎙️ Transcripción de audio: \"{texto_transcrito}\"\n\n{resultado_matching.get('analisis_ia', '')}"
-            
-            return {
-                "productos": productos_con_impuestos,
-                "proveedor": proveedor_detectado,
-                "resumen": resumen,
-                "analisis_ia": analisis_completo,
-                "texto_transcrito": texto_transcrito,
-                "texto_procesado": texto_transcrito,  # Para compatibilidad
-                "success": True
-            }
+            return await procesar_audio_guardado(ruta_audio, productos_actuales_list)
             
         finally:
             # Limpiar archivo temporal
-            if temp_file and os.path.exists(temp_file.name):
-                os.unlink(temp_file.name)
+            if os.path.exists(ruta_audio):
+                os.unlink(ruta_audio)
                 
-    except HTTPException:
-        raise  # Re-raise HTTP exceptions
+    except (HTTPException, ServicioDegradado):
+        raise  # Re-raise HTTP exceptions y servicio degradado (503)
     except Exception as e:
         print(f"Error procesando audio: {e}")
         raise HTTPException(status_code=500, detail=f"Error procesando el audio: {str(e)}")
@@ -756,33 +1107,55 @@ async def procesar_texto_con_matching_inteligente(texto: str, productos_actuales
     
     # Si OpenAI no está configurado, usar fallback
     if not openai_client:
-        print("OpenAI no configurado, usando procesamiento fallback para matching")
-        return procesar_matching_fallback(texto, productos_actuales)
+        print("⚠️ OpenAI no configurado: matching SIMULADO sin IA (modo desarrollo)")
+        return await asyncio.to_thread(procesar_matching_fallback, texto, productos_actuales)
     
     try:
-        # Preparar lista de productos para el prompt
-        productos_inventario = []
-        for producto in productos_actuales:
-            productos_inventario.append(f"ID: {producto.get('id', 'N/A')} - {producto.get('nombre', 'Sin nombre')} - ${producto.get('precio_base', 0)} - Stock: {producto.get('stock', 0)}")
-        
-        productos_texto = '\n'.join(productos_inventario[:50])  # Limitar para no exceder tokens
-        
-        # Obtener lista de proveedores para el prompt
-        proveedores = cargar_proveedores()
-        proveedores_texto = '\n'.join([f"- {p.nombre}" for p in proveedores])
-        
-        prompt = f"""
-Eres un asistente experto en gestión de inventarios. Analiza el texto de entrada de mercadería y haz matching inteligente con los productos existentes.
+        return await agrupador_matching_texto.pedir((texto, productos_actuales))
+    except ValueError as e:
+        raise respuesta_llm_invalida("matching de texto", e)
 
-TEXTO DE ENTRADA:
-{texto}
-
-INVENTARIO ACTUAL:
-{productos_texto}
+# Tokens mínimos de una línea del inventario en el prompt: acota cuántos productos pueden entrar
+TOKENS_MIN_LINEA_INVENTARIO = 15
 
-PROVEEDORES REGISTRADOS:
-{proveedores_texto}
+def sincronizar_matcher_stock():
+    """
+    Pone matcher_stock al día con el stock, solo si cambió la revisión del repositorio.
+    Se llama en un thread, con lock_matcher_stock tomado
+    """
+    revision = repositorio_stock.revision()
+    if revision is None or revision != matcher_stock.revision:
+        matcher_stock.sincronizar(cargar_stock(), revision)
+
+def indexar_productos_creados(creados: List[ProductoStock]):
+    """Indexa enseguida los productos nuevos, sin esperar a la próxima sincronización (en un thread)"""
+    with lock_matcher_stock:
+        for producto in creados:
+            matcher_stock.agregar(producto.id, producto.nombre)
+        indice_semantico.guardar_si_hace_falta(INDICE_GUARDAR_CADA)
+
+def _inventario_para_texto(texto: str, productos_actuales: List[dict], presupuesto: int) -> List[str]:
+    """
+    Líneas del inventario para el prompt: ordenadas por relevancia para el texto (primero los
+    candidatos de matcher_stock, después el resto) hasta agotar el presupuesto de tokens.
+    Solo se miran los productos que pueden entrar en el presupuesto. Corre en un thread
+    """
+    maximo = max(presupuesto // TOKENS_MIN_LINEA_INVENTARIO, 1)
+    with lock_matcher_stock:
+        sincronizar_matcher_stock()
+        candidatos = matcher_stock.candidatos_por_texto(texto, k=maximo)
+    por_id = {producto.get('id'): producto for producto in productos_actuales}
+    relevantes = [por_id[producto_id] for _, producto_id in candidatos if producto_id in por_id]
+    ids_relevantes = {producto.get('id') for producto in relevantes}
+    resto = (p for p in productos_actuales if p.get('id') not in ids_relevantes)
+
+    productos_inventario = [
+        f"ID: {producto.get('id', 'N/A')} - {producto.get('nombre', 'Sin nombre')} - ${producto.get('precio_base', 0)} - Stock: {producto.get('stock', 0)}"
+        for producto in itertools.islice(itertools.chain(relevantes, resto), maximo)
+    ]
+    return recortar_a_presupuesto(productos_inventario, presupuesto, MODELO_CHAT)
 
+INSTRUCCIONES_MATCHING_TEXTO = """
 INSTRUCCIONES:
 1. Analiza el texto para identificar:
    - QUE productos llegaron
@@ -808,10 +1181,9 @@ INSTRUCCIONES:
    - Si menciona "Central", "Distribuidora Central" → Es "Distribuidora Central"
    - IMPORTANTE: En el análisis menciona claramente qué proveedor detectaste
 
-FORMATO DE RESPUESTA (JSON):
-{{
-    "productos": [
-        {{
+"""
+
+_PRODUCTO_MATCHING_JSON = """{
             "nombre": "Nombre del producto (del inventario si hay match, sino el detectado)",
             "cantidad": numero_entero,
             "precio_sin_impuestos": precio_unitario_o_null,
@@ -819,12 +1191,14 @@ FORMATO DE RESPUESTA (JSON):
             "confianza": porcentaje_0_a_100,
             "es_nuevo": true_o_false,
             "producto_id": id_del_producto_existente_o_null
-        }}
-    ],
-    "proveedor_detectado": "Nombre exacto del proveedor de la lista o null",
-    "analisis_ia": "Explicación detallada de lo que detectaste, incluyendo el proveedor identificado y cómo hiciste el matching"
-}}
+        }"""
+
+_RESULTADO_MATCHING_JSON = (
+    '"proveedor_detectado": "Nombre exacto del proveedor de la lista o null",\n'
+    '    "analisis_ia": "Explicación detallada de lo que detectaste, incluyendo el proveedor identificado y cómo hiciste el matching"'
+)
 
+REGLAS_MATCHING_TEXTO = """
 REGLAS IMPORTANTES:
 - SOLO procesa texto que claramente mencione productos o inventario
 - SI el texto no tiene sentido o no menciona productos, devuelve lista vacía
@@ -843,40 +1217,132 @@ EJEMPLO DE TEXTOS QUE NO DEBES PROCESAR:
 Responde SOLO con el JSON válido:
 """
 
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "Eres un experto en matching de productos de inventario. Tu trabajo es ser inteligente y flexible para encontrar coincidencias, incluso con nombres similares o sinónimos. Respondes únicamente con JSON válido."},
-                {"role": "user", "content": prompt}
+def prompt_matching_texto(textos: List[str], productos_texto: str, proveedores_texto: str) -> str:
+    """
+    Prompt de matching para uno o varios textos de entrada. Con varios textos las instrucciones y
+    el inventario van una sola vez y cada texto lleva su id para devolver su resultado por separado
+    """
+    if len(textos) == 1:
+        bloque_textos = f"TEXTO DE ENTRADA:\n{textos[0]}"
+        formato = f"""FORMATO DE RESPUESTA (JSON):
+{{
+    "productos": [
+        {_PRODUCTO_MATCHING_JSON}
+    ],
+    {_RESULTADO_MATCHING_JSON}
+}}"""
+    else:
+        bloque_textos = "TEXTOS DE ENTRADA (cada uno con su id; analizalos por separado):\n" + \
+            "\n".join(f"[id {i}]\n{texto}\n" for i, texto in enumerate(textos))
+        formato = f"""FORMATO DE RESPUESTA (JSON), un resultado por cada texto con su id:
+{{
+    "resultados": [
+        {{
+            "id": id_del_texto,
+            "productos": [
+                {_PRODUCTO_MATCHING_JSON}
             ],
-            temperature=0.2,
-            max_tokens=2000
-        )
-        
-        # Extraer y parsear la respuesta
-        content = response.choices[0].message.content.strip()
-        
-        # Limpiar la respuesta si tiene marcadores de código
-        if content.startswith('```'):
-            content = content.split('```')[1]
-            if content.startswith('json'):
-                content = content[4:]
-        
-        print(f"Respuesta de OpenAI para matching: {content}")
-        
-        # Parsear JSON
-        result = json.loads(content)
-        
-        return result
-        
-    except Exception as e:
-        print(f"Error en OpenAI para matching: {e}")
-        # Fallback a procesamiento básico
-        return procesar_matching_fallback(texto, productos_actuales)
+            {_RESULTADO_MATCHING_JSON}
+        }}
+    ]
+}}"""
+    return f"""
+Eres un asistente experto en gestión de inventarios. Analiza el texto de entrada de mercadería y haz matching inteligente con los productos existentes.
+
+{bloque_textos}
+
+INVENTARIO ACTUAL:
+{productos_texto}
+
+PROVEEDORES REGISTRADOS:
+{proveedores_texto}
+{INSTRUCCIONES_MATCHING_TEXTO}
+{formato}
+{REGLAS_MATCHING_TEXTO}"""
+
+async def _matching_textos_con_openai(pedidos: List[Tuple[str, List[dict]]]) -> List[dict]:
+    """
+    Matching de uno o varios textos (texto, productos_actuales) en un solo request: las instrucciones,
+    los proveedores y el inventario (la unión de lo relevante para cada texto) se pagan una vez.
+    Si el request agrupado falla, o el modelo no devolvió algún texto, esos se procesan de a uno
+    """
+    if len(pedidos) > 1:
+        try:
+            return await _matching_textos_agrupados(pedidos)
+        except ServicioDegradado:
+            raise
+        except Exception as e:
+            print(f"Error en OpenAI con {len(pedidos)} textos agrupados: {e}")
+            resultados = await asyncio.gather(*(_matching_textos_agrupados([pedido]) for pedido in pedidos),
+                                              return_exceptions=True)
+            return [resultado[0] if isinstance(resultado, list) else resultado for resultado in resultados]
+    return await _matching_textos_agrupados(pedidos)
+
+async def _matching_textos_agrupados(pedidos: List[Tuple[str, List[dict]]]) -> List[dict]:
+    textos = [texto for texto, _ in pedidos]
+    tokens_textos = sum(contar_tokens(texto, MODELO_CHAT) for texto in textos)
+    presupuesto_inventario = max(LLM_PRESUPUESTO_DATOS - tokens_textos, LLM_PRESUPUESTO_DATOS // 4) // len(pedidos)
+    productos_inventario = []
+    for texto, productos_actuales in pedidos:
+        for linea in await asyncio.to_thread(_inventario_para_texto, texto, productos_actuales, presupuesto_inventario):
+            if linea not in productos_inventario:
+                productos_inventario.append(linea)
+    productos_texto = '\n'.join(productos_inventario)
+    
+    # Obtener lista de proveedores para el prompt
+    proveedores = cargar_proveedores()
+    proveedores_texto = '\n'.join([f"- {p.nombre}" for p in proveedores])
+    
+    varios = len(pedidos) > 1
+    resultado = await completar_estructurado(
+        completar_chat, "matching_texto_lote" if varios else "matching_texto",
+        MatchingTextoLote if varios else MatchingTexto,
+        model=MODELO_CHAT,
+        messages=[
+            {"role": "system", "content": "Eres un experto en matching de productos de inventario. Tu trabajo es ser inteligente y flexible para encontrar coincidencias, incluso con nombres similares o sinónimos. Respondes únicamente con JSON válido."},
+            {"role": "user", "content": prompt_matching_texto(textos, productos_texto, proveedores_texto)}
+        ],
+        temperature=0.2,
+        # Análisis + ~80 tokens por producto (a lo sumo uno cada ~10 tokens de texto)
+        max_tokens=max_tokens_respuesta(tokens_textos // 10 + len(pedidos), 80, base=400 * len(pedidos), tope=2000 * len(pedidos))
+    )
+    print(f"Respuesta de OpenAI para matching: {resultado.model_dump_json()}")
+    if not varios:
+        return [resultado.model_dump()]
+    
+    por_id = {item.id: item.model_dump(exclude={'id'}) for item in resultado.resultados if 0 <= item.id < len(pedidos)}
+    faltantes = [i for i in range(len(pedidos)) if i not in por_id]
+    if faltantes:
+        print(f"Reprocesando de a uno {len(faltantes)} de {len(pedidos)} textos agrupados")
+        for i, unico in zip(faltantes, await asyncio.gather(*(_matching_textos_agrupados([pedidos[i]]) for i in faltantes))):
+            por_id[i] = unico[0]
+    return [por_id[i] for i in range(len(pedidos))]
+
+agrupador_matching_texto = AgrupadorSolicitudes(
+    "matching_texto", _matching_textos_con_openai, LLM_VENTANA_AGRUPACION,
+    LLM_MAX_TEXTOS_POR_REQUEST, LLM_PRESUPUESTO_DATOS, lambda pedido: _tokens_texto(pedido[0])
+)
+
+# Similitud mínima (coseno de n-gramas) para que el matching sin OpenAI tome un producto existente
+SCORE_MINIMO_FALLBACK = 0.3
+
+def _buscar_en_inventario(consulta: str, productos_actuales: List[dict], k: int) -> List[Tuple[float, int]]:
+    """
+    Busca en el índice semántico del stock si los productos son del stock (con el mismo nombre);
+    si vienen de otro lado, en un índice temporal con esos productos
+    """
+    with lock_matcher_stock:
+        sincronizar_matcher_stock()
+        if all(indice_semantico.nombre(p.get('id')) == p.get('nombre') for p in productos_actuales):
+            return indice_semantico.buscar(consulta, k=k, score_minimo=SCORE_MINIMO_FALLBACK)
+    indice = IndiceSemantico()
+    indice.sincronizar(productos_actuales)
+    return indice.buscar(consulta, k=k, score_minimo=SCORE_MINIMO_FALLBACK)
 
 def procesar_matching_fallback(texto: str, productos_actuales: List[dict]) -> dict:
     """
-    Procesamiento fallback para matching cuando OpenAI no está disponible
+    SOLO PARA DESARROLLO, cuando OpenAI no está configurado: matching aproximado sin IA.
+    Nunca se usa si la llamada a OpenAI falla. Corre en un thread (consulta el índice semántico)
     """
     productos_detectados = []
     texto_lower = texto.lower()
@@ -885,7 +1351,8 @@ def procesar_matching_fallback(texto: str, productos_actuales: List[dict]) -> di
     if len(texto.strip()) < 5:
         return {
             "productos": [],
-            "analisis_ia": f"Análisis fallback: El texto '{texto}' es muy corto para procesar."
+            "simulado": True,
+            "analisis_ia": f"Análisis simulado (OpenAI no configurado): El texto '{texto}' es muy corto para procesar."
         }
     
     # Verificar que el texto tenga al menos una palabra relacionada con inventario
@@ -899,56 +1366,31 @@ def procesar_matching_fallback(texto: str, productos_actuales: List[dict]) -> di
     if not tiene_contexto:
         return {
             "productos": [],
-            "analisis_ia": f"Análisis fallback: El texto '{texto}' no parece contener información sobre productos o inventario."
+            "simulado": True,
+            "analisis_ia": f"Análisis simulado (OpenAI no configurado): El texto '{texto}' no parece contener información sobre productos o inventario."
         }
     
-    # Palabras clave para detectar productos comunes
-    palabras_clave = {
-        "twistos": ["twistos", "twisted", "snack"],
-        "smirnoff": ["smirnoff", "smirn", "vodka", "lata"],
-        "jamon": ["jamon", "jamón"],
-        "queso": ["queso"],
-        "grapefruit": ["grapef", "pomelo", "toronja"],
-        "lima": ["lima", "lime"],
-        "naranja": ["orang", "naranja"],
-        "coca": ["coca", "cola"],
-        "sprite": ["sprite"],
-        "fanta": ["fanta"],
-        "yogur": ["yogur", "yogurt"],
-        "leche": ["leche"],
-        "pan": ["pan", "lactal"],
-        "fideos": ["fideos", "pasta", "macarrones"],
-        "agua": ["agua"],
-        "cerveza": ["cerveza", "quilmes", "brahma"]
-    }
-    
-    # Buscar coincidencias
-    for producto_actual in productos_actuales:
-        nombre_actual = producto_actual.get('nombre', '').lower()
-        
-        # Buscar coincidencias directas por palabras clave
-        for palabra_base, variantes in palabras_clave.items():
-            if any(variante in texto_lower for variante in variantes):
-                # Verificar si la palabra clave está en el nombre del producto
-                if palabra_base in nombre_actual or any(variante in nombre_actual for variante in variantes):
-                    # Extraer cantidad del texto
-                    numeros = re.findall(r'\d+', texto)
-                    cantidad = int(numeros[0]) if numeros else 1
-                    
-                    productos_detectados.append({
-                        "nombre": producto_actual.get('nombre'),
-                        "cantidad": cantidad,
-                        "precio_sin_impuestos": producto_actual.get('precio_base'),
-                        "accion": "entrada",
-                        "confianza": 85,
-                        "es_nuevo": False,
-                        "producto_id": producto_actual.get('id')
-                    })
-                    break
+    # El producto del inventario más parecido al texto (sin las palabras de movimiento de stock)
+    consulta = ' '.join(palabra for palabra in texto_lower.split() if palabra not in palabras_inventario)
+    por_id = {producto.get('id'): producto for producto in productos_actuales}
+    for score, producto_id in _buscar_en_inventario(consulta, productos_actuales, k=10):
+        producto_actual = por_id.get(producto_id)
+        if producto_actual is None:
+            continue
+        # Extraer cantidad del texto
+        numeros = re.findall(r'\d+', texto)
+        cantidad = int(numeros[0]) if numeros else 1
         
-        # Si ya encontramos un producto, no seguir buscando
-        if productos_detectados:
-            break
+        productos_detectados.append({
+            "nombre": producto_actual.get('nombre'),
+            "cantidad": cantidad,
+            "precio_sin_impuestos": producto_actual.get('precio_base'),
+            "accion": "entrada",
+            "confianza": round(score * 100),
+            "es_nuevo": False,
+            "producto_id": producto_id
+        })
+        break
     
     # Si no se encontró nada, crear producto genérico
     if not productos_detectados:
@@ -967,7 +1409,8 @@ def procesar_matching_fallback(texto: str, productos_actuales: List[dict]) -> di
     
     return {
         "productos": productos_detectados,
-        "analisis_ia": f"Análisis fallback: Procesé el texto '{texto}' y encontré {len(productos_detectados)} coincidencias usando patrones básicos."
+        "simulado": True,
+        "analisis_ia": f"Análisis simulado (OpenAI no configurado): Procesé el texto '{texto}' y encontré {len(productos_detectados)} coincidencias con el índice semántico del inventario."
     }
 
 async def procesar_factura_especifica(texto_factura: str) -> List[ProductDetected]:
@@ -976,7 +1419,7 @@ async def procesar_factura_especifica(texto_factura: str) -> List[ProductDetecte
     """
     # Si OpenAI no está configurado, usar fallback
     if not openai_client:
-        print("OpenAI no configurado, usando procesamiento fallback")
+        print("⚠️ OpenAI no configurado: usando datos SIMULADOS (modo desarrollo)")
         return procesar_texto_fallback(texto_factura)
     
     try:
@@ -1041,62 +1484,25 @@ CRÍTICO:
 Responde SOLO con el JSON válido:
 """
 
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
+        resultado = await completar_estructurado(
+            completar_chat, "extraccion_factura_especifica", ExtraccionProductos,
+            model=MODELO_CHAT,
             messages=[
                 {"role": "system", "content": "Eres un experto en análisis exhaustivo de facturas de distribuidoras. Tu trabajo es encontrar TODOS los productos sin excepción. Debes ser meticuloso y no omitir ningún producto. Respondes únicamente con JSON válido."},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.1,
-            max_tokens=4000
+            max_tokens=max_tokens_respuesta(len(texto_factura.splitlines()), 50)
         )
         
-        # Extraer y parsear la respuesta
-        content = response.choices[0].message.content.strip()
-        
-        # Limpiar la respuesta si tiene marcadores de código
-        if content.startswith('```'):
-            content = content.split('```')[1]
-            if content.startswith('json'):
-                content = content[4:]
-        
-        print(f"Respuesta de OpenAI: {content}")
-        
-        # Parsear JSON
-        result = json.loads(content)
-        
-        # Convertir a objetos ProductDetected
-        productos = []
-        for item in result.get('productos', []):
-            # Mejorar el procesamiento de precios sin impuestos
-            precio_raw = item.get('precio_sin_impuestos') or item.get('precio', 0)  # fallback para compatibilidad
-            precio_procesado = 0
-            
-            if precio_raw:
-                try:
-                    # Limpiar el precio: remover símbolos y normalizar decimales
-                    precio_str = str(precio_raw)
-                    # Remover símbolos como $, espacios
-                    precio_str = precio_str.replace('$', '').replace(' ', '')
-                    # Normalizar decimales (convertir comas a puntos)
-                    precio_str = precio_str.replace(',', '.')
-                    precio_procesado = float(precio_str)
-                except (ValueError, TypeError):
-                    precio_procesado = 0
-            
-            productos.append(ProductDetected(
-                nombre=item['nombre'],
-                cantidad=item['cantidad'],
-                precio_sin_impuestos=precio_procesado if precio_procesado > 0 else None,
-                confianza=item.get('confianza', 95)
-            ))
-        
-        return productos
+        # Un precio en 0 es un precio que el modelo no encontró
+        for producto in resultado.productos:
+            if not producto.precio_sin_impuestos or producto.precio_sin_impuestos <= 0:
+                producto.precio_sin_impuestos = None
+        return resultado.productos
         
-    except Exception as e:
-        print(f"Error en OpenAI procesando factura específica: {e}")
-        # Fallback a procesamiento básico
-        return procesar_texto_fallback(texto_factura)
+    except ValueError as e:
+        raise respuesta_llm_invalida("factura específica", e)
 
 @app.get("/api/proveedores")
 async def get_proveedores():
@@ -1109,56 +1515,336 @@ async def get_proveedores():
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error cargando proveedores: {str(e)}")
 
+# Máximo de productos por página en GET /api/stock
+LIMITE_PAGINA_MAX = 5000
+
+def _campos_pedidos(fields: Optional[str]) -> Optional[Tuple[str, ...]]:
+    return tuple(campo.strip() for campo in fields.split(",") if campo.strip()) if fields else None
+
 @app.get("/api/stock")
-async def get_stock():
+async def get_stock(
+    proveedor_id: Optional[int] = None,
+    categoria: Optional[str] = None,
+    criticos: bool = Query(False, description="Solo productos con stock <= stock_minimo"),
+    buscar: Optional[str] = Query(None, description="Palabras que debe contener el nombre"),
+    orden: str = Query("id", description="Campo de orden, con '-' adelante para descendente"),
+    fields: Optional[str] = Query(None, description="Campos a devolver, separados por coma"),
+    limite: Optional[int] = Query(None, ge=1, le=LIMITE_PAGINA_MAX),
+    cursor: Optional[str] = Query(None, description="siguiente_cursor de la página anterior"),
+    formato: str = Query("json", pattern="^(json|ndjson)$"),
+):
     """
-    Obtiene el stock actual
+    Obtiene el stock actual. Sin parámetros devuelve el inventario completo; con filtros, orden,
+    `fields` o `limite` devuelve esos productos y `siguiente_cursor` para pedir la página siguiente.
+    Con formato=ndjson los productos se envían de a uno por línea mientras se recorren
     """
     try:
-        stock = cargar_stock()
-        proveedores = cargar_proveedores()
-        
-        # Enriquecer con datos del proveedor y precio con impuestos
-        stock_enriquecido = []
-        for producto in stock:
-            proveedor = next((p for p in proveedores if p.id == producto.proveedor_id), None)
-            impuesto = proveedor.impuesto if proveedor else 21
-            precio_con_impuestos = producto.precio_base * (1 + impuesto / 100)
-            
-            producto_dict = producto.model_dump()
-            producto_dict['precio_con_impuestos'] = round(precio_con_impuestos, 2)
-            producto_dict['proveedor_nombre'] = proveedor.nombre if proveedor else "Desconocido"
-            
-            stock_enriquecido.append(producto_dict)
-        
-        return {"stock": stock_enriquecido, "success": True}
+        if formato == "json" and not any((proveedor_id is not None, categoria, criticos, buscar, orden != "id",
+                                          fields, limite, cursor)):
+            # Enriquecimiento vectorizado y JSON cacheado por revisión (ver vista_stock.py), fuera del event loop
+            contenido = await asyncio.to_thread(vista_stock.json_completo)
+            return Response(content=contenido, media_type="application/json")
+
+        consulta = ConsultaStock(proveedor_id=proveedor_id, categoria=categoria, criticos=criticos,
+                                 buscar=buscar, orden=orden, campos=_campos_pedidos(fields))
+        tabla = await asyncio.to_thread(vista_stock.tabla)
+        if formato == "ndjson":
+            lineas = tabla.ndjson(consulta, limite, cursor)
+            # El primer bloque se arma antes de responder, así un cursor inválido da 400 y no un stream cortado
+            primero = await asyncio.to_thread(next, lineas, b"")
+
+            def generar():
+                yield primero
+                yield from lineas
+
+            return StreamingResponse(generar(), media_type="application/x-ndjson")
+
+        productos, siguiente = await asyncio.to_thread(tabla.pagina, consulta, limite, cursor)
+        return Response(content=dumps_json({"stock": productos, "siguiente_cursor": siguiente, "success": True}),
+                        media_type="application/json")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error cargando stock: {str(e)}")
 
+@app.get("/api/stock/exportar")
+async def exportar_stock(
+    formato: str = Query("csv", pattern="^(csv|xlsx)$"),
+    proveedor_id: Optional[int] = None,
+    categoria: Optional[str] = None,
+    criticos: bool = False,
+    buscar: Optional[str] = None,
+    orden: str = "id",
+    fields: Optional[str] = Query(None, description="Columnas a exportar, separadas por coma"),
+):
+    """
+    Descarga el stock (con precio_con_impuestos y proveedor_nombre) en CSV o Excel, con los mismos
+    filtros, orden y campos que GET /api/stock. El archivo se genera y envía por bloques, sin
+    armarlo entero en memoria
+    """
+    try:
+        consulta = ConsultaStock(proveedor_id=proveedor_id, categoria=categoria, criticos=criticos,
+                                 buscar=buscar, orden=orden, campos=_campos_pedidos(fields))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    tabla = await asyncio.to_thread(vista_stock.tabla)
+    contenido = exportar_xlsx(tabla, consulta) if formato == "xlsx" else exportar_csv(tabla, consulta)
+    nombre = f"stock_{date.today():%Y%m%d}.{formato}"
+    return StreamingResponse(contenido, media_type=TIPOS_CONTENIDO[formato],
+                             headers={"Content-Disposition": f'attachment; filename="{nombre}"'})
+
+def cantidad_a_reponer(producto: ProductoStock) -> int:
+    """Unidades a pedir para volver a 2 veces el mínimo (nunca menos que el mínimo)"""
+    return max(2 * producto.stock_minimo - producto.stock, producto.stock_minimo)
+
+def _item_critico(producto: ProductoStock, proveedores: Dict[int, Proveedor]) -> dict:
+    proveedor = proveedores.get(producto.proveedor_id)
+    return {
+        "id": producto.id,
+        "nombre": producto.nombre,
+        "codigo": producto.codigo,
+        "stock": producto.stock,
+        "stock_minimo": producto.stock_minimo,
+        "faltante": producto.stock_minimo - producto.stock,
+        "cantidad_sugerida": cantidad_a_reponer(producto),
+        "precio_base": producto.precio_base,
+        "proveedor_id": producto.proveedor_id,
+        "proveedor_nombre": proveedor.nombre if proveedor else "Desconocido",
+    }
+
+@app.get("/api/stock/criticos")
+async def get_stock_critico(limite: int = Query(50, ge=1, le=1000), proveedor_id: Optional[int] = None):
+    """
+    Los `limite` productos más por debajo de su stock mínimo (stock <= stock_minimo), con la
+    cantidad sugerida para reponer. Sale del índice de críticos del repositorio, sin recorrer el stock
+    """
+    proveedores = {p.id: p for p in reversed(cargar_proveedores())}
+    # El índice es rápido, pero comparte el lock con las transacciones (que corren en threads)
+    criticos = await asyncio.to_thread(repositorio_stock.listar_criticos, limite, proveedor_id)
+    return {"criticos": [_item_critico(p, proveedores) for p in criticos], "success": True}
+
+@app.get("/api/stock/reposicion")
+async def get_reposicion(limite_por_proveedor: int = Query(100, ge=1, le=1000)):
+    """
+    Pedido sugerido por proveedor: sus productos críticos (los más faltantes primero) con la
+    cantidad a reponer y el costo estimado sin impuestos. Los proveedores más urgentes van primero
+    """
+    proveedores = {p.id: p for p in reversed(cargar_proveedores())}
+    grupos = await asyncio.to_thread(repositorio_stock.criticos_por_proveedor, limite_por_proveedor)
+    pedidos = []
+    for proveedor_id, criticos in sorted(grupos.items(), key=lambda g: (g[1][0].stock - g[1][0].stock_minimo, g[0])):
+        items = [_item_critico(p, proveedores) for p in criticos]
+        pedidos.append({
+            "proveedor_id": proveedor_id,
+            "proveedor_nombre": items[0]["proveedor_nombre"],
+            "productos": items,
+            "unidades": sum(item["cantidad_sugerida"] for item in items),
+            "costo_estimado": round(sum(item["cantidad_sugerida"] * item["precio_base"] for item in items), 2),
+        })
+    return {"proveedores": pedidos, "success": True}
+
+@app.post("/api/stock/ajustes")
+async def ajustar_stock_masivo(request: Request, dry_run: bool = False, origen: str = "ajuste",
+                               formato: Optional[str] = Query(None, pattern="^(json|csv|ndjson)$")):
+    """
+    Ajuste masivo (conteo físico, importación): filas {id|codigo, delta|absoluto[, version]} en JSON
+    (lista u objeto {"ajustes": [...]}), CSV con encabezado o NDJSON, según el Content-Type o `formato`.
+    Se aplican todas en una transacción con una sola escritura y un resultado por fila; con
+    dry_run=true devuelve los mismos resultados sin guardar nada
+    """
+    bloques, total = [], 0
+    async for bloque in request.stream():
+        total += len(bloque)
+        if total > MAX_AJUSTES_BYTES:
+            raise _error_archivo_grande(MAX_AJUSTES_BYTES)
+        bloques.append(bloque)
+    try:
+        filas = leer_filas(b"".join(bloques), formato or formato_de(request.headers.get("content-type")))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    def aplicar():
+        try:
+            with repositorio_stock.transaccion() as tx:
+                resultados = aplicar_ajustes(tx, filas, repositorio_stock.obtener_por_codigo)
+                if dry_run:
+                    raise SimulacionAjustes(resultados)
+        except SimulacionAjustes as simulacion:
+            return simulacion.resultados
+        registrar_movimientos(tx, origen=origen)
+        return resultados
+
+    resultados = await asyncio.to_thread(aplicar)
+    aplicadas = sum(1 for r in resultados if r["estado"] == "ok")
+    errores = sum(1 for r in resultados if r["estado"] == "error")
+    print(f"📦 Ajuste masivo{' (dry-run)' if dry_run else ''}: {len(resultados)} filas, {aplicadas} con cambios, {errores} errores")
+    return {
+        "dry_run": dry_run,
+        "filas": len(resultados),
+        "aplicadas": aplicadas,
+        "sin_cambios": len(resultados) - aplicadas - errores,
+        "errores": errores,
+        "resultados": resultados,
+        "success": True,
+    }
+
+@app.post("/api/stock/importar")
+async def importar_stock(file: UploadFile = File(...), proveedor_id: int = Query(...), crear_nuevos: bool = True,
+                         dry_run: bool = False, origen: str = "lista_precios"):
+    """
+    Importa la lista de precios de un proveedor (CSV o XLSX con encabezado: codigo y/o nombre,
+    precio, y opcionalmente categoria, stock_minimo y cantidad). Actualiza los precios de los
+    productos que ya existen, crea los que faltan y suma la cantidad como entrada de stock.
+    El archivo se lee fila por fila y se aplica de a bloques, cada uno en su transacción
+    """
+    if not any(p.id == proveedor_id for p in cargar_proveedores()):
+        raise HTTPException(status_code=400, detail=f"No existe el proveedor {proveedor_id}")
+    formato = formato_de_archivo(file.filename, file.content_type)
+    ruta = await guardar_upload_en_disco(file, MAX_IMPORTACION_BYTES, suffix=f".{formato}")
+    try:
+        resumen, creados = await asyncio.to_thread(
+            importar_lista_precios, repositorio_stock, leer_lista_precios(ruta, formato), proveedor_id,
+            crear_nuevos, dry_run, functools.partial(registrar_movimientos, factura=file.filename, origen=origen)
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        os.unlink(ruta)
+
+    # Los productos nuevos se indexan enseguida, como en PUT /api/stock
+    if creados:
+        await asyncio.to_thread(indexar_productos_creados, creados)
+    print(f"📥 Lista de precios{' (dry-run)' if dry_run else ''} de {file.filename}: {resumen['filas']} filas, "
+          f"{resumen['actualizados']} actualizados, {resumen['nuevos']} nuevos, {resumen['errores']} errores")
+    return {"dry_run": dry_run, **resumen, "success": True}
+
 class ActualizarStockRequest(BaseModel):
     productos_actualizados: List[dict]
+    # Para el historial de movimientos: factura de origen (número o nombre de archivo) y de dónde vino
+    factura: Optional[str] = None
+    origen: Optional[str] = None
+
+def registrar_movimientos(tx, factura: Optional[str] = None, origen: Optional[str] = None):
+    """
+    Pasa al historial los cambios de stock de una transacción ya confirmada: los ajustes como
+    entrada/salida y los productos nuevos como alta con su stock inicial
+    """
+    movimientos = []
+    for producto_id, producto in tx.cambios.items():
+        if producto_id in tx.movimientos:
+            delta, accion = tx.movimientos[producto_id], None
+        elif producto.version == 0:
+            delta, accion = producto.stock, 'alta'
+        else:
+            continue
+        movimientos.append({
+            "producto_id": producto_id, "delta": delta, "accion": accion, "proveedor_id": producto.proveedor_id,
+            "factura": factura, "origen": origen, "ts": producto.ultima_actualizacion,
+        })
+    try:
+        historial_movimientos.registrar(movimientos)
+    except Exception as e:
+        # El stock ya quedó guardado: el historial no debe hacer fallar la actualización
+        print(f"⚠️ No se pudo registrar el historial de movimientos: {e}")
 
-async def procesar_matching_con_openai(productos_detectados: List[dict], stock_actual: List[ProductoStock]) -> dict:
+def _resolver_con_matcher(productos_detectados: List[dict]) -> List[Tuple[ResultadoMatch, Optional[ProductoStock]]]:
     """
-    Usa OpenAI para hacer matching inteligente entre productos detectados y stock existente
+    Resuelve cada producto con matcher_stock puesto al día por revisión (en un thread).
+    Devuelve (resultado, producto del stock) por producto; el producto solo si se resolvió localmente
     """
+    with lock_matcher_stock:
+        sincronizar_matcher_stock()
+        indice_semantico.guardar_si_hace_falta(INDICE_GUARDAR_CADA)
+        resultados = [matcher_stock.resolver(p['nombre']) for p in productos_detectados]
+    return [
+        (resultado, repositorio_stock.obtener(resultado.producto_id) if resultado.estado in ('exacto', 'alto') else None)
+        for resultado in resultados
+    ]
+
+async def procesar_matching_con_openai(productos_detectados: List[dict]) -> dict:
+    """
+    Matching entre productos detectados y stock existente. Las coincidencias exactas y de alta
+    confianza se resuelven localmente; solo los casos ambiguos van a OpenAI, con sus candidatos
+    """
+    resueltos = await asyncio.to_thread(_resolver_con_matcher, productos_detectados)
+    
+    actualizaciones = []
+    nuevos = []
+    ambiguos = []
+    for p, (resultado, producto) in zip(productos_detectados, resueltos):
+        if producto is not None:
+            actualizaciones.append({
+                "producto_detectado": p['nombre'],
+                "stock_id": producto.id,
+                "stock_nombre": producto.nombre,
+                "cantidad": p['cantidad'],
+                "accion": p.get('accion', 'entrada')
+            })
+            continue
+        # Un producto dado de baja después de la sincronización no cuenta como candidato
+        candidatos = [producto_id for _, producto_id in resultado.candidatos if producto_id != resultado.producto_id]
+        if candidatos:
+            ambiguos.append((p, candidatos))
+        else:
+            nuevos.append(p)
+    
+    print(f"Matching local: {len(actualizaciones)} resueltos, {len(nuevos)} sin coincidencia, {len(ambiguos)} ambiguos")
+    
+    if not ambiguos:
+        return {"actualizaciones": actualizaciones, "nuevos": nuevos}
+    
     if not openai_client:
-        print("OpenAI no configurado, usando matching básico")
-        return {"actualizaciones": [], "nuevos": productos_detectados}
+        print("OpenAI no configurado, los productos ambiguos se crean como nuevos")
+        return {"actualizaciones": actualizaciones, "nuevos": nuevos + [p for p, _ in ambiguos]}
     
-    try:
-        # Preparar listas para el prompt
-        productos_detectados_str = "\n".join([
-            f"- {p['nombre']} (cantidad: {p['cantidad']}, acción: {p.get('accion', 'entrada')}, precio: {p.get('precio_sin_impuestos', 'N/A')})"
-            for p in productos_detectados
-        ])
-        
-        productos_stock_str = "\n".join([
-            f"- ID:{p.id} {p.nombre} (stock actual: {p.stock})"
-            for p in stock_actual
-        ]) if stock_actual else "NO HAY PRODUCTOS EN STOCK"
-        
-        prompt = f"""
+    # Las líneas de los candidatos se leen del repositorio una vez, en un thread
+    ids_candidatos = {producto_id for _, ids in ambiguos for producto_id in ids}
+    lineas_candidatos = await asyncio.to_thread(
+        lambda: {producto_id: _linea_candidato_stock(producto_id) for producto_id in ids_candidatos}
+    )
+    
+    # Los ambiguos se agrupan para que cada request (productos + sus candidatos) entre en el
+    # presupuesto de tokens; los grupos se resuelven en paralelo
+    def costo(ambiguo) -> int:
+        p, ids = ambiguo
+        lineas = [_linea_producto_detectado(p)] + [lineas_candidatos[producto_id] for producto_id in ids]
+        return contar_tokens("\n".join(lineas), MODELO_CHAT)
+    
+    grupos = agrupar_por_presupuesto(ambiguos, LLM_PRESUPUESTO_DATOS, costo)
+    resultados = await asyncio.gather(*(_resolver_ambiguos_con_openai(grupo, lineas_candidatos) for grupo in grupos),
+                                      return_exceptions=True)
+    for grupo, result in zip(grupos, resultados):
+        # Si OpenAI falla o responde algo inválido, los ambiguos no se crean como nuevos:
+        # se duplicarían productos que ya existen
+        if isinstance(result, ValueError):
+            raise respuesta_llm_invalida("matching de stock", result)
+        if isinstance(result, Exception):
+            raise result
+        actualizaciones += result.get('actualizaciones', [])
+        nuevos += result.get('nuevos', [])
+    return {"actualizaciones": actualizaciones, "nuevos": nuevos}
+
+def _linea_producto_detectado(p: dict) -> str:
+    return f"- {p['nombre']} (cantidad: {p['cantidad']}, acción: {p.get('accion', 'entrada')}, precio: {p.get('precio_sin_impuestos', 'N/A')})"
+
+def _linea_candidato_stock(producto_id: int) -> str:
+    p = repositorio_stock.obtener(producto_id)
+    return f"- ID:{p.id} {p.nombre} (stock actual: {p.stock})" if p else ""
+
+async def _resolver_ambiguos_con_openai(ambiguos: List[Tuple[dict, List[int]]], lineas_candidatos: Dict[int, str]) -> dict:
+    """
+    Pide a OpenAI el matching de un grupo de productos ambiguos contra la unión de sus candidatos
+    (`lineas_candidatos`: la línea del prompt de cada candidato, ya leída del repositorio)
+    """
+    # Preparar listas para el prompt: solo los ambiguos y sus candidatos, no todo el catálogo
+    productos_detectados_str = "\n".join([_linea_producto_detectado(p) for p, _ in ambiguos])
+    
+    ids_candidatos = sorted({producto_id for _, ids in ambiguos for producto_id in ids})
+    productos_stock_str = "\n".join(
+        linea for linea in (lineas_candidatos[producto_id] for producto_id in ids_candidatos) if linea
+    ) or "NO HAY PRODUCTOS EN STOCK"
+    
+    prompt = f"""
 Eres un experto en gestión de inventarios. Tu tarea es hacer MATCHING EXACTO entre productos detectados y productos existentes en stock.
 
 PRODUCTOS DETECTADOS EN LA FACTURA:
@@ -1219,34 +1905,20 @@ IMPORTANTE: CONSERVA SIEMPRE los precios originales de los productos detectados.
 Responde SOLO con el JSON válido:
 """
 
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "Eres un experto en matching de productos para inventarios. Debes ser muy preciso y conservador en las coincidencias. Respondes únicamente con JSON válido."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.1,
-            max_tokens=2000
-        )
-        
-        content = response.choices[0].message.content.strip()
-        
-        # Limpiar la respuesta si tiene marcadores de código
-        if content.startswith('```'):
-            content = content.split('```')[1]
-            if content.startswith('json'):
-                content = content[4:]
-        
-        print(f"Respuesta de matching OpenAI: {content}")
-        
-        # Parsear JSON
-        result = json.loads(content)
-        return result
-        
-    except Exception as e:
-        print(f"Error en matching con OpenAI: {e}")
-        # Fallback: todos los productos como nuevos
-        return {"actualizaciones": [], "nuevos": productos_detectados}
+    resultado = await completar_estructurado(
+        completar_chat, "matching_stock", MatchingStock,
+        model=MODELO_CHAT,
+        messages=[
+            {"role": "system", "content": "Eres un experto en matching de productos para inventarios. Debes ser muy preciso y conservador en las coincidencias. Respondes únicamente con JSON válido."},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.1,
+        # ~60 tokens por producto, vaya a actualizaciones o a nuevos
+        max_tokens=max_tokens_respuesta(len(ambiguos), 60, tope=2000)
+    )
+    
+    print(f"Respuesta de matching OpenAI: {resultado.model_dump_json()}")
+    return resultado.model_dump()
 
 @app.put("/api/stock")
 async def actualizar_stock(request: ActualizarStockRequest):
@@ -1254,7 +1926,8 @@ async def actualizar_stock(request: ActualizarStockRequest):
     Actualiza el stock con los productos detectados usando matching inteligente con OpenAI
     """
     try:
-        stock_actual = cargar_stock()
+        # Las lecturas del repositorio esperan detrás de las transacciones de otros threads: fuera del event loop
+        stock_actual = await asyncio.to_thread(cargar_stock)
         productos_actualizados = 0
         productos_nuevos = 0
         productos_con_error = 0
@@ -1270,86 +1943,496 @@ async def actualizar_stock(request: ActualizarStockRequest):
             print(f"  {i+1}. {p['nombre']} - Cantidad: {p['cantidad']} - Precio: {precio}")
         print("=" * 50)
         
-        # Usar OpenAI para hacer matching inteligente
-        matching_result = await procesar_matching_con_openai(request.productos_actualizados, stock_actual)
+        # Los productos que ya vienen matcheados (p. ej. desde /process-text) se aplican directo por ID
+        ids_existentes = await asyncio.to_thread(
+            lambda: {p['producto_id'] for p in request.productos_actualizados
+                     if p.get('producto_id') and not p.get('es_nuevo') and repositorio_stock.obtener(p['producto_id'])}
+        )
+        actualizaciones_directas = []
+        productos_a_matchear = []
+        for p in request.productos_actualizados:
+            if p.get('producto_id') in ids_existentes and not p.get('es_nuevo'):
+                actualizaciones_directas.append({
+                    "stock_id": p['producto_id'],
+                    "cantidad": p['cantidad'],
+                    "accion": p.get('accion', 'entrada'),
+                    "version": p.get('version')
+                })
+            else:
+                productos_a_matchear.append(p)
+        
+        # Usar OpenAI para hacer matching inteligente del resto
+        matching_result = {"actualizaciones": [], "nuevos": []}
+        if productos_a_matchear:
+            matching_result = await procesar_matching_con_openai(productos_a_matchear)
         
         print(f"Matching IA resultado:")
+        print(f"- Directos por ID: {len(actualizaciones_directas)}")
         print(f"- Actualizaciones: {len(matching_result.get('actualizaciones', []))}")
         print(f"- Nuevos: {len(matching_result.get('nuevos', []))}")
         
-        # Procesar actualizaciones de productos existentes
-        for actualizacion in matching_result.get('actualizaciones', []):
-            try:
-                stock_id = actualizacion['stock_id']
-                cantidad = actualizacion['cantidad']
-                accion = actualizacion['accion']
+        conflictos = []
+        creados = []
+        # La transacción corre con lock entre workers (no se pierden incrementos ni se repiten IDs) y
+        # escribe a disco: va en un thread para no frenar el event loop mientras espera el lock
+        def aplicar_cambios():
+            nonlocal productos_actualizados, productos_nuevos, productos_con_error
+            with repositorio_stock.transaccion() as tx:
+                # Procesar actualizaciones de productos existentes
+                for actualizacion in actualizaciones_directas + matching_result.get('actualizaciones', []):
+                    try:
+                        stock_id = actualizacion['stock_id']
+                        cantidad = actualizacion['cantidad']
+                        accion = actualizacion['accion']
+                    
+                        # Buscar el producto por ID (lookup O(1) en el repositorio)
+                        delta = cantidad if accion == 'entrada' else -cantidad
+                        producto = tx.ajustar_stock(stock_id, delta, version_esperada=actualizacion.get('version'))
+                        if producto:
+                            productos_actualizados += 1
+                            print(f"Actualizado: {producto.nombre} -> Stock: {producto.stock}")
                 
-                # Encontrar el producto por ID
-                for i, producto in enumerate(stock_actual):
-                    if producto.id == stock_id:
-                        if accion == 'entrada':
-                            stock_actual[i].stock += cantidad
-                        else:
-                            stock_actual[i].stock -= cantidad
-                        
-                        stock_actual[i].ultima_actualizacion = datetime.now().isoformat()
-                        productos_actualizados += 1
-                        print(f"Actualizado: {producto.nombre} -> Stock: {stock_actual[i].stock}")
-                        break
-                        
-            except Exception as e:
-                print(f"Error procesando actualización: {e}")
-                productos_con_error += 1
+                    except ConflictoVersion as e:
+                        print(f"Conflicto de versión: {e}")
+                        conflictos.append({
+                            "producto_id": e.producto_id,
+                            "version_esperada": e.version_esperada,
+                            "version_actual": e.version_actual
+                        })
+                        productos_con_error += 1
+                    except Exception as e:
+                        print(f"Error procesando actualización: {e}")
+                        productos_con_error += 1
+            
+                # Procesar productos nuevos
+                for nuevo_producto in matching_result.get('nuevos', []):
+                    try:
+                        precio_base = nuevo_producto.get('precio_sin_impuestos', 0) or 0
+                    
+                        producto_nuevo = tx.agregar(
+                            nombre=nuevo_producto['nombre'],
+                            stock=nuevo_producto['cantidad'] if nuevo_producto['accion'] == 'entrada' else 0,
+                            stock_minimo=5,
+                            precio_base=precio_base,
+                            categoria="Nuevo",
+                            proveedor_id=1
+                        )
+                    
+                        productos_nuevos += 1
+                        creados.append(producto_nuevo)
+                        print(f"Nuevo producto: {producto_nuevo.nombre} -> Stock: {producto_nuevo.stock}")
+                    
+                    except Exception as e:
+                        print(f"Error creando producto nuevo: {e}")
+                        productos_con_error += 1
+            
+                # Los cambios se guardan al cerrar la transacción
+                print(f"\nGuardando {len(tx.cambios)} productos modificados en el journal de stock...")
+            print(f"Stock guardado correctamente.")
         
-        # Procesar productos nuevos
-        for nuevo_producto in matching_result.get('nuevos', []):
-            try:
-                nuevo_id = max([p.id for p in stock_actual] if stock_actual else [0]) + 1
-                precio_base = nuevo_producto.get('precio_sin_impuestos', 0) or 0
-                
-                producto_nuevo = ProductoStock(
-                    id=nuevo_id,
-                    nombre=nuevo_producto['nombre'],
-                    stock=nuevo_producto['cantidad'] if nuevo_producto['accion'] == 'entrada' else 0,
-                    stock_minimo=5,
-                    precio_base=precio_base,
-                    categoria="Nuevo",
-                    codigo=f"AUTO{nuevo_id:03d}",
-                    proveedor_id=1,
-                    ultima_actualizacion=datetime.now().isoformat()
-                )
-                
-                stock_actual.append(producto_nuevo)
-                productos_nuevos += 1
-                print(f"Nuevo producto: {producto_nuevo.nombre} -> Stock: {producto_nuevo.stock}")
-                
-            except Exception as e:
-                print(f"Error creando producto nuevo: {e}")
-                productos_con_error += 1
+            registrar_movimientos(tx, request.factura, request.origen)
+
+        await asyncio.to_thread(aplicar_cambios)
         
-        # Guardar cambios
-        print(f"\nGuardando {len(stock_actual)} productos en stock.json...")
-        guardar_stock(stock_actual)
-        print(f"Stock guardado correctamente.")
+        # Los productos nuevos se indexan enseguida, sin esperar a la próxima sincronización
+        await asyncio.to_thread(indexar_productos_creados, creados)
         
         return {
             "message": f"Stock actualizado con IA: {productos_actualizados} actualizados, {productos_nuevos} nuevos, {productos_con_error} errores",
             "productos_actualizados": productos_actualizados,
             "productos_nuevos": productos_nuevos,
             "productos_con_error": productos_con_error,
+            "conflictos": conflictos,
             "success": True
         }
         
+    except ServicioDegradado:
+        raise
     except Exception as e:
         print(f"Error actualizando stock: {e}")
         raise HTTPException(status_code=500, detail=f"Error actualizando stock: {str(e)}")
 
+# --- Historial de movimientos y reportes ---
+# Los reportes leen los agregados por hora/día/mes de data/movimientos.db, no los eventos
+
+# Rango por defecto de cada granularidad, en días hacia atrás desde hoy
+RANGO_REPORTE_DIAS = {"hora": 2, "dia": 30, "mes": 365}
+
+def _rango_periodos(granularidad: str, desde: Optional[date], hasta: Optional[date]) -> Tuple[str, str]:
+    """Períodos [desde, hasta) de la granularidad para las fechas pedidas (ambas incluidas)"""
+    hasta = hasta or date.today()
+    desde = desde or hasta - timedelta(days=RANGO_REPORTE_DIAS[granularidad] - 1)
+    if desde > hasta:
+        raise HTTPException(status_code=400, detail="'desde' es posterior a 'hasta'")
+    fin = hasta + timedelta(days=1)
+    if granularidad == "mes":
+        desde = desde.replace(day=1)
+        fin = (hasta.replace(day=28) + timedelta(days=4)).replace(day=1)
+    formato = FORMATOS_PERIODO[granularidad]
+    return desde.strftime(formato), fin.strftime(formato)
+
+@app.get("/api/movimientos")
+async def get_movimientos(producto_id: Optional[int] = None, limite: int = Query(100, ge=1, le=1000)):
+    """Últimos movimientos de stock (de todos los productos o de uno), del más reciente al más viejo"""
+    return {"movimientos": historial_movimientos.listar(producto_id, limite), "success": True}
+
+@app.get("/api/reportes/movimientos")
+async def get_reporte_movimientos(
+    granularidad: str = Query("dia", pattern="^(hora|dia|mes)$"),
+    desde: Optional[date] = None,
+    hasta: Optional[date] = None,
+    producto_id: Optional[int] = None,
+    proveedor_id: Optional[int] = None,
+):
+    """
+    Entradas y salidas (unidades) por hora, día o mes entre `desde` y `hasta` (incluidos): del
+    total, de un producto o de un proveedor. Solo aparecen los períodos con movimientos
+    """
+    periodo_desde, periodo_hasta = _rango_periodos(granularidad, desde, hasta)
+    serie = historial_movimientos.serie(granularidad, periodo_desde, periodo_hasta, producto_id, proveedor_id)
+    return {
+        "granularidad": granularidad,
+        "desde": periodo_desde,
+        "hasta": periodo_hasta,
+        "serie": serie,
+        "entradas": sum(p["entradas"] for p in serie),
+        "salidas": sum(p["salidas"] for p in serie),
+        "success": True,
+    }
+
+@app.get("/api/reportes/velocidad")
+async def get_reporte_velocidad(
+    dias: int = Query(30, ge=1, le=3660),
+    limite: int = Query(20, ge=1, le=500),
+    proveedor_id: Optional[int] = None,
+):
+    """
+    Velocidad de venta de los últimos `dias` (hoy incluido): los productos con más salidas,
+    con unidades por día y los días de stock que quedan a ese ritmo
+    """
+    hoy = date.today()
+    totales = historial_movimientos.totales_por_producto(hoy - timedelta(days=dias - 1), hoy + timedelta(days=1),
+                                                         proveedor_id)
+    ranking = sorted(((t["salidas"], producto_id) for producto_id, t in totales.items() if t["salidas"]), reverse=True)
+    ranking = ranking[:limite]
+    por_id = await asyncio.to_thread(lambda: {producto_id: repositorio_stock.obtener(producto_id)
+                                              for _, producto_id in ranking})
+    productos = []
+    for salidas, producto_id in ranking:
+        producto = por_id[producto_id]
+        velocidad = salidas / dias
+        productos.append({
+            "producto_id": producto_id,
+            "nombre": producto.nombre if producto else None,
+            "salidas": salidas,
+            "entradas": totales[producto_id]["entradas"],
+            "unidades_por_dia": round(velocidad, 2),
+            "stock": producto.stock if producto else None,
+            "dias_de_stock": round(producto.stock / velocidad, 1) if producto and producto.stock > 0 else 0,
+        })
+    return {"dias": dias, "productos": productos, "success": True}
+
+# --- Pronóstico de demanda ---
+
+@app.get("/api/pronostico/{producto_id}")
+async def get_pronostico(producto_id: int):
+    """Pronóstico de demanda de un producto y el stock_minimo dinámico que resulta"""
+    # Repositorio y pronóstico esperan a las escrituras en curso: se leen en un thread
+    def leer():
+        producto = repositorio_stock.obtener(producto_id)
+        if producto is None:
+            return None, None, None
+        pronostico_demanda.actualizar()
+        return producto, pronostico_demanda.producto(producto_id), \
+            pronostico_demanda.cantidad_a_reponer(producto_id, producto.stock)
+
+    producto, pronostico, cantidad_sugerida = await asyncio.to_thread(leer)
+    if producto is None:
+        raise HTTPException(status_code=404, detail="Producto no encontrado")
+    return {
+        "producto_id": producto_id,
+        "nombre": producto.nombre,
+        "stock": producto.stock,
+        "stock_minimo_actual": producto.stock_minimo,
+        "pronostico": pronostico,
+        "cantidad_sugerida": cantidad_sugerida,
+        "success": True,
+    }
+
+@app.get("/api/sugerencias")
+async def get_sugerencias(proveedor_id: Optional[int] = None):
+    """
+    Pedidos sugeridos por proveedor según el pronóstico: productos con stock <= stock_minimo dinámico,
+    con la cantidad para cubrir la entrega y los días de cobertura. Los productos sin ventas
+    suficientes para pronosticar se sugieren por su stock_minimo cargado, como en /api/stock/reposicion
+    """
+    # Las lecturas del repositorio y del pronóstico esperan a las escrituras en curso: se hacen en un thread
+    def leer_pronosticos():
+        pronostico_demanda.actualizar()
+        puntos = pronostico_demanda.puntos_de_pedido()
+        faltantes = []
+        for producto_id, punto in puntos.items():
+            producto = repositorio_stock.obtener(producto_id)
+            if producto is None or producto.stock > punto or proveedor_id not in (None, producto.proveedor_id):
+                continue
+            faltantes.append((producto, punto, pronostico_demanda.cantidad_a_reponer(producto_id, producto.stock),
+                              pronostico_demanda.producto(producto_id)))
+        return puntos, faltantes
+
+    puntos, faltantes = await asyncio.to_thread(leer_pronosticos)
+    proveedores = {p.id: p for p in reversed(cargar_proveedores())}
+    items: Dict[int, List[dict]] = {}
+    for producto, punto, cantidad_sugerida, pronostico in faltantes:
+        item = _item_critico(producto, proveedores)
+        item.update({
+            "stock_minimo": punto,
+            "faltante": punto - producto.stock,
+            "cantidad_sugerida": cantidad_sugerida,
+            "demanda_diaria": pronostico["demanda_diaria"],
+            "segun": "pronostico",
+        })
+        items.setdefault(producto.proveedor_id, []).append(item)
+    grupos = await asyncio.to_thread(repositorio_stock.criticos_por_proveedor)
+    for grupo_proveedor, criticos in grupos.items():
+        if proveedor_id not in (None, grupo_proveedor):
+            continue
+        for producto in criticos:
+            if producto.id not in puntos:
+                items.setdefault(grupo_proveedor, []).append({**_item_critico(producto, proveedores), "segun": "stock_minimo"})
+
+    pedidos = []
+    for grupo_proveedor, grupo in items.items():
+        grupo.sort(key=lambda item: (-item["faltante"], item["id"]))
+        pedidos.append({
+            "proveedor_id": grupo_proveedor,
+            "proveedor_nombre": grupo[0]["proveedor_nombre"],
+            "productos": grupo,
+            "unidades": sum(item["cantidad_sugerida"] for item in grupo),
+            "costo_estimado": round(sum(item["cantidad_sugerida"] * item["precio_base"] for item in grupo), 2),
+        })
+    pedidos.sort(key=lambda pedido: (-pedido["productos"][0]["faltante"], pedido["proveedor_id"]))
+    return {"proveedores": pedidos, "success": True}
+
+@app.post("/api/pronostico/aplicar")
+async def aplicar_pronostico():
+    """
+    Guarda como stock_minimo de cada producto con pronóstico su punto de pedido dinámico, en una
+    sola transacción (el índice de críticos se actualiza con ella)
+    """
+    await asyncio.to_thread(pronostico_demanda.actualizar)
+
+    def aplicar() -> int:
+        actualizados = 0
+        with repositorio_stock.transaccion() as tx:
+            for producto_id, punto in pronostico_demanda.puntos_de_pedido().items():
+                producto = tx.obtener(producto_id)
+                if producto is not None and producto.stock_minimo != punto:
+                    tx.reemplazar(producto.model_copy(update={"stock_minimo": punto}))
+                    actualizados += 1
+        return actualizados
+
+    # Toca todo el catálogo con el lock del repositorio: fuera del event loop
+    actualizados = await asyncio.to_thread(aplicar)
+    print(f"📈 stock_minimo dinámico aplicado a {actualizados} productos")
+    return {"productos_actualizados": actualizados, "success": True}
+
+# --- Cola de trabajos en segundo plano ---
+# Facturas y audios se pueden encolar: el request devuelve un trabajo_id enseguida y los workers
+# de la cola (TRABAJOS_WORKERS por proceso) hacen el OCR/Whisper/LLM con reintentos
+
+# Errores de Textract que no se arreglan reintentando
+ERRORES_TEXTRACT_PERMANENTES = {
+    "InvalidParameterException", "UnsupportedDocumentException", "BadDocumentException",
+    "DocumentTooLargeException", "AccessDeniedException"
+}
+
+cola_trabajos = ColaTrabajos(
+    os.path.join(DATA_DIR, "trabajos.db"),
+    os.path.join(DATA_DIR, "trabajos"),
+    max_intentos=int(os.getenv("TRABAJOS_MAX_INTENTOS", "4")),
+    backoff_base=float(os.getenv("TRABAJOS_BACKOFF_SEGUNDOS", "2"))
+)
+
+async def _trabajo_factura(payload: dict, ruta_archivo: str) -> dict:
+    if not textract_client:
+        raise ErrorPermanente("AWS Textract no está configurado")
+    with open(ruta_archivo, "rb") as f:
+        image_bytes = f.read()
+    try:
+        response = await detectar_texto_textract(image_bytes)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ERRORES_TEXTRACT_PERMANENTES:
+            raise ErrorPermanente(f"Error en AWS Textract: {e}")
+        raise
+    layout = analizar_respuesta(response)
+    texto_completo = layout.texto
+    proveedor_detectado, confianza_proveedor = detectar_proveedor_con_confianza(texto_completo)
+    productos_detectados = await extraer_productos_factura(texto_completo, proveedor_detectado, layout, interactivo=False)
+    return armar_respuesta_factura(texto_completo, proveedor_detectado, productos_detectados, confianza_proveedor).model_dump()
+
+async def _trabajo_audio(payload: dict, ruta_archivo: str) -> dict:
+    if not openai_client:
+        raise ErrorPermanente("OpenAI Whisper no está configurado. Configure OPENAI_API_KEY.")
+    productos_actuales_list = payload.get("productos_actuales") or [p.model_dump() for p in await asyncio.to_thread(cargar_stock)]
+    try:
+        resultado = await procesar_audio_guardado(ruta_archivo, productos_actuales_list)
+    except HTTPException as e:
+        # Audio sin contenido útil: reintentar no cambia nada
+        raise ErrorPermanente(e.detail)
+    return jsonable_encoder(resultado)
+
+cola_trabajos.registrar("factura", _trabajo_factura)
+cola_trabajos.registrar("audio", _trabajo_audio)
+
+@app.on_event("startup")
+async def iniciar_cola_trabajos():
+    cola_trabajos.purgar(float(os.getenv("TRABAJOS_RETENCION_HORAS", "72")) * 3600)
+    cola_trabajos.iniciar_workers(int(os.getenv("TRABAJOS_WORKERS", "2")))
+
+@app.on_event("shutdown")
+async def detener_cola_trabajos():
+    await cola_trabajos.detener_workers()
+
+@app.on_event("startup")
+async def preparar_indice_semantico():
+    # Con el índice guardado solo se vectorizan los productos nuevos o renombrados desde entonces
+    def preparar():
+        with lock_matcher_stock:
+            sincronizar_matcher_stock()
+            indice_semantico.guardar_si_hace_falta(1)
+    await asyncio.to_thread(preparar)
+
+@app.on_event("shutdown")
+async def guardar_indice_semantico():
+    indice_semantico.guardar_si_hace_falta(1)
+
+@app.post("/api/trabajos/factura")
+async def encolar_factura(file: UploadFile = File(...)):
+    """
+    Encola una factura para procesarla en segundo plano (mismo resultado que /process-invoice)
+    """
+    if not file.content_type or not file.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="El archivo debe ser una imagen")
+    ruta = await guardar_upload_en_disco(file, MAX_IMAGEN_BYTES, suffix=os.path.splitext(file.filename or "")[1],
+                                         directorio=cola_trabajos.directorio_archivos)
+    trabajo = await asyncio.to_thread(cola_trabajos.encolar, "factura", {"archivo": file.filename}, ruta)
+    return {"trabajo_id": trabajo["id"], "estado": trabajo["estado"], "success": True}
+
+@app.post("/api/trabajos/audio")
+async def encolar_audio(file: UploadFile = File(...), productos_actuales: str = Form("[]")):
+    """
+    Encola un audio para transcribirlo y procesarlo en segundo plano (mismo resultado que /process-audio)
+    """
+    audio_types = ['audio/mpeg', 'audio/wav', 'audio/m4a', 'audio/mp4', 'audio/webm', 'audio/flac']
+    if file.content_type not in audio_types:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Tipo de archivo no soportado. Use: {', '.join(audio_types)}"
+        )
+    try:
+        productos_actuales_list = json.loads(productos_actuales) if productos_actuales != "[]" else []
+    except json.JSONDecodeError:
+        productos_actuales_list = []
+    
+    ruta = await guardar_upload_en_disco(file, MAX_AUDIO_BYTES, suffix=extension_audio(file.content_type),
+                                         directorio=cola_trabajos.directorio_archivos)
+    if os.path.getsize(ruta) < 1000:
+        os.unlink(ruta)
+        raise HTTPException(status_code=400, detail="El audio es muy corto. Grabe al menos 1-2 segundos.")
+    
+    trabajo = await asyncio.to_thread(
+        cola_trabajos.encolar,
+        "audio",
+        {"archivo": file.filename, "productos_actuales": productos_actuales_list},
+        ruta
+    )
+    return {"trabajo_id": trabajo["id"], "estado": trabajo["estado"], "success": True}
+
+@app.get("/api/trabajos")
+async def listar_trabajos(estado: str = None, limite: int = Query(100, ge=1, le=1000)):
+    """
+    Lista los trabajos más recientes; con estado=fallido devuelve la lista de dead letter
+    """
+    # La cola es SQLite compartida entre workers: sus llamadas pueden esperar un lock, van en un thread
+    return {"trabajos": await asyncio.to_thread(cola_trabajos.listar, estado, limite), "success": True}
+
+@app.get("/api/trabajos/{trabajo_id}")
+async def estado_trabajo(trabajo_id: str):
+    trabajo = await asyncio.to_thread(cola_trabajos.obtener, trabajo_id)
+    if trabajo is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return trabajo
+
+@app.get("/api/trabajos/{trabajo_id}/eventos")
+async def eventos_trabajo(trabajo_id: str):
+    """
+    Server-Sent Events con el estado del trabajo cada vez que cambia; se cierra al terminar
+    """
+    if await asyncio.to_thread(cola_trabajos.obtener, trabajo_id) is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    
+    async def generar():
+        async for trabajo in cola_trabajos.eventos(trabajo_id):
+            yield f"event: {trabajo['estado']}\ndata: {json.dumps(trabajo, ensure_ascii=False)}\n\n"
+    
+    return StreamingResponse(generar(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.post("/api/trabajos/{trabajo_id}/reintentar")
+async def reintentar_trabajo(trabajo_id: str):
+    """
+    Vuelve a encolar un trabajo de la lista de fallidos
+    """
+    if not await asyncio.to_thread(cola_trabajos.reintentar, trabajo_id):
+        raise HTTPException(status_code=404, detail="No hay un trabajo fallido con ese ID")
+    return {"trabajo_id": trabajo_id, "estado": "pendiente", "success": True}
+
 @app.get("/health")
 async def health_check():
     """
     Endpoint de health check
     """
-    return {"status": "healthy", "service": "StockAI Backend"}
+    return {"status": "healthy", "service": "StockAI Backend", "servicios_degradados": clientes_externos.degradados()}
+
+@app.get("/api/cache")
+async def get_estadisticas_cache():
+    """
+    Hits/misses y tamaño de las caches de Textract y OpenAI
+    """
+    return {
+        "habilitada": CACHE_HABILITADA,
+        "textract": cache_textract.estadisticas(),
+        "llm": cache_llm.estadisticas(),
+        "success": True
+    }
+
+@app.get("/api/tokens")
+async def get_estadisticas_tokens():
+    """
+    Tokens de entrada y salida de OpenAI por operación y agrupación de pedidos, desde que arrancó el worker
+    """
+    return {
+        "modelo": MODELO_CHAT,
+        "presupuesto_datos": LLM_PRESUPUESTO_DATOS,
+        "operaciones": registro_tokens.estadisticas(),
+        "agrupacion": {
+            agrupador.nombre: agrupador.estadisticas()
+            for agrupador in (agrupador_extraccion, agrupador_extraccion_diferida, agrupador_matching_texto)
+        },
+        "success": True
+    }
+
+@app.get("/api/servicios")
+async def get_estado_servicios():
+    """
+    Estado del circuito, reintentos, rechazos y latencia (p50/p95/max) de cada servicio externo
+    (OpenAI por modelo, Textract por operación), desde que arrancó el worker
+    """
+    return {
+        "degradados": clientes_externos.degradados(),
+        "servicios": clientes_externos.estadisticas(),
+        "success": True
+    }
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,293 @@
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from repositorio_stock import normalizar_nombre
+
+# Separador decimal entre dígitos (1.5L, 2,25L): se protege antes de normalizar
+_PATRON_DECIMAL = re.compile(r'(\d)[.,](\d)')
+# Tamaño pegado o separado del número: 95G, 95 GR, 1.5L, 500ML, 1KG, 354CC
+_PATRON_TAMANO = re.compile(r'^(\d+(?:p\d+)?)(g|gr|grs|kg|ml|cc|l|lt|lts)$')
+# Presentación: X30X1, X6, 4X6
+_PATRON_PACK = re.compile(r'^(\d*)x(\d+)(?:x(\d+))?$')
+# 95GX30X1 → tamaño 95G + pack X30X1
+_PATRON_TAMANO_PACK = re.compile(r'^(\d+(?:p\d+)?(?:g|gr|grs|kg|ml|cc|l|lt|lts))(x\d+(?:x\d+)?)$')
+
+_FACTOR_UNIDAD = {'g': ('g', 1), 'gr': ('g', 1), 'grs': ('g', 1), 'kg': ('g', 1000),
+                  'ml': ('ml', 1), 'cc': ('ml', 1), 'l': ('ml', 1000), 'lt': ('ml', 1000), 'lts': ('ml', 1000)}
+
+# Palabras que no distinguen productos
+_PALABRAS_VACIAS = {'de', 'del', 'la', 'el', 'los', 'las', 'con', 'sin', 'y', 'en', 'x', 'unidades', 'unidad', 'un', 'u'}
+
+# Umbrales de decisión
+SCORE_ALTA_CONFIANZA = 0.85
+MARGEN_ALTA_CONFIANZA = 0.10
+SCORE_MINIMO_CANDIDATO = 0.35
+# Con más candidatos que esto (palabras muy comunes en un catálogo grande) se puntúan solo
+# los más cercanos según el índice semántico
+MAX_CANDIDATOS_PUNTUAR = 300
+
+
+@dataclass(frozen=True)
+class AtributosProducto:
+    """Nombre descompuesto en palabras, tamaño normalizado (g/ml) y presentación"""
+    palabras: frozenset
+    tamano: Optional[str] = None
+    pack: Optional[str] = None
+
+
+@dataclass
+class ResultadoMatch:
+    """
+    estado: 'exacto' | 'alto' (se resuelve localmente), 'ambiguo' (va al LLM con candidatos) o 'sin_match'
+    """
+    estado: str
+    producto_id: Optional[int] = None
+    confianza: float = 0.0
+    candidatos: List[Tuple[float, int]] = field(default_factory=list)
+
+
+def _normalizar_tamano(numero: str, unidad: str) -> str:
+    base, factor = _FACTOR_UNIDAD[unidad]
+    valor = float(numero.replace('p', '.')) * factor
+    return f"{valor:g}{base}"
+
+
+@lru_cache(maxsize=200_000)
+def extraer_atributos(nombre: str) -> AtributosProducto:
+    """
+    Separa un nombre como "TWISTOS MINIT JAMON 95GX30X1" en palabras {twistos, minit, jamon},
+    tamaño "95g" y pack "30x1"
+    """
+    tokens = normalizar_nombre(_PATRON_DECIMAL.sub(r'\1p\2', nombre or '')).replace(' x ', ' x').split()
+    palabras: Set[str] = set()
+    tamano = None
+    pack = None
+
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        # Número y unidad separados: "500 ML"
+        if token.replace('p', '').isdigit() and i + 1 < len(tokens) and tokens[i + 1] in _FACTOR_UNIDAD:
+            token = token + tokens[i + 1]
+            i += 1
+
+        combinado = _PATRON_TAMANO_PACK.match(token)
+        if combinado:
+            token, pack_texto = combinado.groups()
+            pack = pack_texto.lstrip('x')
+
+        coincidencia_tamano = _PATRON_TAMANO.match(token)
+        if coincidencia_tamano:
+            tamano = _normalizar_tamano(*coincidencia_tamano.groups())
+        elif _PATRON_PACK.match(token):
+            pack = token.lstrip('x')
+        elif not token.replace('p', '').isdigit() and token not in _PALABRAS_VACIAS:
+            # Los números sueltos son cantidades o códigos SKU, no distinguen el producto
+            palabras.add(token)
+        i += 1
+
+    return AtributosProducto(frozenset(palabras), tamano, pack)
+
+
+@lru_cache(maxsize=100_000)
+def _trigramas(palabra: str) -> frozenset:
+    relleno = f"  {palabra} "
+    return frozenset(relleno[i:i + 3] for i in range(len(relleno) - 2))
+
+
+def similitud_palabras(a: str, b: str) -> float:
+    """Coeficiente de Dice sobre trigramas de caracteres (tolera errores de OCR y abreviaturas)"""
+    if a == b:
+        return 1.0
+    if min(len(a), len(b)) >= 4 and (a.startswith(b) or b.startswith(a)):
+        # Abreviatura: GRAPEF → GRAPEFRUIT
+        return 0.9
+    ta, tb = _trigramas(a), _trigramas(b)
+    return 2 * len(ta & tb) / (len(ta) + len(tb))
+
+
+def puntuar(consulta: AtributosProducto, producto: AtributosProducto) -> float:
+    """
+    Score 0..1 entre dos productos. Tamaños distintos nunca coinciden (500ML ≠ 2L), y cada
+    palabra sin par (JAMON vs QUESO) baja el score
+    """
+    if consulta.tamano and producto.tamano and consulta.tamano != producto.tamano:
+        return 0.0
+    if not consulta.palabras or not producto.palabras:
+        return 0.0
+
+    coincidencia = 0.0
+    for palabra in consulta.palabras:
+        if palabra in producto.palabras:
+            coincidencia += 1
+            continue
+        mejor = max(similitud_palabras(palabra, otra) for otra in producto.palabras)
+        if mejor >= 0.6:
+            coincidencia += mejor * 0.9
+
+    union = len(consulta.palabras) + len(producto.palabras) - coincidencia
+    score = coincidencia / union if union else 0.0
+
+    if consulta.tamano != producto.tamano:
+        # Uno de los dos no indica tamaño
+        score *= 0.85
+    return score
+
+
+class MatcherProductos:
+    """
+    Matching local y determinista de nombres de productos contra el stock, sin llamadas de red.
+    Índice invertido palabra → productos para generar candidatos, y trigramas para tolerar
+    variaciones de escritura. Con un IndiceSemantico los productos se indexan también ahí y
+    acota los candidatos a puntuar en catálogos grandes
+    """
+
+    def __init__(self, indice=None):
+        self.indice = indice
+        self._nombres: Dict[int, str] = {}
+        self._atributos: Dict[int, AtributosProducto] = {}
+        self._indice: Dict[str, Set[int]] = {}
+        self._indice_trigramas: Dict[str, Set[str]] = {}
+        self._exactos: Dict[str, Set[int]] = {}
+        self.revision = None
+
+    # --- Mantenimiento del índice ---
+
+    def sincronizar(self, productos: Iterable, revision=None):
+        """
+        Deja el índice igual a la lista recibida (ProductoStock o dicts), re-indexando solo
+        los productos nuevos o renombrados
+        """
+        productos = list(productos)
+        vistos = set()
+        for producto in productos:
+            producto_id, nombre = _id_y_nombre(producto)
+            vistos.add(producto_id)
+            if self._nombres.get(producto_id) != nombre:
+                self._indexar(producto_id, nombre)
+        for producto_id in list(self._nombres):
+            if producto_id not in vistos:
+                self._desindexar(producto_id)
+        if self.indice is not None:
+            # El índice semántico puede venir cargado de disco: solo recalcula lo que cambió
+            self.indice.sincronizar(productos)
+        self.revision = revision
+
+    def agregar(self, producto_id: int, nombre: str):
+        self._indexar(producto_id, nombre)
+        if self.indice is not None:
+            self.indice.agregar(producto_id, nombre)
+
+    def quitar(self, producto_id: int):
+        self._desindexar(producto_id)
+        if self.indice is not None:
+            self.indice.quitar(producto_id)
+
+    def _indexar(self, producto_id: int, nombre: str):
+        if producto_id in self._nombres:
+            self._desindexar(producto_id)
+        atributos = extraer_atributos(nombre)
+        self._nombres[producto_id] = nombre
+        self._atributos[producto_id] = atributos
+        self._exactos.setdefault(_clave_exacta(atributos), set()).add(producto_id)
+        for palabra in atributos.palabras:
+            self._indice.setdefault(palabra, set()).add(producto_id)
+            for trigrama in _trigramas(palabra):
+                self._indice_trigramas.setdefault(trigrama, set()).add(palabra)
+
+    def _desindexar(self, producto_id: int):
+        atributos = self._atributos.pop(producto_id, None)
+        self._nombres.pop(producto_id, None)
+        if atributos is None:
+            return
+        self._exactos.get(_clave_exacta(atributos), set()).discard(producto_id)
+        for palabra in atributos.palabras:
+            self._indice.get(palabra, set()).discard(producto_id)
+
+    # --- Consultas ---
+
+    def _palabras_similares(self, palabra: str) -> Set[str]:
+        """Palabras indexadas que comparten trigramas con la consulta (para errores de tipeo/OCR)"""
+        if palabra in self._indice:
+            return {palabra}
+        conteo: Dict[str, int] = {}
+        for trigrama in _trigramas(palabra):
+            for otra in self._indice_trigramas.get(trigrama, ()):
+                conteo[otra] = conteo.get(otra, 0) + 1
+        return {otra for otra, n in conteo.items() if similitud_palabras(palabra, otra) >= 0.6}
+
+    def _ids_candidatos(self, palabras: Iterable[str]) -> Set[int]:
+        ids: Set[int] = set()
+        for palabra in palabras:
+            for similar in self._palabras_similares(palabra):
+                ids |= self._indice.get(similar, set())
+        return ids
+
+    def candidatos(self, nombre: str, k: int = 5) -> List[Tuple[float, int]]:
+        """Top-k (score, producto_id) para un nombre detectado"""
+        consulta = extraer_atributos(nombre)
+        ids = self._ids_candidatos(consulta.palabras)
+        if self.indice is not None and len(ids) > MAX_CANDIDATOS_PUNTUAR:
+            ids &= {producto_id for _, producto_id in self.indice.buscar(nombre, MAX_CANDIDATOS_PUNTUAR)}
+        puntajes = [
+            (round(puntuar(consulta, self._atributos[producto_id]), 3), producto_id)
+            for producto_id in ids
+        ]
+        puntajes = [p for p in puntajes if p[0] >= SCORE_MINIMO_CANDIDATO]
+        puntajes.sort(key=lambda p: (-p[0], p[1]))
+        return puntajes[:k]
+
+    def resolver(self, nombre: str, k: int = 5) -> ResultadoMatch:
+        """
+        Decide localmente si un nombre detectado es un producto existente.
+        Solo los casos 'ambiguo' necesitan al LLM
+        """
+        consulta = extraer_atributos(nombre)
+        exactos = self._exactos.get(_clave_exacta(consulta), set())
+        if len(exactos) == 1:
+            producto_id = next(iter(exactos))
+            return ResultadoMatch('exacto', producto_id, 1.0, [(1.0, producto_id)])
+
+        candidatos = self.candidatos(nombre, k)
+        if not candidatos:
+            return ResultadoMatch('sin_match')
+
+        mejor_score, mejor_id = candidatos[0]
+        segundo = candidatos[1][0] if len(candidatos) > 1 else 0.0
+        if mejor_score >= SCORE_ALTA_CONFIANZA and mejor_score - segundo >= MARGEN_ALTA_CONFIANZA:
+            return ResultadoMatch('alto', mejor_id, mejor_score, candidatos)
+        return ResultadoMatch('ambiguo', None, mejor_score, candidatos)
+
+    def candidatos_por_texto(self, texto: str, k: int = 50) -> List[Tuple[float, int]]:
+        """
+        Productos más relevantes para un texto libre ("llegaron 10 twistos de jamón"):
+        fracción de las palabras del producto presentes en el texto, con bonus si el tamaño coincide
+        """
+        consulta = extraer_atributos(texto)
+        palabras_texto = set()
+        for palabra in consulta.palabras:
+            palabras_texto |= self._palabras_similares(palabra)
+
+        puntajes = []
+        for producto_id in self._ids_candidatos(consulta.palabras):
+            atributos = self._atributos[producto_id]
+            presentes = len(atributos.palabras & palabras_texto)
+            score = presentes / len(atributos.palabras)
+            if consulta.tamano and atributos.tamano == consulta.tamano:
+                score += 0.25
+            puntajes.append((round(score, 3), producto_id))
+
+        puntajes.sort(key=lambda p: (-p[0], p[1]))
+        return puntajes[:k]
+
+
+def _clave_exacta(atributos: AtributosProducto) -> tuple:
+    return (tuple(sorted(atributos.palabras)), atributos.tamano)
+
+
+def _id_y_nombre(producto) -> Tuple[int, str]:
+    if isinstance(producto, dict):
+        return producto.get('id'), producto.get('nombre', '')
+    return producto.id, producto.nombre
@@ -0,0 +1,45 @@
+from pydantic import BaseModel
+from typing import List
+
+class Proveedor(BaseModel):
+    id: int
+    nombre: str
+    impuesto: float
+    telefono: str
+    cuit: str = None
+    email: str = None
+    direccion: str = None
+    # Otros nombres con los que aparece en las facturas (para detectar el proveedor)
+    alias: List[str] = []
+
+class ProductoStock(BaseModel):
+    id: int
+    nombre: str
+    stock: int
+    stock_minimo: int
+    precio_base: float
+    categoria: str
+    codigo: str
+    proveedor_id: int
+    ultima_actualizacion: str
+    version: int = 0
+
+class ProductDetected(BaseModel):
+    nombre: str
+    cantidad: int
+    precio_sin_impuestos: float = None
+    precio_con_impuestos: float = None
+    confianza: float
+
+class ResumenFactura(BaseModel):
+    subtotal: float
+    impuestos: float
+    total: float
+
+class OCRResponse(BaseModel):
+    productos: List[ProductDetected]
+    proveedor: Proveedor = None
+    resumen: ResumenFactura = None
+    texto_completo: str
+    success: bool
+    confianza_proveedor: float = None
@@ -0,0 +1,161 @@
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from modelos import ProductDetected, Proveedor
+from repositorio_stock import normalizar_nombre
+
+# Importes y cantidades: 1849.96, 1.250,50, 1,250.50, 2.00, 12
+_NUMERO = r'\d{1,3}(?:[.,]\d{3})+(?:[.,]\d{1,2})?|\d+(?:[.,]\d+)?'
+_UNIDADES = r'(?:unidades|unidad|uni|un|u)\.?'
+
+
+@dataclass(frozen=True)
+class GramaticaLinea:
+    """
+    Formato de línea de producto. El patrón define los grupos `descripcion`, `cantidad` y `importe`
+    (y opcionalmente `codigo`); `importe` es el total de la línea o el precio unitario según `tipo_importe`
+    """
+    nombre: str
+    patron: re.Pattern
+    confianza: float
+    tipo_importe: str = 'total'
+    separador_decimal: Optional[str] = None  # Desempata números como 1.250 (ver parsear_numero)
+
+
+def _gramatica(nombre: str, patron: str, confianza: float, **kwargs) -> GramaticaLinea:
+    return GramaticaLinea(nombre, re.compile(patron, re.IGNORECASE), confianza, **kwargs)
+
+
+# Gramáticas propias de cada proveedor (clave: nombre normalizado)
+GRAMATICAS_POR_PROVEEDOR: Dict[str, List[GramaticaLinea]] = {
+    # 300063098 TWISTOS MINIT JAMON 95GX30X1 2.00 Unidades $1849.96
+    "hif hih distribuciones": [
+        _gramatica(
+            "hif_hih",
+            rf'^(?P<codigo>\d{{6,13}})\s+(?P<descripcion>.+?)\s+(?P<cantidad>{_NUMERO})\s+{_UNIDADES}\s+\$\s?(?P<importe>{_NUMERO})$',
+            95
+        ),
+    ],
+}
+
+# Formatos comunes a varios proveedores, probados después de los propios
+GRAMATICAS_GENERICAS: List[GramaticaLinea] = [
+    # [CODIGO] DESCRIPCION CANTIDAD [UNIDADES] $TOTAL
+    _gramatica(
+        "codigo_descripcion_cantidad_total",
+        rf'^(?:(?P<codigo>\d{{5,13}})\s+)?(?P<descripcion>.*[a-z].*?)\s+(?P<cantidad>{_NUMERO})\s+(?:{_UNIDADES}\s+)?\$\s?(?P<importe>{_NUMERO})$',
+        85
+    ),
+    # Coca-Cola 2L - 2 unidades - $450 c/u
+    _gramatica(
+        "descripcion_cantidad_unitario",
+        rf'^(?P<descripcion>.*[a-z].*?)\s+-\s+(?P<cantidad>\d+)\s+{_UNIDADES}\s+-\s+\$\s?(?P<importe>{_NUMERO})\s*c/u$',
+        85, tipo_importe='unitario'
+    ),
+]
+
+# Líneas que nunca son productos
+_NO_PRODUCTO = re.compile(
+    r'\b(sub\s?total|total|iva|impuestos?|percep\w*|descuentos?|bonif\w*|saldo|cuit|cae|fecha|'
+    r'vencimiento|factura|remito|condici[oó]n|domicilio|tel[eé]fono|p[aá]gina)\b',
+    re.IGNORECASE
+)
+# Líneas que parecen productos: empiezan con un código, o tienen un importe, o "N unidades"
+_PARECE_PRODUCTO = re.compile(rf'^\d{{5,13}}\s+\S|\$\s?\d|\b\d+(?:[.,]\d+)?\s+{_UNIDADES}(?:\s|$)', re.IGNORECASE)
+_LETRAS = re.compile(r'[a-záéíóúñ]{3,}', re.IGNORECASE)
+
+# "95GX30X1" → "95G", "500ML X6" → "500ML": la presentación no forma parte del nombre
+_PACK_TRAS_TAMANO = re.compile(r'(\d+(?:[.,]\d+)?\s?(?:G|GR|GRS|KG|ML|CC|L|LT|LTS))\s?X\d+(?:X\d+)?\b', re.IGNORECASE)
+
+
+def _deducir_separador_decimal(texto: str, preferido: Optional[str]) -> str:
+    puntos, comas = texto.count('.'), texto.count(',')
+    if puntos and comas:
+        # El último separador es el decimal: 1.250,50 / 1,250.50
+        return '.' if texto.rfind('.') > texto.rfind(',') else ','
+    if puntos + comas == 1:
+        separador = '.' if puntos else ','
+        if len(texto.split(separador)[1]) != 3:
+            return separador  # 2.00 / 2,5
+        # 1.250: miles, salvo que el proveedor use ese separador como decimal
+        return separador if preferido == separador else ''
+    return ''
+
+
+def parsear_numero(texto: str, separador_decimal: Optional[str] = None) -> Optional[float]:
+    """
+    Convierte números en formato argentino o anglosajón: 1.250,50 / 1,250.50 / 1849.96 / 2,5.
+    El separador decimal se deduce de cada número; `separador_decimal` solo desempata el caso
+    ambiguo de un único separador seguido de 3 dígitos (por defecto 1.250 = 1250)
+    """
+    texto = texto.strip().replace('$', '').replace(' ', '')
+    if not texto:
+        return None
+    decimal = _deducir_separador_decimal(texto, separador_decimal)
+    if decimal:
+        separador_miles = ',' if decimal == '.' else '.'
+        texto = texto.replace(separador_miles, '').replace(decimal, '.')
+    else:
+        texto = texto.replace('.', '').replace(',', '')
+    try:
+        return float(texto)
+    except ValueError:
+        return None
+
+
+def limpiar_descripcion(descripcion: str) -> str:
+    return re.sub(r'\s+', ' ', _PACK_TRAS_TAMANO.sub(r'\1', descripcion)).strip(' -')
+
+
+@dataclass
+class ResultadoParser:
+    productos: List[ProductDetected] = field(default_factory=list)
+    # Líneas que parecen productos pero ninguna gramática pudo interpretar: van al LLM
+    lineas_dudosas: List[str] = field(default_factory=list)
+
+
+class ParserFacturas:
+    """
+    Parser determinista de líneas de factura: prueba las gramáticas del proveedor y luego las
+    genéricas. Solo las líneas que parecen productos y no se pudieron interpretar con seguridad
+    quedan como dudosas para escalar al LLM.
+    """
+
+    def gramaticas_para(self, proveedor: Optional[Proveedor]) -> List[GramaticaLinea]:
+        propias = GRAMATICAS_POR_PROVEEDOR.get(normalizar_nombre(proveedor.nombre), []) if proveedor else []
+        return propias + GRAMATICAS_GENERICAS
+
+    def parsear(self, texto: str, proveedor: Optional[Proveedor] = None) -> ResultadoParser:
+        gramaticas = self.gramaticas_para(proveedor)
+        resultado = ResultadoParser()
+        for linea in texto.splitlines():
+            linea = linea.strip()
+            if not linea or not _LETRAS.search(linea) or _NO_PRODUCTO.search(linea):
+                continue
+            producto = self.parsear_linea(linea, gramaticas)
+            if producto:
+                resultado.productos.append(producto)
+            elif _PARECE_PRODUCTO.search(linea):
+                resultado.lineas_dudosas.append(linea)
+        return resultado
+
+    def parsear_linea(self, linea: str, gramaticas: List[GramaticaLinea]) -> Optional[ProductDetected]:
+        for gramatica in gramaticas:
+            coincidencia = gramatica.patron.match(linea)
+            if not coincidencia:
+                continue
+            cantidad = parsear_numero(coincidencia.group('cantidad'), gramatica.separador_decimal)
+            importe = parsear_numero(coincidencia.group('importe'), gramatica.separador_decimal)
+            descripcion = limpiar_descripcion(coincidencia.group('descripcion'))
+            # Cantidades fraccionarias o importes en cero: mejor que lo mire el LLM
+            if not cantidad or cantidad != int(cantidad) or not importe or not _LETRAS.search(descripcion):
+                continue
+            precio_unitario = importe / cantidad if gramatica.tipo_importe == 'total' else importe
+            return ProductDetected(
+                nombre=descripcion,
+                cantidad=int(cantidad),
+                precio_sin_impuestos=round(precio_unitario, 2),
+                confianza=gramatica.confianza
+            )
+        return None
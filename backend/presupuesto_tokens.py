@@ -0,0 +1,138 @@
+import math
+import threading
+from typing import Callable, Dict, List, Optional, TypeVar
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+T = TypeVar('T')
+
+# Sin tiktoken (o sin su archivo de encoding) se estima con ~3.5 caracteres por token, que para
+# texto en español con números queda del lado conservador
+CARACTERES_POR_TOKEN_ESTIMADOS = 3.5
+# Tokens de formato que agrega cada mensaje del chat además de su contenido
+TOKENS_POR_MENSAJE = 4
+
+_encodings: Dict[str, object] = {}
+_lock_encodings = threading.Lock()
+
+
+def _encoding(modelo: str):
+    """Encoding de tiktoken para el modelo, o None si no está disponible (se intenta una sola vez)"""
+    with _lock_encodings:
+        if modelo not in _encodings:
+            encoding = None
+            if tiktoken is not None:
+                try:
+                    try:
+                        encoding = tiktoken.encoding_for_model(modelo)
+                    except KeyError:
+                        encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception as e:
+                    # El encoding se descarga la primera vez: sin red se usa la estimación
+                    print(f"⚠️ tiktoken no disponible para {modelo}, se estiman los tokens: {e}")
+            _encodings[modelo] = encoding
+        return _encodings[modelo]
+
+
+def contar_tokens(texto: str, modelo: str = "gpt-3.5-turbo") -> int:
+    encoding = _encoding(modelo)
+    if encoding is None:
+        return math.ceil(len(texto) / CARACTERES_POR_TOKEN_ESTIMADOS)
+    return len(encoding.encode(texto, disallowed_special=()))
+
+
+def contar_tokens_mensajes(mensajes: List[dict], modelo: str = "gpt-3.5-turbo") -> int:
+    return sum(contar_tokens(m["content"], modelo) + TOKENS_POR_MENSAJE for m in mensajes) + 3
+
+
+def recortar_a_presupuesto(items: List[str], presupuesto: int, modelo: str = "gpt-3.5-turbo",
+                           separador: str = "\n") -> List[str]:
+    """
+    Los primeros items (ya ordenados por relevancia) que entran en `presupuesto` tokens
+    """
+    elegidos = []
+    usados = 0
+    costo_separador = contar_tokens(separador, modelo)
+    for item in items:
+        costo = contar_tokens(item, modelo) + costo_separador
+        if usados + costo > presupuesto:
+            break
+        elegidos.append(item)
+        usados += costo
+    return elegidos
+
+
+def agrupar_por_presupuesto(items: List[T], presupuesto: int, costo: Callable[[T], int]) -> List[List[T]]:
+    """
+    Parte los items en grupos consecutivos cuyo costo total no supera el presupuesto.
+    Un item que solo ya lo supera queda en un grupo propio
+    """
+    grupos: List[List[T]] = []
+    actual: List[T] = []
+    usados = 0
+    for item in items:
+        costo_item = costo(item)
+        if actual and usados + costo_item > presupuesto:
+            grupos.append(actual)
+            actual, usados = [], 0
+        actual.append(item)
+        usados += costo_item
+    if actual:
+        grupos.append(actual)
+    return grupos
+
+
+def dividir_texto(texto: str, presupuesto: int, modelo: str = "gpt-3.5-turbo") -> List[str]:
+    """Divide el texto por líneas en fragmentos de a lo sumo `presupuesto` tokens"""
+    lineas = [linea for linea in texto.splitlines() if linea.strip()]
+    grupos = agrupar_por_presupuesto(lineas, presupuesto, lambda linea: contar_tokens(linea + "\n", modelo))
+    return ['\n'.join(grupo) for grupo in grupos] or [texto]
+
+
+def max_tokens_respuesta(items_esperados: int, tokens_por_item: int, base: int = 150, tope: int = 4000) -> int:
+    """`max_tokens` proporcional a lo que se espera de respuesta, en lugar de un valor fijo"""
+    return max(base, min(tope, base + items_esperados * tokens_por_item))
+
+
+class RegistroTokens:
+    """
+    Tokens de entrada y salida por operación (extracción de facturas, matching, etc.),
+    para seguir el costo y detectar prompts que crecen con el catálogo
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operaciones: Dict[str, dict] = {}
+
+    def registrar(self, operacion: str, modelo: str, tokens_entrada: int, tokens_salida: int,
+                  desde_cache: bool = False, max_tokens: Optional[int] = None):
+        with self._lock:
+            datos = self._operaciones.setdefault(operacion, {
+                "requests": 0, "desde_cache": 0, "tokens_entrada": 0, "tokens_salida": 0,
+                "max_tokens_entrada": 0, "modelo": modelo,
+            })
+            if desde_cache:
+                datos["desde_cache"] += 1
+                return
+            datos["requests"] += 1
+            datos["tokens_entrada"] += tokens_entrada
+            datos["tokens_salida"] += tokens_salida
+            datos["max_tokens_entrada"] = max(datos["max_tokens_entrada"], tokens_entrada)
+            datos["modelo"] = modelo
+        print(f"🔢 {operacion} ({modelo}): {tokens_entrada} tokens de entrada, {tokens_salida} de salida"
+              + (f" (máximo {max_tokens})" if max_tokens else ""))
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            resultado = {}
+            for operacion, datos in self._operaciones.items():
+                requests = datos["requests"]
+                resultado[operacion] = dict(
+                    datos,
+                    promedio_entrada=round(datos["tokens_entrada"] / requests, 1) if requests else 0,
+                    promedio_salida=round(datos["tokens_salida"] / requests, 1) if requests else 0,
+                )
+            return resultado
@@ -0,0 +1,190 @@
+"""
+Pronóstico de demanda por producto a partir de las salidas diarias del historial de movimientos.
+
+Todos los productos se calculan juntos sobre una matriz productos x días (NumPy, sin loops por
+producto): medias móviles de 7 y 28 días, suavizado exponencial de la serie desestacionalizada y
+factores por día de la semana. De ahí salen el punto de pedido (stock_minimo dinámico: demanda
+durante la entrega + stock de seguridad) y la cantidad a reponer para cubrir los días siguientes.
+
+El resultado queda en memoria: al llegar movimientos nuevos se suman a la matriz y se recalculan
+solo los productos tocados; al cambiar el día se rearma la ventana completa.
+"""
+import math
+import threading
+from datetime import date, datetime, timedelta
+from typing import Dict, Optional
+
+import numpy as np
+
+DIAS_HISTORIA = 112  # 16 semanas
+SEMANAS_ESTACIONALIDAD = 8
+ALFA_SUAVIZADO = 0.3
+# Factor z del stock de seguridad (1.65 ~ 95% de nivel de servicio)
+Z_SERVICIO = 1.65
+# Días con ventas necesarios para confiar en el pronóstico; si no, se usa el stock_minimo cargado
+MIN_DIAS_CON_VENTAS = 3
+
+
+def pronosticar(salidas: np.ndarray, dia_semana_inicio: int, dias_entrega: int, dias_cobertura: int) -> dict:
+    """
+    Pronóstico de todas las filas de `salidas` (productos x días, la última columna es hoy).
+    `dia_semana_inicio` es el día de la semana (lunes = 0) de la primera columna
+    """
+    productos, dias = salidas.shape
+    dia_semana = (dia_semana_inicio + np.arange(dias)) % 7
+
+    # Estacionalidad: promedio de cada día de la semana sobre el promedio general de las últimas semanas,
+    # acercado a 1 (con pocas semanas un día raro no debe pesar de más) y normalizado a promedio 1
+    ventana = min(dias, 7 * SEMANAS_ESTACIONALIDAD)
+    recientes, dias_recientes = salidas[:, -ventana:], dia_semana[-ventana:]
+    media = recientes.mean(axis=1, keepdims=True)
+    por_dia = np.stack([recientes[:, dias_recientes == d].mean(axis=1) for d in range(7)], axis=1)
+    crudo = np.divide(por_dia, media, out=np.ones_like(por_dia), where=media > 0)
+    semanas = ventana / 7
+    factores = 1 + (crudo - 1) * semanas / (semanas + 2)
+    factores /= factores.mean(axis=1, keepdims=True)
+
+    # Suavizado exponencial simple de la serie desestacionalizada, como promedio ponderado (un producto matricial)
+    desestacionalizada = salidas / factores[:, dia_semana]
+    pesos = ALFA_SUAVIZADO * (1 - ALFA_SUAVIZADO) ** np.arange(dias)[::-1]
+    nivel = desestacionalizada @ (pesos / pesos.sum())
+
+    # Error de los últimos 28 días contra el nivel actual, para el stock de seguridad
+    ultimos = slice(-min(dias, 28), None)
+    residuos = salidas[:, ultimos] - nivel[:, None] * factores[:, dia_semana[ultimos]]
+    desvio = residuos.std(axis=1)
+
+    futuro = (dia_semana[-1] + 1 + np.arange(dias_entrega + dias_cobertura)) % 7
+    demanda_futura = nivel[:, None] * factores[:, futuro]
+    demanda_entrega = demanda_futura[:, :dias_entrega].sum(axis=1)
+    demanda_cobertura = demanda_futura[:, dias_entrega:].sum(axis=1)
+    seguridad = Z_SERVICIO * desvio * math.sqrt(dias_entrega)
+    return {
+        "media_7": salidas[:, -7:].mean(axis=1),
+        "media_28": salidas[:, -28:].mean(axis=1),
+        "nivel": nivel,
+        "factores": factores,
+        "demanda_entrega": demanda_entrega,
+        "demanda_cobertura": demanda_cobertura,
+        "seguridad": seguridad,
+        "punto_pedido": np.ceil(demanda_entrega + seguridad).astype(np.int64),
+        "dias_con_ventas": (salidas > 0).sum(axis=1),
+    }
+
+
+class PronosticoDemanda:
+    """
+    Pronóstico de todos los productos con salidas en los últimos `dias_historia` días, sobre un
+    HistorialMovimientos. `actualizar()` incorpora los movimientos nuevos y devuelve si hubo cambios
+    """
+
+    def __init__(self, historial, dias_entrega: int = 7, dias_cobertura: int = 14, dias_historia: int = DIAS_HISTORIA):
+        self.historial = historial
+        self.dias_entrega = dias_entrega
+        self.dias_cobertura = dias_cobertura
+        self.dias_historia = dias_historia
+        self._lock = threading.Lock()
+        self._hoy: Optional[date] = None
+        self._ultimo_id = 0
+        self._filas: Dict[int, int] = {}
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._salidas = np.zeros((0, dias_historia))
+        self._resultado: Dict[str, np.ndarray] = {}
+        self.recalculos_completos = 0
+
+    # --- Cálculo ---
+
+    def actualizar(self) -> bool:
+        with self._lock:
+            hoy = date.today()
+            if hoy != self._hoy:
+                self._recalcular_todo(hoy)
+                return True
+            ultimo_id, salidas = self.historial.salidas_desde(self._ultimo_id)
+            self._ultimo_id = ultimo_id
+            if not salidas:
+                return False
+            inicio = hoy - timedelta(days=self.dias_historia - 1)
+            tocadas = set()
+            for producto_id, ts, unidades in salidas:
+                columna = (datetime.fromisoformat(ts).date() - inicio).days
+                if 0 <= columna < self.dias_historia:
+                    fila = self._fila(producto_id)
+                    self._salidas[fila, columna] += unidades
+                    tocadas.add(fila)
+            if tocadas:
+                self._recalcular_filas(np.array(sorted(tocadas)))
+            return bool(tocadas)
+
+    def _recalcular_todo(self, hoy: date):
+        inicio = hoy - timedelta(days=self.dias_historia - 1)
+        self._ultimo_id, filas = self.historial.salidas_diarias(inicio, hoy + timedelta(days=1))
+        self._filas = {}
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._salidas = np.zeros((0, self.dias_historia))
+        if filas:
+            ids = sorted({producto_id for producto_id, _, _ in filas})
+            self._filas = {producto_id: fila for fila, producto_id in enumerate(ids)}
+            self._ids = np.array(ids, dtype=np.int64)
+            self._salidas = np.zeros((len(ids), self.dias_historia))
+            indices = np.array([self._filas[producto_id] for producto_id, _, _ in filas])
+            columnas = np.array([(date.fromisoformat(dia) - inicio).days for _, dia, _ in filas])
+            np.add.at(self._salidas, (indices, columnas), np.array([unidades for _, _, unidades in filas], dtype=float))
+        self._hoy = hoy
+        self._resultado = pronosticar(self._salidas, inicio.weekday(), self.dias_entrega, self.dias_cobertura)
+        self.recalculos_completos += 1
+
+    def _recalcular_filas(self, filas: np.ndarray):
+        inicio = self._hoy - timedelta(days=self.dias_historia - 1)
+        parcial = pronosticar(self._salidas[filas], inicio.weekday(), self.dias_entrega, self.dias_cobertura)
+        for clave, valores in parcial.items():
+            self._resultado[clave][filas] = valores
+
+    def _fila(self, producto_id: int) -> int:
+        fila = self._filas.get(producto_id)
+        if fila is None:
+            fila = self._filas[producto_id] = len(self._ids)
+            self._ids = np.append(self._ids, producto_id)
+            self._salidas = np.vstack([self._salidas, np.zeros((1, self.dias_historia))])
+            for clave, valores in self._resultado.items():
+                self._resultado[clave] = np.concatenate([valores, np.zeros((1,) + valores.shape[1:], valores.dtype)])
+        return fila
+
+    # --- Resultados ---
+
+    def producto(self, producto_id: int) -> Optional[dict]:
+        """Pronóstico de un producto (None si no tiene suficientes ventas recientes)"""
+        # Bajo el lock: actualizar() agrega filas en otro thread y los arrays crecen después del índice
+        with self._lock:
+            return self._producto(producto_id)
+
+    def _producto(self, producto_id: int) -> Optional[dict]:
+        fila = self._filas.get(producto_id)
+        if fila is None or self._resultado["dias_con_ventas"][fila] < MIN_DIAS_CON_VENTAS:
+            return None
+        r = self._resultado
+        return {
+            "producto_id": producto_id,
+            "media_7": round(float(r["media_7"][fila]), 2),
+            "media_28": round(float(r["media_28"][fila]), 2),
+            "demanda_diaria": round(float(r["nivel"][fila]), 2),
+            "estacionalidad": [round(float(f), 2) for f in r["factores"][fila]],
+            "demanda_entrega": round(float(r["demanda_entrega"][fila]), 1),
+            "stock_seguridad": round(float(r["seguridad"][fila]), 1),
+            "stock_minimo": int(r["punto_pedido"][fila]),
+            "demanda_cobertura": round(float(r["demanda_cobertura"][fila]), 1),
+        }
+
+    def puntos_de_pedido(self) -> Dict[int, int]:
+        """stock_minimo dinámico de cada producto con pronóstico confiable"""
+        with self._lock:
+            confiables = self._resultado.get("dias_con_ventas", np.zeros(0)) >= MIN_DIAS_CON_VENTAS
+            return dict(zip(self._ids[confiables].tolist(), self._resultado["punto_pedido"][confiables].tolist())) \
+                if confiables.any() else {}
+
+    def cantidad_a_reponer(self, producto_id: int, stock: int) -> Optional[int]:
+        """Unidades para volver al punto de pedido más la demanda de los días de cobertura"""
+        pronostico = self.producto(producto_id)
+        if pronostico is None:
+            return None
+        return max(0, math.ceil(pronostico["stock_minimo"] + pronostico["demanda_cobertura"] - stock))
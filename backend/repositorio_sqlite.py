@@ -0,0 +1,355 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from almacenamiento import RepositorioStockBase
+from modelos import ProductoStock, Proveedor
+from repositorio_stock import ConflictoVersion, normalizar_nombre
+
+COLUMNAS_PRODUCTO = [
+    'id', 'nombre', 'stock', 'stock_minimo', 'precio_base', 'categoria',
+    'codigo', 'proveedor_id', 'ultima_actualizacion', 'version'
+]
+COLUMNAS_PROVEEDOR = ['id', 'nombre', 'impuesto', 'telefono', 'cuit', 'email', 'direccion', 'alias']
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS productos (
+    id INTEGER PRIMARY KEY,
+    nombre TEXT NOT NULL,
+    stock INTEGER NOT NULL,
+    stock_minimo INTEGER NOT NULL,
+    precio_base REAL NOT NULL,
+    categoria TEXT NOT NULL,
+    codigo TEXT NOT NULL,
+    proveedor_id INTEGER NOT NULL,
+    ultima_actualizacion TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0,
+    nombre_normalizado TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_productos_proveedor ON productos(proveedor_id);
+CREATE INDEX IF NOT EXISTS idx_productos_codigo ON productos(codigo);
+CREATE INDEX IF NOT EXISTS idx_productos_nombre_normalizado ON productos(nombre_normalizado);
+-- Índice por faltante: sirve tanto para stock < stock_minimo como para stock <= stock_minimo,
+-- y devuelve los críticos ya ordenados del más faltante al menos faltante
+CREATE INDEX IF NOT EXISTS idx_productos_faltante ON productos(stock - stock_minimo);
+CREATE INDEX IF NOT EXISTS idx_productos_proveedor_faltante ON productos(proveedor_id, stock - stock_minimo);
+
+CREATE TABLE IF NOT EXISTS proveedores (
+    id INTEGER PRIMARY KEY,
+    nombre TEXT NOT NULL,
+    impuesto REAL NOT NULL,
+    telefono TEXT NOT NULL,
+    cuit TEXT,
+    email TEXT,
+    direccion TEXT,
+    alias TEXT NOT NULL DEFAULT '[]'
+);
+"""
+
+# Índice full-text sobre el nombre, sincronizado con triggers
+ESQUEMA_FTS = """
+CREATE VIRTUAL TABLE IF NOT EXISTS productos_fts USING fts5(
+    nombre_normalizado, content='productos', content_rowid='id', tokenize='unicode61'
+);
+CREATE TRIGGER IF NOT EXISTS productos_fts_ai AFTER INSERT ON productos BEGIN
+    INSERT INTO productos_fts(rowid, nombre_normalizado) VALUES (new.id, new.nombre_normalizado);
+END;
+CREATE TRIGGER IF NOT EXISTS productos_fts_ad AFTER DELETE ON productos BEGIN
+    INSERT INTO productos_fts(productos_fts, rowid, nombre_normalizado) VALUES ('delete', old.id, old.nombre_normalizado);
+END;
+CREATE TRIGGER IF NOT EXISTS productos_fts_au AFTER UPDATE OF nombre_normalizado ON productos BEGIN
+    INSERT INTO productos_fts(productos_fts, rowid, nombre_normalizado) VALUES ('delete', old.id, old.nombre_normalizado);
+    INSERT INTO productos_fts(rowid, nombre_normalizado) VALUES (new.id, new.nombre_normalizado);
+END;
+"""
+
+
+def _producto_desde_fila(fila) -> ProductoStock:
+    return ProductoStock(**{columna: fila[i] for i, columna in enumerate(COLUMNAS_PRODUCTO)})
+
+
+def _fila_desde_producto(producto: ProductoStock) -> tuple:
+    datos = producto.model_dump()
+    return tuple(datos[columna] for columna in COLUMNAS_PRODUCTO) + (normalizar_nombre(producto.nombre),)
+
+
+def _proveedor_desde_fila(fila) -> Proveedor:
+    datos = {columna: fila[i] for i, columna in enumerate(COLUMNAS_PROVEEDOR)}
+    datos['alias'] = json.loads(datos['alias'])
+    return Proveedor(**datos)
+
+
+def _fila_desde_proveedor(proveedor: Proveedor) -> tuple:
+    datos = proveedor.model_dump()
+    datos['alias'] = json.dumps(datos['alias'], ensure_ascii=False)
+    return tuple(datos[columna] for columna in COLUMNAS_PROVEEDOR)
+
+
+class TransaccionSQLite:
+    """
+    Misma interfaz que TransaccionStock; corre dentro de un BEGIN IMMEDIATE, que toma el lock
+    de escritura de la base y lo comparte entre todos los workers
+    """
+
+    def __init__(self, conexion: sqlite3.Connection):
+        self._conexion = conexion
+        self.cambios: Dict[int, ProductoStock] = {}
+        self.movimientos: Dict[int, int] = {}
+        fila = conexion.execute("SELECT COALESCE(MAX(id), 0) FROM productos").fetchone()
+        self._siguiente_id = fila[0] + 1
+
+    def obtener(self, producto_id: int) -> Optional[ProductoStock]:
+        if producto_id in self.cambios:
+            return self.cambios[producto_id]
+        fila = self._conexion.execute(
+            f"SELECT {', '.join(COLUMNAS_PRODUCTO)} FROM productos WHERE id = ?", (producto_id,)
+        ).fetchone()
+        return _producto_desde_fila(fila) if fila else None
+
+    def _copia_para_modificar(self, producto_id: int, version_esperada: Optional[int]) -> Optional[ProductoStock]:
+        if producto_id in self.cambios:
+            return self.cambios[producto_id]
+
+        actual = self.obtener(producto_id)
+        if actual is None:
+            return None
+        if version_esperada is not None and actual.version != version_esperada:
+            raise ConflictoVersion(producto_id, version_esperada, actual.version)
+
+        actual.version += 1
+        return actual
+
+    def ajustar_stock(self, producto_id: int, delta: int, version_esperada: Optional[int] = None) -> Optional[ProductoStock]:
+        producto = self._copia_para_modificar(producto_id, version_esperada)
+        if producto is None:
+            return None
+
+        producto.stock += delta
+        producto.ultima_actualizacion = datetime.now().isoformat()
+        if producto_id in self.movimientos or producto_id not in self.cambios:
+            self.movimientos[producto_id] = self.movimientos.get(producto_id, 0) + delta
+        self.cambios[producto_id] = producto
+        return producto
+
+    def agregar(self, **campos) -> ProductoStock:
+        nuevo_id = self._siguiente_id
+        self._siguiente_id += 1
+
+        campos.setdefault('codigo', f"AUTO{nuevo_id:03d}")
+        campos.setdefault('ultima_actualizacion', datetime.now().isoformat())
+        producto = ProductoStock(id=nuevo_id, **campos)
+        self.cambios[nuevo_id] = producto
+        return producto
+
+    def reemplazar(self, producto: ProductoStock, version_esperada: Optional[int] = None) -> ProductoStock:
+        anterior = self._copia_para_modificar(producto.id, version_esperada)
+        producto = producto.model_copy(update={'version': anterior.version if anterior else 0})
+        self.movimientos.pop(producto.id, None)
+        self.cambios[producto.id] = producto
+        self._siguiente_id = max(self._siguiente_id, producto.id + 1)
+        return producto
+
+    def _confirmar(self):
+        _upsert_productos(self._conexion, self.cambios.values())
+
+
+def _upsert_productos(conexion: sqlite3.Connection, productos: Iterable[ProductoStock]):
+    columnas = COLUMNAS_PRODUCTO + ['nombre_normalizado']
+    actualizaciones = ', '.join(f"{c} = excluded.{c}" for c in columnas if c != 'id')
+    conexion.executemany(
+        f"INSERT INTO productos ({', '.join(columnas)}) VALUES ({', '.join('?' * len(columnas))}) "
+        f"ON CONFLICT(id) DO UPDATE SET {actualizaciones}",
+        (_fila_desde_producto(p) for p in productos)
+    )
+
+
+class RepositorioStockSQLite(RepositorioStockBase):
+    """
+    Stock y proveedores en SQLite (modo WAL). Las consultas filtran y ordenan con índices
+    en la base, sin cargar el catálogo completo en memoria.
+    """
+
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        self._local = threading.local()
+        self.fts_disponible = True
+        self._crear_esquema()
+        # Conexión propia para revision(): data_version cambia con cada commit de las otras conexiones
+        self._conexion_revision = sqlite3.connect(ruta, timeout=30, isolation_level=None, check_same_thread=False)
+        self._lock_revision = threading.Lock()
+
+    def _conexion(self) -> sqlite3.Connection:
+        conexion = getattr(self._local, 'conexion', None)
+        if conexion is None:
+            # isolation_level=None: las transacciones se manejan explícitamente con BEGIN
+            conexion = sqlite3.connect(self.ruta, timeout=30, isolation_level=None, check_same_thread=False)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute("PRAGMA synchronous=NORMAL")
+            conexion.execute("PRAGMA busy_timeout=30000")
+            self._local.conexion = conexion
+        return conexion
+
+    def _crear_esquema(self):
+        conexion = self._conexion()
+        conexion.executescript(ESQUEMA)
+        # Bases creadas antes de los alias de proveedores
+        columnas = {fila[1] for fila in conexion.execute("PRAGMA table_info(proveedores)")}
+        if 'alias' not in columnas:
+            conexion.execute("ALTER TABLE proveedores ADD COLUMN alias TEXT NOT NULL DEFAULT '[]'")
+        try:
+            conexion.executescript(ESQUEMA_FTS)
+        except sqlite3.OperationalError as e:
+            # SQLite compilado sin FTS5: la búsqueda de texto cae a LIKE
+            print(f"FTS5 no disponible en SQLite ({e}), búsqueda por nombre sin índice full-text")
+            self.fts_disponible = False
+
+    def _consultar(self, where: str = "", parametros: tuple = (), sufijo: str = "") -> List[ProductoStock]:
+        sql = f"SELECT {', '.join(COLUMNAS_PRODUCTO)} FROM productos {where} {sufijo}"
+        return [_producto_desde_fila(fila) for fila in self._conexion().execute(sql, parametros)]
+
+    # --- Lecturas ---
+
+    def listar(self) -> List[ProductoStock]:
+        return self._consultar(sufijo="ORDER BY id")
+
+    def obtener(self, producto_id: int) -> Optional[ProductoStock]:
+        resultado = self._consultar("WHERE id = ?", (producto_id,))
+        return resultado[0] if resultado else None
+
+    def obtener_por_codigo(self, codigo: str) -> Optional[ProductoStock]:
+        resultado = self._consultar("WHERE codigo = ?", (codigo,), "LIMIT 1")
+        return resultado[0] if resultado else None
+
+    def listar_por_proveedor(self, proveedor_id: int) -> List[ProductoStock]:
+        return self._consultar("WHERE proveedor_id = ?", (proveedor_id,), "ORDER BY id")
+
+    def buscar_por_nombre(self, nombre: str) -> List[ProductoStock]:
+        return self._consultar("WHERE nombre_normalizado = ?", (normalizar_nombre(nombre),), "ORDER BY id")
+
+    def buscar_texto(self, texto: str, limite: int = 50) -> List[ProductoStock]:
+        palabras = normalizar_nombre(texto).split()
+        if not palabras:
+            return []
+        if self.fts_disponible:
+            consulta = ' '.join(f'"{palabra}"*' for palabra in palabras)
+            return self._consultar(
+                "WHERE id IN (SELECT rowid FROM productos_fts WHERE productos_fts MATCH ?)",
+                (consulta,), f"LIMIT {int(limite)}"
+            )
+        condiciones = ' AND '.join("nombre_normalizado LIKE ?" for _ in palabras)
+        return self._consultar(f"WHERE {condiciones}", tuple(f"%{p}%" for p in palabras), f"LIMIT {int(limite)}")
+
+    def listar_criticos(self, limite: Optional[int] = None, proveedor_id: Optional[int] = None) -> List[ProductoStock]:
+        where, parametros = "WHERE stock - stock_minimo <= 0", ()
+        if proveedor_id is not None:
+            where, parametros = where + " AND proveedor_id = ?", (proveedor_id,)
+        sufijo = "ORDER BY stock - stock_minimo, id" + (f" LIMIT {int(limite)}" if limite is not None else "")
+        return self._consultar(where, parametros, sufijo)
+
+    def criticos_por_proveedor(self, limite_por_proveedor: Optional[int] = None) -> Dict[int, List[ProductoStock]]:
+        # Numera los críticos dentro de cada proveedor y se queda con los primeros
+        limite = f"WHERE posicion <= {int(limite_por_proveedor)}" if limite_por_proveedor is not None else ""
+        sql = (
+            f"SELECT {', '.join(COLUMNAS_PRODUCTO)} FROM ("
+            f"SELECT *, ROW_NUMBER() OVER (PARTITION BY proveedor_id ORDER BY stock - stock_minimo, id) AS posicion "
+            f"FROM productos WHERE stock - stock_minimo <= 0) {limite} ORDER BY proveedor_id, posicion"
+        )
+        grupos: Dict[int, List[ProductoStock]] = {}
+        for fila in self._conexion().execute(sql):
+            producto = _producto_desde_fila(fila)
+            grupos.setdefault(producto.proveedor_id, []).append(producto)
+        return grupos
+
+    def revision(self) -> int:
+        with self._lock_revision:
+            return self._conexion_revision.execute("PRAGMA data_version").fetchone()[0]
+
+    def listar_proveedores(self) -> List[Proveedor]:
+        filas = self._conexion().execute(f"SELECT {', '.join(COLUMNAS_PROVEEDOR)} FROM proveedores ORDER BY id")
+        return [_proveedor_desde_fila(fila) for fila in filas]
+
+    # --- Escrituras ---
+
+    @contextmanager
+    def transaccion(self):
+        conexion = self._conexion()
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            tx = TransaccionSQLite(conexion)
+            yield tx
+            if tx.cambios:
+                tx._confirmar()
+            conexion.execute("COMMIT")
+        except BaseException:
+            conexion.execute("ROLLBACK")
+            raise
+
+    def reemplazar_todo(self, productos: List[ProductoStock]):
+        conexion = self._conexion()
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            conexion.execute("DELETE FROM productos")
+            _upsert_productos(conexion, productos)
+            conexion.execute("COMMIT")
+        except BaseException:
+            conexion.execute("ROLLBACK")
+            raise
+
+    def reemplazar_proveedores(self, proveedores: List[Proveedor]):
+        conexion = self._conexion()
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            conexion.execute("DELETE FROM proveedores")
+            conexion.executemany(
+                f"INSERT INTO proveedores ({', '.join(COLUMNAS_PROVEEDOR)}) VALUES ({', '.join('?' * len(COLUMNAS_PROVEEDOR))})",
+                (_fila_desde_proveedor(p) for p in proveedores)
+            )
+            conexion.execute("COMMIT")
+        except BaseException:
+            conexion.execute("ROLLBACK")
+            raise
+
+    def compactar(self):
+        self._conexion().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def migrar_desde_json(data_dir: str, ruta_db: str, forzar: bool = False):
+    """
+    Migración única: copia stock (snapshot + journal) y proveedores desde los JSON a SQLite
+    """
+    from repositorio_stock import RepositorioStock
+
+    origen = RepositorioStock(os.path.join(data_dir, 'stock.json'), ruta_proveedores=os.path.join(data_dir, 'proveedores.json'))
+    destino = RepositorioStockSQLite(ruta_db)
+
+    existentes = destino._conexion().execute("SELECT COUNT(*) FROM productos").fetchone()[0]
+    if existentes and not forzar:
+        raise SystemExit(f"❌ {ruta_db} ya tiene productos. Use --forzar para reemplazarlos.")
+
+    inicio = time.perf_counter()
+    productos = origen.listar()
+    proveedores = origen.listar_proveedores()
+    destino.reemplazar_todo(productos)
+    destino.reemplazar_proveedores(proveedores)
+    destino.compactar()
+    print(f"✅ Migrados {len(productos)} productos y {len(proveedores)} proveedores a {ruta_db} "
+          f"en {time.perf_counter() - inicio:.2f}s")
+    print("Para usarlo: STOCKAI_ALMACENAMIENTO=sqlite")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Almacenamiento SQLite de StockAI")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+    migrar = subparsers.add_parser("migrar", help="Migra stock.json y proveedores.json a SQLite")
+    migrar.add_argument("--data-dir", default=os.getenv("STOCKAI_DATA_DIR", "data"))
+    migrar.add_argument("--db", default=None, help="Ruta de la base (por defecto <data-dir>/stockai.db)")
+    migrar.add_argument("--forzar", action="store_true", help="Reemplaza los datos si la base ya existe")
+    args = parser.parse_args()
+
+    migrar_desde_json(args.data_dir, args.db or os.path.join(args.data_dir, 'stockai.db'), args.forzar)
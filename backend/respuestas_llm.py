@@ -0,0 +1,228 @@
+"""
+Respuestas estructuradas del LLM: cada llamada declara un modelo Pydantic, se le pasa a OpenAI como
+esquema de una herramienta (tool calling) y la respuesta se valida en una sola pasada. Si algunos
+campos o elementos no validan, se vuelven a pedir solo esos, no la respuesta entera.
+"""
+import json
+from typing import Any, Awaitable, Callable, Dict, List, Literal, Optional, Tuple, Type, TypeVar, get_args, get_origin
+
+from pydantic import BaseModel, ValidationError, create_model, field_validator
+from pydantic.json_schema import SkipJsonSchema
+
+from modelos import ProductDetected
+from parser_facturas import parsear_numero
+
+M = TypeVar('M', bound=BaseModel)
+
+NOMBRE_HERRAMIENTA = "responder"
+
+_NUMERICOS = (int, float, Optional[int], Optional[float])
+
+
+def extraer_json(content: str) -> Any:
+    """JSON de la respuesta, tolerando un bloque ```json ... ``` alrededor"""
+    content = content.strip()
+    if content.startswith('```'):
+        content = content.split('```')[1]
+        if content.startswith('json'):
+            content = content[4:]
+    return json.loads(content)
+
+
+class _ModeloLLM(BaseModel):
+    """Base de las respuestas del LLM: acepta números como texto ("$1.250,50", "2.00")"""
+
+    @field_validator('*', mode='before')
+    @classmethod
+    def _numero_desde_texto(cls, valor, info):
+        if isinstance(valor, str) and cls.model_fields[info.field_name].annotation in _NUMERICOS:
+            numero = parsear_numero(valor)
+            return valor if numero is None else numero
+        return valor
+
+
+class ProductoExtraido(ProductDetected, _ModeloLLM):
+    precio_sin_impuestos: Optional[float] = None
+    # Lo calcula el backend según el proveedor, no el LLM
+    precio_con_impuestos: SkipJsonSchema[float] = None
+
+
+class ExtraccionProductos(_ModeloLLM):
+    """Productos detectados en el texto de una factura"""
+    productos: List[ProductoExtraido] = []
+
+
+class ProductosDeTexto(_ModeloLLM):
+    id: int
+    productos: List[ProductoExtraido] = []
+
+
+class ExtraccionLote(_ModeloLLM):
+    """Productos detectados en cada uno de los textos de facturas, identificados por su id"""
+    textos: List[ProductosDeTexto] = []
+
+
+class ProductoMatchingTexto(_ModeloLLM):
+    nombre: str
+    cantidad: int
+    precio_sin_impuestos: Optional[float] = None
+    accion: Literal['entrada', 'salida'] = 'entrada'
+    confianza: float = 0
+    es_nuevo: bool = False
+    producto_id: Optional[int] = None
+
+
+class MatchingTexto(_ModeloLLM):
+    """Productos mencionados en un texto libre (o audio transcrito), con su matching contra el inventario"""
+    productos: List[ProductoMatchingTexto] = []
+    proveedor_detectado: Optional[str] = None
+    analisis_ia: str = ''
+
+
+class MatchingTextoConId(MatchingTexto):
+    id: int
+
+
+class MatchingTextoLote(_ModeloLLM):
+    """Resultado del matching de cada uno de los textos de entrada, identificado por su id"""
+    resultados: List[MatchingTextoConId] = []
+
+
+class ActualizacionStock(_ModeloLLM):
+    producto_detectado: str
+    stock_id: int
+    stock_nombre: str
+    cantidad: int
+    accion: Literal['entrada', 'salida'] = 'entrada'
+
+
+class ProductoNuevo(_ModeloLLM):
+    nombre: str
+    cantidad: int
+    accion: Literal['entrada', 'salida'] = 'entrada'
+    precio_sin_impuestos: Optional[float] = None
+
+
+class MatchingStock(_ModeloLLM):
+    """Productos detectados que coinciden con uno del stock (actualizaciones) y los que son nuevos"""
+    actualizaciones: List[ActualizacionStock] = []
+    nuevos: List[ProductoNuevo] = []
+
+
+def herramienta(modelo: Type[BaseModel]) -> dict:
+    """Definición de la herramienta con el esquema JSON del modelo"""
+    return {
+        "type": "function",
+        "function": {
+            "name": NOMBRE_HERRAMIENTA,
+            "description": (modelo.__doc__ or modelo.__name__).strip(),
+            "parameters": modelo.model_json_schema(),
+        },
+    }
+
+
+def _tipo_elemento(modelo: Type[BaseModel], campo: str) -> Optional[type]:
+    """Tipo de los elementos si el campo es una lista de modelos"""
+    anotacion = modelo.model_fields[campo].annotation
+    if get_origin(anotacion) in (list, List):
+        (tipo,) = get_args(anotacion)
+        if isinstance(tipo, type) and issubclass(tipo, BaseModel):
+            return tipo
+    return None
+
+
+def validar_parcial(modelo: Type[M], datos: Any) -> Tuple[dict, Dict[str, Any], List[str]]:
+    """
+    Valida los datos contra el modelo campo por campo. Devuelve:
+    - los datos sin lo que falló
+    - lo que falló: {campo: valor} para campos simples, {campo: [elementos]} para listas de modelos
+    - los mensajes de error
+    """
+    if not isinstance(datos, dict):
+        return {}, {campo: None for campo in modelo.model_fields}, ["la respuesta no es un objeto JSON"]
+    try:
+        modelo.model_validate(datos)
+        return datos, {}, []
+    except ValidationError as e:
+        errores = e.errors()
+
+    validos = dict(datos)
+    indices_fallidos: Dict[str, set] = {}
+    fallidos: Dict[str, Any] = {}
+    mensajes = []
+    for error in errores:
+        ubicacion = error['loc']
+        mensajes.append(f"{'.'.join(str(parte) for parte in ubicacion)}: {error['msg']}")
+        campo = ubicacion[0] if ubicacion else None
+        if campo not in modelo.model_fields:
+            continue
+        if _tipo_elemento(modelo, campo) and len(ubicacion) > 1 and isinstance(ubicacion[1], int):
+            indices_fallidos.setdefault(campo, set()).add(ubicacion[1])
+        else:
+            fallidos[campo] = validos.pop(campo, None)
+
+    for campo, indices in indices_fallidos.items():
+        if campo in fallidos:
+            continue
+        elementos = validos[campo]
+        fallidos[campo] = [elementos[i] for i in sorted(indices)]
+        validos[campo] = [elemento for i, elemento in enumerate(elementos) if i not in indices]
+    return validos, fallidos, mensajes
+
+
+def _modelo_correccion(modelo: Type[BaseModel], fallidos: Dict[str, Any]) -> Type[BaseModel]:
+    """Modelo con solo los campos que hay que volver a pedir"""
+    campos = {campo: (modelo.model_fields[campo].annotation, ...) for campo in fallidos}
+    return create_model(f"Correccion{modelo.__name__}", __base__=_ModeloLLM, __doc__="Valores corregidos", **campos)
+
+
+async def completar_estructurado(completar: Callable[..., Awaitable[str]], operacion: str, modelo: Type[M],
+                                 messages: List[dict], reintentos: int = 1, **parametros) -> M:
+    """
+    Pide la respuesta como llamada a la herramienta con el esquema de `modelo` y la valida.
+    Los campos o elementos de listas que no validan se vuelven a pedir (hasta `reintentos` veces)
+    y se combinan con los válidos; si siguen sin validar se descartan.
+
+    `completar` es la función que llama al chat (con cache y registro de tokens) y devuelve el texto
+    o los argumentos de la herramienta. Si el JSON de la respuesta no se puede leer, lanza ValueError
+    """
+    content = await completar(
+        operacion, messages=messages,
+        tools=[herramienta(modelo)],
+        tool_choice={"type": "function", "function": {"name": NOMBRE_HERRAMIENTA}},
+        **parametros
+    )
+    validos, fallidos, errores = validar_parcial(modelo, extraer_json(content))
+
+    for _ in range(reintentos):
+        if not fallidos:
+            break
+        print(f"🩹 {operacion}: {len(errores)} errores de validación, se vuelven a pedir: {', '.join(fallidos)}")
+        correccion = _modelo_correccion(modelo, fallidos)
+        pedido = (
+            "Estos valores de tu respuesta no cumplen el formato pedido:\n"
+            f"{json.dumps(fallidos, ensure_ascii=False, default=str)}\n\n"
+            "Errores:\n" + "\n".join(errores) + "\n\n"
+            "Devolvé solo estos campos corregidos, con la herramienta."
+        )
+        try:
+            content = await completar(
+                operacion + "_correccion",
+                messages=messages + [{"role": "user", "content": pedido}],
+                tools=[herramienta(correccion)],
+                tool_choice={"type": "function", "function": {"name": NOMBRE_HERRAMIENTA}},
+                **parametros
+            )
+            corregidos, fallidos, errores = validar_parcial(correccion, extraer_json(content))
+        except ValueError as e:
+            print(f"⚠️ {operacion}: la corrección no se pudo leer: {e}")
+            break
+        for campo, valor in corregidos.items():
+            if _tipo_elemento(modelo, campo):
+                validos[campo] = list(validos.get(campo) or []) + list(valor)
+            else:
+                validos[campo] = valor
+
+    if fallidos:
+        print(f"⚠️ {operacion}: se descartan valores inválidos en {', '.join(fallidos)}: {'; '.join(errores)}")
+    return modelo.model_validate(validos)
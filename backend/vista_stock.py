@@ -0,0 +1,293 @@
+"""
+Vista columnar del stock para GET /api/stock: cada campo es una columna (NumPy para los
+números, arrays de objetos para el texto), así el proveedor y el precio con impuestos se
+calculan para todo el catálogo en una sola pasada vectorizada.
+
+La tabla y el JSON ya serializado se guardan hasta que cambie la revisión del stock o los
+proveedores: los GET seguidos sin cambios no recorren los productos.
+
+Las consultas con filtros, orden y paginación recorren la tabla por bloques en el orden pedido
+(la permutación de cada orden se calcula una vez por tabla): la primera página cuesta lo mismo
+con 10 mil que con un millón de productos.
+"""
+import base64
+import binascii
+import json
+import threading
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from modelos import ProductoStock, Proveedor
+from repositorio_stock import normalizar_nombre
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CAMPOS_PRODUCTO = list(ProductoStock.model_fields)
+CAMPOS_RESPUESTA = CAMPOS_PRODUCTO + ['precio_con_impuestos', 'proveedor_nombre']
+_TIPOS_COLUMNA = {'id': np.int64, 'stock': np.int64, 'stock_minimo': np.int64, 'precio_base': np.float64,
+                  'proveedor_id': np.int64, 'version': np.int64}
+
+# Productos cuyo proveedor no existe
+IMPUESTO_POR_DEFECTO = 21
+PROVEEDOR_DESCONOCIDO = "Desconocido"
+
+# Filas del primer bloque al recorrer la tabla; cada bloque siguiente duplica hasta BLOQUE_MAX
+BLOQUE_INICIAL = 1000
+BLOQUE_MAX = 65536
+
+
+def dumps_json(datos) -> bytes:
+    """JSON compacto en UTF-8, con orjson si está instalado (varias veces más rápido que json)"""
+    if orjson is not None:
+        return orjson.dumps(datos)
+    return json.dumps(datos, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def redondear_precios(valores: np.ndarray) -> np.ndarray:
+    """
+    Redondeo a 2 decimales idéntico a round() de Python. np.round escala por 100 y puede diferir
+    en los casos que caen casi justo en medio centavo: esos pocos se redondean con round()
+    """
+    redondeados = np.round(valores, 2)
+    centavos = valores * 100
+    dudosos = np.flatnonzero(np.abs(centavos - np.floor(centavos) - 0.5) < 1e-6)
+    for i in dudosos.tolist():
+        redondeados[i] = round(float(valores[i]), 2)
+    return redondeados
+
+
+@dataclass(frozen=True)
+class ConsultaStock:
+    """
+    Filtros, orden y campos de GET /api/stock. `orden` es un campo de CAMPOS_RESPUESTA, con "-"
+    adelante para orden descendente; los empates se ordenan por id
+    """
+    proveedor_id: Optional[int] = None
+    categoria: Optional[str] = None
+    criticos: bool = False
+    buscar: Optional[str] = None
+    orden: str = "id"
+    campos: Optional[Tuple[str, ...]] = None
+
+    def __post_init__(self):
+        if self.campo_orden not in CAMPOS_RESPUESTA:
+            raise ValueError(f"No se puede ordenar por '{self.campo_orden}'")
+        desconocidos = [campo for campo in self.campos or () if campo not in CAMPOS_RESPUESTA]
+        if desconocidos:
+            raise ValueError(f"Campos desconocidos: {', '.join(desconocidos)}")
+
+    @property
+    def campo_orden(self) -> str:
+        return self.orden.lstrip("-")
+
+    @property
+    def descendente(self) -> bool:
+        return self.orden.startswith("-")
+
+    @property
+    def palabras(self) -> List[str]:
+        return normalizar_nombre(self.buscar).split() if self.buscar else []
+
+
+def codificar_cursor(orden: str, valor, producto_id: int) -> str:
+    """Cursor opaco con la posición después de la última fila entregada (valor de orden e id)"""
+    datos = dumps_json({"o": orden, "v": valor, "id": producto_id})
+    return base64.urlsafe_b64encode(datos).decode("ascii").rstrip("=")
+
+
+def decodificar_cursor(cursor: str, orden: str) -> Tuple[object, int]:
+    try:
+        datos = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        valor, producto_id = datos["v"], int(datos["id"])
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError, KeyError):
+        raise ValueError("Cursor inválido")
+    if datos.get("o") != orden:
+        raise ValueError("El cursor es de otro orden")
+    return valor, producto_id
+
+
+class TablaStock:
+    """
+    Stock en columnas, enriquecido con `precio_con_impuestos` y `proveedor_nombre`.
+    Las filas se arman recién al serializar, y solo con los campos pedidos
+    """
+
+    def __init__(self, productos: Sequence[ProductoStock], proveedores: List[Proveedor]):
+        self.columnas = {
+            campo: np.array([getattr(p, campo) for p in productos], dtype=_TIPOS_COLUMNA.get(campo, object))
+            for campo in CAMPOS_PRODUCTO
+        }
+        self._enriquecer(proveedores)
+        # Por campo de orden: (permutación ascendente por (valor, id), valores e ids en ese orden)
+        self._ordenes = {}
+        # Nombres normalizados para buscar, calculados a medida que se recorren
+        self._nombres_normalizados = np.full(len(self), None, dtype=object)
+
+    def __len__(self) -> int:
+        return len(self.columnas['id'])
+
+    def _enriquecer(self, proveedores: List[Proveedor]):
+        # Proveedor de cada producto por búsqueda binaria sobre los ids de proveedor ordenados
+        ids_proveedor = np.array([p.id for p in proveedores], dtype=np.int64)
+        orden = np.argsort(ids_proveedor, kind="stable")  # con ids repetidos gana el primero, como antes
+        ids_ordenados = ids_proveedor[orden]
+        posiciones = np.searchsorted(ids_ordenados, self.columnas['proveedor_id'])
+        posiciones = np.minimum(posiciones, max(len(ids_ordenados) - 1, 0))
+        existe = ids_ordenados[posiciones] == self.columnas['proveedor_id'] if len(ids_ordenados) else \
+            np.zeros(len(self), dtype=bool)
+        # Índice del proveedor en la lista, o el último lugar (sin proveedor) si no existe
+        indice = np.where(existe, orden[posiciones] if len(orden) else 0, len(proveedores))
+
+        impuestos = np.array([p.impuesto for p in proveedores] + [IMPUESTO_POR_DEFECTO], dtype=np.float64)
+        nombres = np.array([p.nombre for p in proveedores] + [PROVEEDOR_DESCONOCIDO], dtype=object)
+        self.columnas['precio_con_impuestos'] = redondear_precios(
+            self.columnas['precio_base'] * (1 + impuestos[indice] / 100)
+        )
+        self.columnas['proveedor_nombre'] = nombres[indice]
+
+    # --- Consultas ---
+
+    def _orden(self, campo: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        orden = self._ordenes.get(campo)
+        if orden is None:
+            claves = self.columnas[campo]
+            if claves.dtype == object:
+                claves = claves.astype(str)
+            permutacion = np.lexsort((self.columnas['id'], claves))
+            orden = self._ordenes[campo] = (permutacion, claves[permutacion], self.columnas['id'][permutacion])
+        return orden
+
+    def _posicion(self, consulta: ConsultaStock, valor, producto_id: int) -> int:
+        """Posición en el orden de la consulta de la primera fila posterior a (valor, producto_id)"""
+        _, claves, ids = self._orden(consulta.campo_orden)
+        if claves.dtype.kind == 'U':
+            valor = str(valor)
+        desde = np.searchsorted(claves, valor, 'left')
+        hasta = np.searchsorted(claves, valor, 'right')
+        if consulta.descendente:
+            # Quedan las filas menores que el cursor, que en orden descendente van al final
+            return len(claves) - (desde + int(np.searchsorted(ids[desde:hasta], producto_id, 'left')))
+        return desde + int(np.searchsorted(ids[desde:hasta], producto_id, 'right'))
+
+    def _filtrar(self, filas: np.ndarray, consulta: ConsultaStock) -> np.ndarray:
+        mascara = np.ones(len(filas), dtype=bool)
+        if consulta.proveedor_id is not None:
+            mascara &= self.columnas['proveedor_id'][filas] == consulta.proveedor_id
+        if consulta.categoria is not None:
+            mascara &= self.columnas['categoria'][filas] == consulta.categoria
+        if consulta.criticos:
+            mascara &= self.columnas['stock'][filas] <= self.columnas['stock_minimo'][filas]
+        filas = filas[mascara]
+        palabras = consulta.palabras
+        if palabras and len(filas):
+            nombres = self._nombres_normalizados
+            pendientes = filas[np.equal(nombres[filas], None)]
+            for fila, nombre in zip(pendientes.tolist(), self.columnas['nombre'][pendientes].tolist()):
+                nombres[fila] = normalizar_nombre(nombre)
+            filas = filas[np.fromiter((all(p in nombre for p in palabras) for nombre in nombres[filas].tolist()),
+                                      dtype=bool, count=len(filas))]
+        return filas
+
+    def recorrer(self, consulta: ConsultaStock, cursor: Optional[str] = None) -> Iterator[np.ndarray]:
+        """Índices de las filas que cumplen la consulta, en orden y por bloques, desde el cursor"""
+        permutacion = self._orden(consulta.campo_orden)[0]
+        if consulta.descendente:
+            permutacion = permutacion[::-1]
+        posicion = self._posicion(consulta, *decodificar_cursor(cursor, consulta.orden)) if cursor else 0
+        bloque = BLOQUE_INICIAL
+        while posicion < len(permutacion):
+            filas = self._filtrar(permutacion[posicion:posicion + bloque], consulta)
+            posicion += bloque
+            bloque = min(2 * bloque, BLOQUE_MAX)
+            if len(filas):
+                yield filas
+
+    def pagina(self, consulta: ConsultaStock, limite: int = None,
+               cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """Hasta `limite` filas (todas si es None) y el cursor de la página siguiente, si hay más"""
+        seleccion, cantidad = [], 0
+        for filas in self.recorrer(consulta, cursor):
+            seleccion.append(filas)
+            cantidad += len(filas)
+            if limite is not None and cantidad > limite:
+                break
+        indices = np.concatenate(seleccion) if seleccion else np.zeros(0, dtype=np.int64)
+        siguiente = None
+        if limite is not None and len(indices) > limite:
+            indices = indices[:limite]
+            ultima = indices[-1]
+            valor = self.columnas[consulta.campo_orden][[ultima]].tolist()[0]
+            siguiente = codificar_cursor(consulta.orden, valor, int(self.columnas['id'][ultima]))
+        return self.filas(indices, list(consulta.campos) if consulta.campos else None), siguiente
+
+    def ndjson(self, consulta: ConsultaStock, limite: int = None, cursor: Optional[str] = None) -> Iterator[bytes]:
+        """Las filas de la consulta como NDJSON (un producto por línea), un bloque por vez"""
+        campos = list(consulta.campos) if consulta.campos else None
+        restantes = limite
+        for filas in self.recorrer(consulta, cursor):
+            if restantes is not None:
+                filas = filas[:restantes]
+                restantes -= len(filas)
+            yield b"".join(dumps_json(fila) + b"\n" for fila in self.filas(filas, campos))
+            if restantes == 0:
+                return
+
+    def filas(self, indices: Optional[np.ndarray] = None, campos: Optional[List[str]] = None) -> List[dict]:
+        """Productos como dicts (todos, o los de `indices` en ese orden), con los campos pedidos"""
+        campos = campos or CAMPOS_RESPUESTA
+        columnas = [
+            (self.columnas[campo] if indices is None else self.columnas[campo][indices]).tolist()
+            for campo in campos
+        ]
+        return [dict(zip(campos, valores)) for valores in zip(*columnas)]
+
+
+class VistaStock:
+    """
+    TablaStock del repositorio, reconstruida solo cuando cambia `repositorio.revision()` o los
+    proveedores. También guarda el JSON completo de GET /api/stock ya serializado
+    """
+
+    def __init__(self, repositorio):
+        self.repositorio = repositorio
+        self._lock = threading.Lock()
+        self._clave = None
+        self._tabla: Optional[TablaStock] = None
+        self._json: Optional[bytes] = None
+        self.reconstrucciones = 0
+
+    def _clave_actual(self):
+        revision = self.repositorio.revision()
+        if revision is None:
+            return None
+        proveedores = tuple((p.id, p.nombre, p.impuesto) for p in self.repositorio.listar_proveedores())
+        return revision, proveedores
+
+    def vigente(self) -> bool:
+        """True si la tabla guardada corresponde al stock actual"""
+        clave = self._clave_actual()
+        return clave is not None and clave == self._clave
+
+    def tabla(self) -> TablaStock:
+        with self._lock:
+            # La revisión se lee antes que el stock: si cambia en el medio, se reconstruye de nuevo
+            clave = self._clave_actual()
+            if clave is None or clave != self._clave or self._tabla is None:
+                self._tabla = TablaStock(self.repositorio.listar(), self.repositorio.listar_proveedores())
+                self._clave = clave
+                self._json = None
+                self.reconstrucciones += 1
+            return self._tabla
+
+    def json_completo(self) -> bytes:
+        """Cuerpo de GET /api/stock sin parámetros: {"stock": [...], "success": true}"""
+        tabla = self.tabla()
+        with self._lock:
+            if self._json is None or self._tabla is not tabla:
+                self._json = dumps_json({"stock": tabla.filas(), "success": True})
+            return self._json